@@ -0,0 +1,116 @@
+import itertools
+import logging
+import os
+import pickle
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Checkpointer(object):
+    """
+    Periodically save a model being trained.
+
+    A checkpoint is the pickled model, including its online feature state
+    and the number of rows it has consumed, followed by the training state
+    that isn't pickled with the model. By default it's written from
+    a forked child so the training process only pays for the fork itself.
+    Files are written to a temporary name and atomically renamed.
+    """
+
+    def __init__(self, filename, every_n_rows=None, every_seconds=None, fork=True):
+        self.filename = filename
+        self.every_n_rows = every_n_rows
+        self.every_seconds = every_seconds
+        self.fork = fork and hasattr(os, 'fork')
+
+        self._last_rows = 0
+        self._last_time = time.time()
+        self._child_pid = None
+
+    def maybe_save(self, model):
+        """Save a checkpoint if enough rows or time have passed."""
+        due = False
+
+        if self.every_n_rows is not None and model.n_rows - self._last_rows >= self.every_n_rows:
+            due = True
+
+        if self.every_seconds is not None and time.time() - self._last_time >= self.every_seconds:
+            due = True
+
+        if due:
+            self.save(model)
+
+    def save(self, model):
+        if self.fork:
+            if not self._reap(block=False):
+                # The previous snapshot is still being written. Don't stall.
+                return
+
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    self._write(model)
+                except Exception:
+                    status = 1
+                finally:
+                    os._exit(status)
+            self._child_pid = pid
+        else:
+            self._write(model)
+
+        self._last_rows = model.n_rows
+        self._last_time = time.time()
+
+        _logger.info('Checkpoint at row {} saved to {}'.format(model.n_rows, self.filename))
+
+    def wait(self):
+        """Wait for a background snapshot to finish."""
+        self._reap(block=True)
+
+    def _reap(self, block):
+        """Collect a finished snapshot process. Returns False if it's still running."""
+        if self._child_pid is None:
+            return True
+
+        pid, status = os.waitpid(self._child_pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return False
+
+        if status != 0:
+            _logger.warning('Checkpoint process exited with status {}'.format(status))
+
+        self._child_pid = None
+        return True
+
+    def _write(self, model):
+        tmp_filename = '{}.tmp.{}'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(model.get_training_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self.filename)
+
+
+def load_checkpoint(filename):
+    """Load a model to continue training with fit(..., resume=True)."""
+    with open(filename, 'rb') as f:
+        model = pickle.load(f)
+        model.set_training_state(pickle.load(f))
+    return model
+
+
+def resume_iterator(dataset, model, prefetch=None):
+    """
+    Rows of a sparse dataset a checkpointed model hasn't been trained on.
+
+    The model counts rows it was trained on, so with negative
+    downsampling they are skipped in the downsampled stream rather
+    than in the file, which takes decoding them.
+    """
+    if model.negative_rate == 1:
+        return dataset.iterator(offset=model.n_rows, prefetch=prefetch)
+
+    data = dataset.iterator(prefetch=prefetch, negative_rate=model.negative_rate)
+    return itertools.islice(data, model.n_rows, None)
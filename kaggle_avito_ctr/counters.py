@@ -0,0 +1,128 @@
+import collections
+import math
+import random
+
+import numpy as np
+
+from . import utils
+
+
+class DictCounterStore(object):
+    """Exact counters in a dict. Reference implementation."""
+
+    def __init__(self):
+        self._counts = collections.defaultdict(int)
+
+    def get(self, key):
+        return self._counts.get(key, 0)
+
+    def increment(self, key, amount=1):
+        self._counts[key] += amount
+
+
+class ArrayCounterStore(object):
+    """
+    Exact counters in a dense int32 array indexed by non-negative integer ids.
+
+    The array grows on demand, so memory is proportional to the largest id.
+    Negative ids are rejected rather than indexed from the end.
+    """
+
+    def __init__(self, size=1024):
+        self._counts = np.zeros(size, dtype=np.int32)
+
+    def get(self, key):
+        self._check_key(key)
+        if key >= self._counts.shape[0]:
+            return 0
+        return int(self._counts[key])
+
+    def increment(self, key, amount=1):
+        self._check_key(key)
+        if key >= self._counts.shape[0]:
+            self._counts = utils.grow(self._counts, key + 1)
+        self._counts[key] += amount
+
+    def _check_key(self, key):
+        if key < 0:
+            raise ValueError('Array counters need non-negative ids, got {}'.format(key))
+
+
+class CountMinCounterStore(object):
+    """
+    Approximate counters in a count-min sketch with a fixed memory budget.
+
+    Counts are never underestimated. With width = ceil(e / epsilon) and
+    depth = ceil(ln(1 / delta)) a count is overestimated by more than
+    epsilon * total with probability at most delta.
+    """
+
+    # Small enough for a * x + b to fit in int64 when hashing arrays of keys.
+    _PRIME = 2 ** 31 - 1
+
+    def __init__(self, width=2 ** 20, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+
+        # Coefficients of a universal hash family h(x) = ((a * x + b) mod p) mod width.
+        rng = random.Random(seed)
+        self._a = [rng.randrange(1, self._PRIME) for _ in range(depth)]
+        self._b = [rng.randrange(0, self._PRIME) for _ in range(depth)]
+        self._counts = np.zeros((depth, width), dtype=np.int32)
+
+    @classmethod
+    def from_error_bound(cls, epsilon, delta, seed=0):
+        width = int(math.ceil(math.e / epsilon))
+        depth = int(math.ceil(math.log(1 / delta)))
+        return cls(width, depth, seed)
+
+    @property
+    def epsilon(self):
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+
+    def error_bound(self):
+        """Overestimate that any count exceeds with probability at most delta."""
+        return self.epsilon * self.total
+
+    def _columns(self, key):
+        return [((a * key + b) % self._PRIME) % self.width for a, b in zip(self._a, self._b)]
+
+    def _columns_many(self, keys):
+        """Columns of an array of keys in every row, shape (depth, len(keys))."""
+        keys = np.asarray(keys, dtype=np.int64) % self._PRIME
+        a = np.array(self._a, dtype=np.int64)[:, np.newaxis]
+        b = np.array(self._b, dtype=np.int64)[:, np.newaxis]
+        return ((a * keys + b) % self._PRIME) % self.width
+
+    def get(self, key):
+        return int(min(self._counts[row, column] for row, column in enumerate(self._columns(key))))
+
+    def get_many(self, keys):
+        """Counts of an array of keys."""
+        columns = self._columns_many(keys)
+        return self._counts[np.arange(self.depth)[:, np.newaxis], columns].min(axis=0)
+
+    def increment(self, key, amount=1):
+        for row, column in enumerate(self._columns(key)):
+            self._counts[row, column] += amount
+        self.total += amount
+
+    def increment_many(self, keys, amounts=1):
+        """Increment an array of keys by a scalar or an array of amounts."""
+        columns = self._columns_many(keys)
+        amounts = np.broadcast_to(np.asarray(amounts, dtype=np.int32), columns.shape[1:])
+        for row in range(self.depth):
+            np.add.at(self._counts[row], columns[row], amounts)
+        self.total += int(amounts.sum())
+
+
+COUNTER_STORES = {
+    'dict': DictCounterStore,
+    'array': ArrayCounterStore,
+    'sketch': CountMinCounterStore,
+}
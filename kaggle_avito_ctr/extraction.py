@@ -1,11 +1,10 @@
 import gzip
 import json
+import time
+import zlib
 
-import sqlalchemy as sa
-
-from .globals import session
-from .models import (AdInfo, Category, Location, SearchInfo, TestSearchStream,
-                     TrainSearchStream, ValSearchStream, UserInfo)
+from . import profiling, streaming
+from .globals import DATA, get_session
 
 
 def _json_converter(v):
@@ -20,10 +19,21 @@ _special_converters = {
 
 
 class Dataset(object):
-    """Generic file-based dataset."""
+    """
+    Generic file-based dataset.
+
+    A row takes a line. In a file grouped by search, the features
+    shared by all ads of a search are written once, to a search line
+    followed by compact lines of its rows (see _split_row), which the
+    iterator expands back to the original rows. Both layouts are read
+    alike, grouped is only a choice of the writer.
+    """
 
-    def __init__(self, filename, mode='r'):
+    def __init__(self, filename, mode='r', grouped=False):
         self.file = self._open(filename, mode=mode)
+        self.grouped = grouped
+        self._search_line = None
+        self._decoded_search = (None, None)
 
     def _open(self, filename, *args, **kwargs):
         f = open(filename, *args, **kwargs)
@@ -35,12 +45,55 @@ class Dataset(object):
     def _decode_row(self, row):
         return row
 
+    def _is_search_line(self, line):
+        return False
+
+    def _encode_search(self, search):
+        raise NotImplementedError
+
+    def _decode_search(self, line):
+        raise NotImplementedError
+
+    def _split_row(self, row):
+        """(search record, compact row) of a row, the search record is shared by rows of a search."""
+        raise NotImplementedError
+
+    def _expand_row(self, search, row):
+        """The original row of a decoded search record and compact row."""
+        raise NotImplementedError
+
     def append(self, row):
+        if self.grouped:
+            search, row = self._split_row(row)
+            search_line = self._encode_search(search)
+            if search_line != self._search_line:
+                self.file.write(search_line + '\n')
+                self._search_line = search_line
+
+        timer = profiling.current_timer()
+        if timer is not None and timer.sample(type(self).__name__ + '.append'):
+            self._timed_append(row, timer)
+            return
+
         line = self._encode_row(row)
         line += '\n'
         self.file.write(line)
 
-    def iterator(self, offset=0, limit=None, skip_nth=None, every_nth=None, n_cycles=1):
+    def _timed_append(self, row, timer):
+        site = type(self).__name__ + '.append'
+
+        start = time.perf_counter()
+        line = self._encode_row(row)
+        line += '\n'
+        encoded = time.perf_counter()
+        self.file.write(line)
+        written = time.perf_counter()
+
+        timer.add(site + '.encode', encoded - start, site)
+        timer.add(site + '.write', written - encoded, site)
+
+    def iterator(self, offset=0, limit=None, skip_nth=None, every_nth=None, n_cycles=1, prefetch=None,
+                 negative_rate=None):
         """
         Iterator for the dataset.
 
@@ -50,15 +103,45 @@ class Dataset(object):
             skip_nth: Skip every N-th row.
             every_nth: Return only every N-th row.
             n_cycles: Iterate N times.
+            prefetch: Read and decode up to N blocks of rows ahead
+                in a background thread, see streaming.prefetch.
+            negative_rate: Return all positive rows and only this
+                fraction of negative ones, see keeps_negative.
         """
 
+        rows = self._iterate(offset, limit, skip_nth, every_nth, n_cycles, negative_rate)
+
+        if prefetch:
+            rows = streaming.prefetch(rows, depth=prefetch)
+
+        return rows
+
+    def _iterate(self, *args):
+        for search, row in self._iterate_compact(*args):
+            yield row if search is None else self._expand_row(search, row)
+
+    def _iterate_compact(self, offset, limit, skip_nth, every_nth, n_cycles, negative_rate):
+        """(decoded search record or None in a flat file, decoded line) pairs."""
         n_yielded = 0
+        timer = profiling.current_timer()
+        decode_site = type(self).__name__ + '.decode'
 
         for _ in range(n_cycles):
 
             self.reset()
 
-            for i, line in enumerate(self.file):
+            lines = self.file if timer is None else self._timed_lines(timer)
+            i = -1
+            search_line = search = None
+
+            for line in lines:
+
+                if self._is_search_line(line):
+                    # Decoded with the first row that needs it.
+                    search_line, search = line, None
+                    continue
+
+                i += 1
 
                 if i < offset:
                     continue
@@ -75,12 +158,72 @@ class Dataset(object):
                     continue
 
                 line = line.rstrip('\n')
-                row = self._decode_row(line)
 
-                yield row
+                # Dropped lines aren't decoded.
+                if (negative_rate is not None and not keeps_negative(line, negative_rate) and
+                        self._line_label(line) == 0):
+                    continue
+
+                if timer is not None and timer.sample(decode_site):
+                    start = time.perf_counter()
+                    row = self._decode_row(line)
+                    timer.add(decode_site, time.perf_counter() - start)
+                else:
+                    row = self._decode_row(line)
+
+                if search_line is not None and search is None:
+                    search = self._decode_search(search_line)
+
+                yield search, row
 
                 n_yielded += 1
 
+    def lines(self):
+        """
+        Undecoded rows of the file, e.g. to decode them in other processes with decode_line.
+
+        Yields:
+            (search line, line) pairs, the search line is None in a flat file.
+        """
+        self.reset()
+        search_line = None
+        for line in self.file:
+            if self._is_search_line(line):
+                search_line = line
+            else:
+                yield search_line, line.rstrip('\n')
+
+    def decode_line(self, line):
+        """An item of iterator from an item of lines."""
+        search_line, line = line
+        row = self._decode_row(line)
+        if search_line is not None:
+            # Rows of a search are consecutive, its last decoded record is kept.
+            if search_line != self._decoded_search[0]:
+                self._decoded_search = (search_line, self._decode_search(search_line))
+            row = self._expand_row(self._decoded_search[1], row)
+        return row
+
+    def _line_label(self, line):
+        """Label of an undecoded line, needed for negative downsampling."""
+        raise NotImplementedError
+
+    def _timed_lines(self, timer):
+        """Lines of the file timing reads, see profiling.SampledTimer."""
+        site = type(self).__name__ + '.read'
+        lines = iter(self.file)
+
+        while True:
+            if timer.sample(site):
+                start = time.perf_counter()
+                line = next(lines, None)
+                timer.add(site, time.perf_counter() - start)
+            else:
+                line = next(lines, None)
+            if line is None:
+                return
+            yield line
+
     def __enter__(self):
         return self
 
@@ -113,13 +256,57 @@ class JsonFormatMixin(object):
         decoded_row = json.loads(row)
         return decoded_row
 
+    def _is_search_line(self, line):
+        # Rows are arrays.
+        return line.startswith('{')
+
+    def _encode_search(self, search):
+        return json.dumps({'search': search}, ensure_ascii=False)
+
+    def _decode_search(self, line):
+        return json.loads(line)['search']
+
 
 class RawDataset(JsonFormatMixin, GzipCompressorMixin, Dataset):
 
+    # Positions of DATA['SEARCH_COLUMNS'] and their bit mask, looked up when writing.
+    _search_columns = None
+    _search_mask = None
+
     def get_field_names(self, part):
-        q = _make_query(part)
-        field_names = [c.name for c in q.statement.columns]
-        return field_names
+        return get_field_names(part)
+
+    def _line_label(self, line):
+        # is_click is the first column of train rows.
+        return int(line[1:line.index(',')])
+
+    def _split_row(self, row):
+        """
+        Values of search-level columns (DATA['SEARCH_COLUMNS']) go to
+        the search record along with a bit mask of their positions,
+        the compact row keeps the rest.
+        """
+        if self._search_columns is None:
+            # Only the first column differs between parts.
+            self._search_columns = frozenset(column for column, name in enumerate(get_field_names('train'))
+                                             if name in DATA['SEARCH_COLUMNS'])
+            self._search_mask = sum(1 << column for column in self._search_columns)
+
+        values = [value for column, value in enumerate(row) if column in self._search_columns]
+        compact_row = [value for column, value in enumerate(row) if column not in self._search_columns]
+
+        return [self._search_mask, values], compact_row
+
+    def _decode_search(self, line):
+        mask, values = super()._decode_search(line)
+        return _column_runs(mask), values
+
+    def _expand_row(self, search, row):
+        runs, values = search
+        # Runs are in ascending order, so every value lands where it was.
+        for column, start, stop in runs:
+            row[column:column] = values[start:stop]
+        return row
 
     def sparse_iterator(self, part, *args, **kwargs):
         """
@@ -141,13 +328,149 @@ class SparseDataset(JsonFormatMixin, GzipCompressorMixin, Dataset):
         Iterate over (x, label) pairs.
 
         label is either target for train or sample id for test.
+        Accepts arguments of Dataset.iterator.
         """
 
-        it = super().iterator(*args, **kwargs)
-        for row in it:
+        return super().iterator(*args, **kwargs)
+
+    def _iterate(self, *args):
+        for row in super()._iterate(*args):
             label = row.pop(0)[2]
             yield row, label
 
+    def decode_line(self, line):
+        row = super().decode_line(line)
+        label = row.pop(0)[2]
+        return row, label
+
+    def search_iterator(self, offset=0, limit=None, skip_nth=None, every_nth=None, n_cycles=1, prefetch=None,
+                        negative_rate=None):
+        """
+        Iterate over searches as (search-level features, [(ad-level features, label), ...]) pairs.
+
+        Consecutive rows with equal search-level features make up
+        a search, in a file of either layout. Rows of a grouped file
+        aren't expanded, rows of a flat one are split. Arguments are
+        those of Dataset.iterator.
+        """
+
+        searches = self._searches(self._iterate_compact(offset, limit, skip_nth, every_nth, n_cycles, negative_rate))
+
+        if prefetch:
+            searches = streaming.prefetch(searches, depth=prefetch)
+
+        return searches
+
+    def _searches(self, rows):
+        search = None
+        ads = []
+
+        for row_search, row in rows:
+            if row_search is None:
+                row_search, row = self._split_row(row)
+            if row_search is not search and row_search != search:
+                if ads:
+                    yield search, ads
+                search, ads = row_search, []
+            # The label is the first feature, runs of search-level ones are the last item.
+            ads.append((row[1:-1], row[0][2]))
+
+        if ads:
+            yield search, ads
+
+    def _line_label(self, line):
+        # The label is the first feature, decoding it alone is cheap.
+        return json.loads(line[:line.index(']') + 1] + ']')[0][2]
+
+    def _split_row(self, row):
+        """
+        Features of DATA['SEARCH_FIELDS'] go to the search record.
+        The compact row keeps the rest followed by a list of runs of
+        search-level features, [position, length, position, length, ...].
+        """
+        search = []
+        compact_row = []
+        runs = []
+
+        for position, item in enumerate(row):
+            if item[0] not in DATA['SEARCH_FIELDS']:
+                compact_row.append(item)
+                continue
+            if runs and runs[-2] + runs[-1] == position:
+                runs[-1] += 1
+            else:
+                runs += [position, 1]
+            search.append(item)
+
+        compact_row.append(runs)
+
+        return search, compact_row
+
+    def _expand_row(self, search, row):
+        # Rows of a search share its feature objects.
+        runs = row.pop()
+        start = 0
+
+        for i in range(0, len(runs), 2):
+            position = runs[i]
+            stop = start + runs[i + 1]
+            row[position:position] = search[start:stop]
+            start = stop
+
+        return row
+
+
+# Runs of search-level columns by a bit mask of their positions.
+_column_runs_cache = {}
+
+
+def _column_runs(mask):
+    """[(position, start, stop)] of runs of set bits, start and stop count set bits."""
+    runs = _column_runs_cache.get(mask)
+
+    if runs is None:
+        runs = []
+        column = start = 0
+        while mask >> column:
+            if mask >> column & 1:
+                if runs and runs[-1][0] + runs[-1][2] - runs[-1][1] == column:
+                    runs[-1] = (runs[-1][0], runs[-1][1], start + 1)
+                else:
+                    runs.append((column, start, start + 1))
+                start += 1
+            column += 1
+        _column_runs_cache[mask] = runs
+
+    return runs
+
+
+def keeps_negative(line, negative_rate):
+    """
+    Whether negative downsampling at negative_rate keeps a row if it is negative.
+
+    The decision is a hash of the encoded row rather than a random
+    draw, so every pass and every process keeps the same rows, and
+    rows kept at a lower rate are also kept at a higher one. In a
+    grouped file the compact line is hashed, so its sample differs
+    from the sample of the same rows in a flat file.
+    """
+    return zlib.crc32(line.encode('utf-8')) < negative_rate * 2 ** 32
+
+
+def downsample_negatives(rows, negative_rate):
+    """Raw train rows, e.g. of a query, sampled like RawDataset.iterator(negative_rate=...)."""
+    for row in rows:
+        # Rows are hashed as RawDataset encodes them.
+        if row[0] == 1 or keeps_negative(json.dumps(row, ensure_ascii=False), negative_rate):
+            yield row
+
+
+def get_field_names(part):
+    """Names of raw dataset columns. Doesn't need a database connection."""
+    q = _make_query(part, bound=False)
+    field_names = [c.name for c in q.statement.columns]
+    return field_names
+
 
 def extract_data(offset=None, limit=None):
     query = _make_query(offset, limit)
@@ -155,7 +478,11 @@ def extract_data(offset=None, limit=None):
         yield row
 
 
-def _make_query(part, offset=None, limit=None, p_sample=1):
+def _make_query(part, offset=None, limit=None, p_sample=1, bound=True):
+    # File datasets are read without SQLAlchemy.
+    import sqlalchemy as sa
+    from .models import (AdInfo, Category, Location, SearchInfo, TestSearchStream,
+                         TrainSearchStream, ValSearchStream, UserInfo)
 
     if part == 'train':
         SearchStream = TrainSearchStream
@@ -169,7 +496,10 @@ def _make_query(part, offset=None, limit=None, p_sample=1):
 
     search_date = sa.func.extract('epoch', SearchInfo.search_date).label('search_date')
 
-    query = (session.query(SearchStream)
+    # An unbound query can be compiled without a database.
+    session = get_session() if bound else None
+
+    query = (sa.orm.Query(SearchStream, session)
              .join(AdInfo, SearchStream.ad_id == AdInfo.ad_id)
              .outerjoin(AdCategory, AdInfo.category_id == AdCategory.category_id)
              .join(SearchInfo, SearchStream.search_id == SearchInfo.search_id)
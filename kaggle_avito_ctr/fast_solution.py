@@ -14,119 +14,221 @@ as the name is changed.
  0. You just DO WHAT THE FUCK YOU WANT TO.
 '''
 
+import math
+import zlib
 
-from datetime import datetime
-from csv import DictReader
-from math import exp, log, sqrt
-
-
-# parameters #################################################################
-
-train = 'data/train.tsv'  # path to training file
-test = 'data/test.tsv'  # path to testing file
-
-D = 2 ** 20   # number of weights use for learning
-alpha = .1    # learning rate for sgd optimization
-
-
-# function definitions #######################################################
-
-# A. Bounded logloss
-# INPUT:
-#     p: our prediction
-#     y: real answer
-# OUTPUT
-#     logarithmic loss of p given y
-def logloss(p, y):
-    p = max(min(p, 1. - 10e-12), 10e-12)
-    return -log(p) if y == 1. else -log(1. - p)
-
-
-# B. Apply hash trick of the original csv row
-# for simplicity, we treat both integer and categorical features as categorical
-# INPUT:
-#     csv_row: a csv dictionary, ex: {'Lable': '1', 'I1': '357', 'I2': '', ...}
-#     D: the max index that we can hash to
-# OUTPUT:
-#     x: a list of indices that its value is 1
-def get_x(csv_row, D):
-    x = [0]  # 0 is the index of the bias term
-    for key, value in csv_row.items():
-        index = int(value + key[1:], 16) % D  # weakest hash ever ;)
-        x.append(index)
-    return x  # x contains indices of features that have a value of 1
-
-
-# C. Get probability estimation on x
-# INPUT:
-#     x: features
-#     w: weights
-# OUTPUT:
-#     probability of p(y = 1 | x; w)
-def get_p(x, w):
-    wTx = 0.
-    for i in x:  # do wTx
-        wTx += w[i] * 1.  # w[i] * x[i], but if i in x we got x[i] = 1.
-    return 1. / (1. + exp(-max(min(wTx, 20.), -20.)))  # bounded sigmoid
-
-
-# D. Update given model
-# INPUT:
-#     w: weights
-#     n: a counter that counts the number of times we encounter a feature
-#        this is used for adaptive learning rate
-#     x: feature
-#     p: prediction of our model
-#     y: answer
-# OUTPUT:
-#     w: updated model
-#     n: updated count
-def update_w(w, n, x, p, y):
-    for i in x:
-        # alpha / (sqrt(n) + 1) is the adaptive learning rate heuristic
-        # (p - y) * x[i] is the current gradient
-        # note that in our case, if i in x then x[i] = 1
-        w[i] -= (p - y) * alpha / (sqrt(n[i]) + 1.)
-        n[i] += 1.
-
-    return w, n
-
-
-# training and testing #######################################################
-
-# initialize our model
-w = [0.] * D  # weights
-n = [0.] * D  # number of times we've encountered a feature
-
-# start training a logistic regression model using on pass sgd
-loss = 0.
-for t, row in enumerate(DictReader(open(train))):
-    y = 1. if row['is_click'] == '1' else 0.
-
-    del row['is_click']  # can't let the model peek the answer
-
-    # main training procedure
-    # step 1, get the hashed features
-    x = get_x(row, D)
-
-    # step 2, get prediction
-    p = get_p(x, w)
-
-    # for progress validation, useless for learning our model
-    loss += logloss(p, y)
-    if t % 1000000 == 0 and t > 1:
-        print('%s\tencountered: %d\tcurrent logloss: %f' % (
-            datetime.now(), t, loss/t))
-
-    # step 3, update model with answer
-    w, n = update_w(w, n, x, p, y)
-
-# testing (build kaggle's submission file)
-#with open('submission1234.csv', 'w') as submission:
-    #submission.write('Id,Predicted\n')
-    #for t, row in enumerate(DictReader(open(test))):
-        #Id = row['Id']
-        #del row['Id']
-        #x = get_x(row, D)
-        #p = get_p(x, w)
-        #submission.write('%s,%f\n' % (Id, p))
+import numpy as np
+
+from . import utils
+
+
+# Raw dataset columns that are not features.
+_SKIPPED_RAW_FIELDS = ('id', 'is_click', 'search_date')
+
+# Fields that SparseDataset rows carry as (field, 0, id) placeholders
+# for online features. They are hashed as categorical (field, id).
+_ID_FIELDS = ('ad_id', 'user_id')
+
+# Multipliers of the 64-bit mixing function (splitmix64 finalizer).
+_M1 = np.uint64(0x9E3779B97F4A7C15)
+_M2 = np.uint64(0xBF58476D1CE4E5B9)
+_M3 = np.uint64(0x94D049BB133111EB)
+
+
+def raw_to_sparse(row):
+    """
+    Convert a raw (name, value) row to (field, index, value) features
+    without a fitted preprocessor.
+
+    Every value is treated as categorical: floats are put into
+    logarithmic bins, dicts produce one feature per key-value pair
+    and missing values are skipped. Ids are kept the way SparseDataset
+    rows have them.
+    """
+
+    x = []
+
+    for name, value in row:
+        if value is None or name in _SKIPPED_RAW_FIELDS:
+            continue
+        if name in _ID_FIELDS:
+            x.append((name, 0, value))
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                x.append((name, '{}={}'.format(k, v), 1))
+        elif isinstance(value, float):
+            x.append((name, _log_bin(value), 1))
+        else:
+            x.append((name, value, 1))
+
+    return x
+
+
+def raw_iterator(dataset, part, *args, **kwargs):
+    """Iterate over (x, label) pairs of a RawDataset like SparseDataset.iterator."""
+    for row in dataset.sparse_iterator(part, *args, **kwargs):
+        label = row[0][1]
+        yield raw_to_sparse(row), label
+
+
+def _log_bin(value):
+    return int(math.copysign(round(4 * math.log1p(abs(value))), value))
+
+
+def hash_features(X, n_bits):
+    """
+    Hash (field, index) pairs of a batch of rows to [0, 2 ** n_bits).
+
+    Fields and non-integer indexes are reduced to integers with CRC32,
+    then the pairs are mixed in one vectorized pass. Id placeholders
+    (field, 0, id) are hashed as a (field, id) feature of value 1.
+
+    Returns:
+        (buckets, values, offsets) where features of the i-th row are
+        buckets[offsets[i]:offsets[i + 1]].
+    """
+
+    field_keys = []
+    index_keys = []
+    values = []
+    offsets = [0]
+    field_hashes = {}
+
+    for x in X:
+        for (field, index, value) in x:
+            if field in _ID_FIELDS:
+                index, value = value, 1
+            field_hash = field_hashes.get(field, None)
+            if field_hash is None:
+                field_hash = field_hashes[field] = zlib.crc32(field.encode('utf-8'))
+            field_keys.append(field_hash)
+            if not isinstance(index, int):
+                index = zlib.crc32(str(index).encode('utf-8'))
+            index_keys.append(index)
+            values.append(value)
+        offsets.append(len(values))
+
+    h = np.array(field_keys, dtype=np.uint64) * _M1 + np.array(index_keys, dtype=np.int64).astype(np.uint64)
+    h ^= h >> np.uint64(30)
+    h *= _M2
+    h ^= h >> np.uint64(27)
+    h *= _M3
+    h ^= h >> np.uint64(31)
+
+    buckets = (h & np.uint64(2 ** n_bits - 1)).astype(np.int64)
+
+    return buckets, np.array(values, dtype=np.float64), np.array(offsets, dtype=np.int64)
+
+
+class HashingLogisticRegression(object):
+    """
+    One-pass logistic regression over hashed features.
+
+    Weights live in a fixed array of 2 ** n_bits elements, so memory
+    doesn't depend on the number of distinct features and no
+    preprocessor has to be fitted. Rows are hashed a batch at a time,
+    updates are made row by row with the adaptive rate
+    alpha / (1 + sqrt(n)), n being the number of updates of a weight.
+    """
+
+    # Whether the score is a sum of per-feature contributions.
+    is_linear = True
+
+    def __init__(self, n_bits=20, alpha=0.1, batch_size=1000):
+        self.n_bits = n_bits
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.weights = None
+        self._counts = None
+        self.n_rows = 0
+
+    @property
+    def n_weights(self):
+        return int(np.count_nonzero(self._counts))
+
+    def get_weight(self, field, index):
+        feature = (field, 0, index) if field in _ID_FIELDS else (field, index, 1)
+        buckets, _, _ = hash_features([[feature]], self.n_bits)
+        return self.weights[buckets[0]]
+
+    def fit(self, data, monitor=None, validation=None):
+        """
+        Train the model on a stream of (x, y) pairs.
+
+        Args:
+            data: An iterable of (x, y) pairs.
+            monitor: An optional TrainingMonitor.
+            validation: An optional ProgressiveValidation.
+
+        Returns:
+            validation.result() if validation is given.
+        """
+
+        self.weights = np.zeros(2 ** self.n_bits, dtype=np.float64)
+        self._counts = np.zeros(2 ** self.n_bits, dtype=np.float64)
+        self.n_rows = 0
+
+        if monitor is not None:
+            monitor.start(self)
+
+        for batch in utils.chunked(data, self.batch_size):
+            xs, ys = zip(*batch)
+            buckets, values, offsets = hash_features(xs, self.n_bits)
+
+            for i, y in enumerate(ys):
+                start, stop = offsets[i], offsets[i + 1]
+                y_hat = self._update(buckets[start:stop], values[start:stop], y)
+
+                self.n_rows += 1
+
+                if self.n_rows % 100000 == 0:
+                    print('Processed {} rows'.format(self.n_rows), end='\r')
+
+                if monitor is not None:
+                    monitor.observe(y_hat, y)
+                    monitor.maybe_report(self)
+
+                if validation is not None:
+                    validation.observe(y_hat, y)
+
+        if monitor is not None:
+            monitor.finish(self)
+
+        print('Processed {} rows'.format(self.n_rows))
+
+        if validation is not None:
+            return validation.result()
+
+    def _update(self, buckets, values, y):
+        """Make a gradient step on a row. Returns the prediction before the step."""
+        z = self.weights[buckets].dot(values)
+        y_hat = 1 / (1 + math.exp(-max(min(z, 35), -35)))
+
+        # Colliding features of a row must all be applied, hence add.at.
+        rate = self.alpha / (1 + np.sqrt(self._counts[buckets]))
+        np.add.at(self.weights, buckets, -rate * (y_hat - y) * values)
+        np.add.at(self._counts, buckets, 1)
+
+        return y_hat
+
+    def predict(self, x):
+        return self.predict_batch([x])[0]
+
+    def predict_batch(self, X):
+        """
+        Predict click probabilities for many rows at once.
+
+        Args:
+            X: A list of rows.
+
+        Returns:
+            numpy.ndarray of probabilities.
+        """
+
+        return utils.sigmoid(self.margin_batch(X))
+
+    def margin_batch(self, X):
+        """Raw scores (log-odds) of many rows, see predict_batch."""
+        buckets, values, offsets = hash_features(X, self.n_bits)
+        row_ids = np.repeat(np.arange(len(X)), np.diff(offsets))
+        return np.bincount(row_ids, weights=self.weights[buckets] * values, minlength=len(X))
@@ -0,0 +1,330 @@
+import numpy as np
+import scipy.sparse
+
+from . import utils
+from .counters import DictCounterStore
+from .online_lr import OnlineLogisticRegression
+from .sparse import FeatureIndex
+
+
+def _has_repeats(columns):
+    return len(set(columns.tolist())) < len(columns)
+
+
+def _add_at(array, index, delta, repeated):
+    """
+    array[index] += delta.
+
+    If a row repeats a feature, its index repeats cells and
+    only np.add.at keeps the updates of every repetition.
+    It's several times slower, so it's used only then.
+    """
+    if repeated:
+        np.add.at(array, index, delta)
+    else:
+        array[index] += delta
+
+
+class FactorizationMachine(OnlineLogisticRegression):
+    """
+    Online factorization machine.
+
+    Pairwise interactions are modelled with k-dimensional latent factors
+    instead of explicit cross features, so the cost per row is O(n * k).
+    Linear weights follow the same adaptive learning rate as
+    OnlineLogisticRegression. Factors take per-coordinate AdaGrad steps:
+    a factor's gradient is a product of two feature values, which for
+    scaled continuous features is in the thousands, and a step that
+    doesn't shrink with it makes training diverge.
+    """
+
+    is_linear = False
+
+    # AdaGrad step of a factor coordinate is
+    # ALPHA_V * g / (1 + sqrt(sum of its squared gradients)).
+    ALPHA_V = 0.05
+
+    def __init__(self, k=4, lambda_v=1e-4, init_std=0.01, seed=0, counter_store=DictCounterStore,
+                 count_threshold=None, alpha=None, beta=None, alpha_v=None, admission_width=None):
+        """
+        Args:
+            k: Dimension of latent factors.
+            lambda_v: L2 regularization strength of factors.
+            init_std: Standard deviation of initial factors.
+            seed: Random seed of initial factors.
+            alpha_v: Overrides ALPHA_V.
+            Other arguments are those of OnlineLogisticRegression.
+        """
+        super().__init__(counter_store, count_threshold, alpha, beta, admission_width)
+        self.k = k
+        self.lambda_v = lambda_v
+        self.init_std = init_std
+        self.seed = seed
+        self.alpha_v = self.ALPHA_V if alpha_v is None else alpha_v
+
+        self.feature_index = None
+        self.coef = None
+        self.factors = None
+        self._factor_gradients = None
+
+    @property
+    def n_weights(self):
+        return len(self.feature_index)
+
+    @property
+    def weights_flat(self):
+        weights = [(field, index, self.coef[column])
+                   for column, (field, index) in enumerate(self.feature_index.features)]
+
+        weights = sorted(weights, key=lambda x: abs(x[2]))
+
+        return weights
+
+    def get_weight(self, field, index):
+        column = self.feature_index.get(field, index)
+        if column is None:
+            return 0
+        return self.coef[column]
+
+    def _init_weights(self):
+        self._random = np.random.RandomState(self.seed)
+        self._n_initialized = 0
+
+        self.feature_index = FeatureIndex()
+        self.coef = np.zeros(1024, dtype=np.float64)
+        self._counters = np.zeros(1024, dtype=np.float64)
+        self.factors = np.zeros((1024, self.k), dtype=np.float64)
+        self._factor_gradients = np.zeros_like(self.factors)
+        self._init_admission()
+
+    def _is_allocated(self, field, index):
+        return (field, index) in self.feature_index
+
+    def _allocate(self, x):
+        """Map a row to column numbers and values, allocating new features."""
+        columns = np.array([self.feature_index.add(field, index) for (field, index, _) in x], dtype=np.int64)
+        values = np.array([value for (_, _, value) in x], dtype=np.float64)
+
+        n_features = len(self.feature_index)
+        if n_features > self._n_initialized:
+            self.coef = utils.grow(self.coef, n_features)
+            self._counters = utils.grow(self._counters, n_features)
+            self.factors = utils.grow(self.factors, n_features)
+            self._factor_gradients = utils.grow(self._factor_gradients, n_features)
+            self._init_factors(self._n_initialized, n_features)
+            self._n_initialized = n_features
+
+        return columns, values
+
+    def _init_factors(self, start, stop):
+        shape = (stop - start,) + self.factors.shape[1:]
+        self.factors[start:stop] = self._random.normal(scale=self.init_std, size=shape)
+
+    def _lookup(self, x):
+        """Map a row to column numbers and values skipping unknown features."""
+        columns = []
+        values = []
+
+        for (field, index, value) in x:
+            column = self.feature_index.get(field, index)
+            if column is not None:
+                columns.append(column)
+                values.append(value)
+
+        return np.array(columns, dtype=np.int64), np.array(values, dtype=np.float64)
+
+    def _margin(self, columns, values):
+        """
+        Compute the raw score.
+
+        Returns:
+            (z, s) pair where s = sum_i v_i * x_i is reused by the update.
+        """
+        vx = self.factors[columns] * values[:, np.newaxis]
+        s = vx.sum(axis=0)
+        pairwise = 0.5 * (np.dot(s, s) - np.sum(vx * vx))
+        z = np.dot(self.coef[columns], values) + pairwise
+        return z, s
+
+    def _update(self, x, y):
+        x = self._admit(x)
+        columns, values = self._allocate(x)
+
+        z, s = self._margin(columns, values)
+        y_hat = utils.sigmoid(z)
+        error = y_hat - y
+        self._lap('predict')
+
+        repeated = _has_repeats(columns)
+        self._update_linear(x, columns, values, error, repeated)
+
+        v = self.factors[columns]
+        grad_v = error * values[:, np.newaxis] * (s - v * values[:, np.newaxis]) + self.lambda_v * v
+        self._update_factors(columns, grad_v, repeated)
+
+        return y_hat
+
+    def _update_linear(self, x, columns, values, error, repeated):
+        """Step of linear weights like in OnlineLogisticRegression, see _add_at for repeated."""
+        alpha = self.alpha / (self.beta + np.sqrt(self._counters[columns]))
+
+        grad = error * values
+
+        if self.lambda1 or self.lambda2:
+            w = self.coef[columns]
+            grad += self.lambda1 * np.sign(w)
+            grad += self.lambda2 * w * np.array([field != 'intercept' for (field, _, _) in x])
+
+        _add_at(self.coef, columns, -alpha * grad, repeated)
+        _add_at(self._counters, columns, 1, repeated)
+
+    def _update_factors(self, cells, grad, repeated):
+        """AdaGrad step of factors at cells, an index of self.factors, see _add_at for repeated."""
+        if repeated:
+            np.add.at(self._factor_gradients, cells, grad ** 2)
+            np.add.at(self.factors, cells, -self.alpha_v * grad / (1 + np.sqrt(self._factor_gradients[cells])))
+        else:
+            factor_gradients = self._factor_gradients[cells] + grad ** 2
+            self._factor_gradients[cells] = factor_gradients
+            self.factors[cells] -= self.alpha_v * grad / (1 + np.sqrt(factor_gradients))
+
+    def predict(self, x):
+        columns, values = self._lookup(x)
+        z, _ = self._margin(columns, values)
+        return utils.sigmoid(z + self.margin_offset)
+
+    def predict_batch(self, X):
+        return utils.sigmoid(self.margin_batch(X))
+
+    def margin_batch(self, X):
+        if not scipy.sparse.issparse(X):
+            X = self.feature_index.transform(X)
+
+        # Weights are allocated ahead of the feature index.
+        n_columns = len(self.feature_index)
+        coef = self.coef[:n_columns]
+        factors = self.factors[:n_columns]
+
+        s = X.dot(factors)
+        squares = X.multiply(X).dot(factors ** 2)
+        z = X.dot(coef) + 0.5 * np.sum(s ** 2 - squares, axis=1)
+
+        return z + self.margin_offset
+
+
+class FieldAwareFactorizationMachine(FactorizationMachine):
+    """
+    Online field-aware factorization machine.
+
+    Every feature keeps a separate latent vector per field it interacts with.
+    The pairwise term costs O(n^2 * k) per row and is evaluated
+    with dense NumPy operations over the row's features.
+    """
+
+    def __init__(self, k=4, lambda_v=1e-4, init_std=0.01, seed=0, counter_store=DictCounterStore,
+                 count_threshold=None, alpha=None, beta=None, alpha_v=None, admission_width=None):
+        super().__init__(k=k, lambda_v=lambda_v, init_std=init_std, seed=seed, counter_store=counter_store,
+                         count_threshold=count_threshold, alpha=alpha, beta=beta, alpha_v=alpha_v,
+                         admission_width=admission_width)
+        self.field_ids = None
+
+    def _init_weights(self):
+        super()._init_weights()
+        self.field_ids = {}
+        self.factors = np.zeros((1024, 8, self.k), dtype=np.float64)
+        self._factor_gradients = np.zeros_like(self.factors)
+
+    def _get_fields(self, x):
+        """Field number of every feature in a row, registering new fields."""
+        fields = []
+
+        for (field, _, _) in x:
+            field_id = self.field_ids.get(field, None)
+            if field_id is None:
+                field_id = len(self.field_ids)
+                self.field_ids[field] = field_id
+            fields.append(field_id)
+
+        n_fields = len(self.field_ids)
+        if n_fields > self.factors.shape[1]:
+            n_old = self.factors.shape[1]
+            factors = np.zeros((self.factors.shape[0], max(n_fields, 2 * n_old), self.k), dtype=np.float64)
+            factors[:, :n_old] = self.factors
+            factors[:self._n_initialized, n_old:] = self._random.normal(
+                scale=self.init_std, size=(self._n_initialized, factors.shape[1] - n_old, self.k))
+            self.factors = factors
+            factor_gradients = np.zeros_like(factors)
+            factor_gradients[:, :n_old] = self._factor_gradients
+            self._factor_gradients = factor_gradients
+
+        return np.array(fields, dtype=np.int64)
+
+    def _margin(self, columns, values, fields):
+        """
+        Compute the raw score.
+
+        Returns:
+            (z, v, xx) where v[i, j] is the factor of feature i towards
+            the field of feature j and xx holds pairwise value products.
+        """
+        v = self.factors[columns[:, np.newaxis], fields[np.newaxis, :]]
+        xx = np.triu(np.outer(values, values), 1)
+        pairwise = np.sum(np.einsum('ijk,jik->ij', v, v) * xx)
+        z = np.dot(self.coef[columns], values) + pairwise
+        return z, v, xx
+
+    def _update(self, x, y):
+        x = self._admit(x)
+        columns, values = self._allocate(x)
+        fields = self._get_fields(x)
+
+        z, v, xx = self._margin(columns, values, fields)
+        y_hat = utils.sigmoid(z)
+        error = y_hat - y
+        self._lap('predict')
+
+        repeated = _has_repeats(columns)
+        self._update_linear(x, columns, values, error, repeated)
+
+        # d(v[i, j] . v[j, i]) / d(v[i, j]) = v[j, i], the diagonal of xx is zero.
+        xx = xx + xx.T
+        pair_grad = error * xx[:, :, np.newaxis] * v.transpose(1, 0, 2)
+
+        # Features of one field share the factor towards it, their gradients add up.
+        row_fields, positions = np.unique(fields, return_inverse=True)
+        in_field = np.zeros((len(fields), len(row_fields)), dtype=np.float64)
+        in_field[np.arange(len(fields)), positions] = 1
+        grad_v = np.matmul(pair_grad.transpose(0, 2, 1), in_field).transpose(0, 2, 1)
+
+        # Only factors towards fields of other features of the row take a step.
+        cells = (columns[:, np.newaxis], row_fields[np.newaxis, :])
+        has_pair = (in_field.sum(axis=0) - in_field) > 0
+        grad_v = (grad_v + self.lambda_v * self.factors[cells]) * has_pair[:, :, np.newaxis]
+        self._update_factors(cells, grad_v, repeated)
+
+        return y_hat
+
+    def predict(self, x):
+        known = [(field, index, value) for (field, index, value) in x
+                 if field in self.field_ids and self.feature_index.get(field, index) is not None]
+        columns, values = self._lookup(known)
+        fields = np.array([self.field_ids[field] for (field, _, _) in known], dtype=np.int64)
+        z, _, _ = self._margin(columns, values, fields)
+        return utils.sigmoid(z + self.margin_offset)
+
+    def predict_batch(self, X):
+        """Predict rows one by one; the pairwise term is not expressible as a mat-vec."""
+        if scipy.sparse.issparse(X):
+            X = self._decode(X.tocsr())
+        return np.array([self.predict(x) for x in X], dtype=np.float64)
+
+    def _decode(self, X):
+        """Rows of (field, index, value) triplets of a CSR matrix numbered by the feature index."""
+        features = self.feature_index.features
+        return [[features[column] + (value,) for column, value in
+                 zip(X.indices[X.indptr[i]:X.indptr[i + 1]], X.data[X.indptr[i]:X.indptr[i + 1]])]
+                for i in range(X.shape[0])]
+
+    def margin_batch(self, X):
+        p = self.predict_batch(X)
+        return np.log(p) - np.log1p(-p)
@@ -1,8 +1,6 @@
 import datetime
 import logging
-
-import sqlalchemy as sa
-import sqlalchemy.orm  # noqa
+import os
 
 
 DATA = {
@@ -38,13 +36,94 @@ DATA = {
         'price_percentile',
         'hist_ctr_percentile',
     },
+
+    # Features shared by all ads shown in a search.
+    'SEARCH_FIELDS': {
+        'intercept',
+        'hour',
+        'user_id',
+        'user_agent_id',
+        'user_agent_family_id',
+        'user_agent_osid',
+        'user_device_id',
+        'user_n_visits_scaled',
+        'user_n_phone_requests_scaled',
+        'user_ctr_scaled',
+        'user_ctr_root_scaled',
+        'user_ctr_pow2_scaled',
+        'user_ctr_pow3_scaled',
+        'new_user',
+        'loc_level',
+        'region_id',
+        'city_id',
+        'search_cat_id',
+        'search_cat_level',
+    },
+
+    # Raw dataset columns shared by all ads shown in a search.
+    'SEARCH_COLUMNS': {
+        'intercept',
+        'hour',
+        'search_date',
+        'search_cat_id',
+        'search_cat_level',
+        'user_id',
+        'user_agent_id',
+        'user_agent_family_id',
+        'user_agent_osid',
+        'user_device_id',
+        'user_n_impressions',
+        'user_n_clicks',
+        'user_n_visits',
+        'user_n_phone_requests',
+        'loc_level',
+        'region_id',
+        'city_id',
+    },
 }
 
-engine = sa.create_engine('postgresql://postgres@localhost:5432/avito')
-Session = sa.orm.sessionmaker(bind=engine)
-session = Session()
+# Database and logging are set up on first use rather than on import,
+# so that scoring doesn't need SQLAlchemy or a reachable database.
+DATABASE_URL_ENV = 'AVITO_DATABASE_URL'
+DEFAULT_DATABASE_URL = 'postgresql://postgres@localhost:5432/avito'
+
+LOG_LEVEL_ENV = 'AVITO_LOG_LEVEL'
+
+_db = {}
+
+
+def get_engine():
+    """SQLAlchemy engine of $AVITO_DATABASE_URL, created on the first call."""
+    if 'engine' not in _db:
+        import sqlalchemy as sa
+        _db['engine'] = sa.create_engine(os.environ.get(DATABASE_URL_ENV, DEFAULT_DATABASE_URL))
+    return _db['engine']
+
+
+def get_session():
+    """A session shared by the process, created on the first call."""
+    if 'session' not in _db:
+        import sqlalchemy.orm
+        _db['session'] = sqlalchemy.orm.sessionmaker(bind=get_engine())()
+    return _db['session']
+
+
+def __getattr__(name):
+    # Old code reads globals.engine and globals.session.
+    if name == 'engine':
+        return get_engine()
+    if name == 'session':
+        return get_session()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
+def configure_logging(level=None):
+    """
+    Log to stderr at level, $AVITO_LOG_LEVEL or INFO.
 
-root_logger = logging.getLogger()
-root_logger.addHandler(logging.StreamHandler())
-root_logger.setLevel(logging.INFO)
+    Called by scripts, the library itself leaves logging alone.
+    """
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        root_logger.addHandler(logging.StreamHandler())
+    root_logger.setLevel(level or os.environ.get(LOG_LEVEL_ENV, 'INFO'))
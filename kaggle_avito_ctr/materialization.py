@@ -0,0 +1,237 @@
+import datetime
+import logging
+
+import sqlalchemy as sa
+
+from .globals import DATA, get_engine
+from .models import (AdInfo, CounterWatermark, DailyAdCounters, DailyUserCounters,
+                     SearchInfo, TrainSearchStream, UserInfo)
+
+
+_logger = logging.getLogger(__name__)
+
+WATERMARK_NAME = 'search_stream'
+
+_DAY = datetime.timedelta(days=1)
+
+
+def _day_start(date):
+    return datetime.datetime.combine(date.date(), datetime.time())
+
+
+def counter_start_date():
+    """DATA['COUNTER_START_DATE'] as a datetime."""
+    return datetime.datetime.fromtimestamp(DATA['COUNTER_START_DATE'])
+
+
+class CounterMaterializer(object):
+    """
+    Incremental maintenance of ad and user history counters.
+
+    Contextual impressions and clicks of the train search stream are
+    aggregated a day at a time into daily counter tables and the totals
+    of the day are added to ads_info.n_impressions/n_clicks and
+    user_info.n_context_impressions/n_context_clicks.
+
+    A watermark keeps the end of the last aggregated day, so a refresh
+    only scans searches past it. Every day is committed together with
+    the watermark, an interrupted refresh resumes where it stopped.
+    Live counters always cover exactly the searches before the
+    watermark, which makes a snapshot at an earlier date a sum of
+    daily rows instead of a rescan of the search stream.
+
+    Days are assumed to be loaded whole: searches added later for a
+    day already behind the watermark are not counted.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or get_engine()
+
+    def create_tables(self):
+        for model in (CounterWatermark, DailyAdCounters, DailyUserCounters):
+            model.__table__.create(self.engine, checkfirst=True)
+        # Scans of a day of searches need it.
+        for index in SearchInfo.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
+
+    def get_watermark(self, conn):
+        watermarks = CounterWatermark.__table__
+        query = sa.select([watermarks.c.search_date]).where(watermarks.c.name == WATERMARK_NAME)
+        return conn.execute(query).scalar()
+
+    def refresh(self, until=None):
+        """
+        Aggregate whole days of searches from the watermark up to until.
+
+        Args:
+            until: A datetime, rounded down to a day. Defaults to the start
+                of the last day with searches, which may still be loading.
+
+        Returns:
+            The new watermark.
+        """
+
+        self.create_tables()
+
+        with self.engine.connect() as conn:
+            watermark = self.get_watermark(conn)
+
+            if watermark is None:
+                first_search = conn.execute(sa.select([sa.func.min(SearchInfo.search_date)])).scalar()
+                if first_search is None:
+                    _logger.info('No searches to count')
+                    return None
+                watermark = _day_start(first_search)
+                with conn.begin():
+                    self._initialize(conn, watermark)
+
+            if until is None:
+                last_search = conn.execute(
+                    sa.select([sa.func.max(SearchInfo.search_date)])
+                    .where(SearchInfo.search_date >= watermark)
+                ).scalar()
+                until = _day_start(last_search) if last_search is not None else watermark
+            else:
+                until = _day_start(until)
+
+            day = watermark
+            while day < until:
+                with conn.begin():
+                    n_ads, n_users = self._add_day(conn, day)
+                _logger.info('Counted %s: %d ads, %d users', day.date(), n_ads, n_users)
+                day += _DAY
+
+        return max(watermark, until)
+
+    def snapshot(self, as_of=None):
+        """
+        Set live counters to cover searches before as_of only.
+
+        Moving forward is a refresh. Moving back sums up the daily
+        counters and rewinds the watermark, so the following refresh
+        aggregates the days after as_of again.
+
+        Args:
+            as_of: A datetime, rounded down to a day.
+                Defaults to DATA['COUNTER_START_DATE'].
+        """
+
+        as_of = _day_start(as_of or counter_start_date())
+
+        self.create_tables()
+
+        with self.engine.connect() as conn:
+            watermark = self.get_watermark(conn)
+
+        if watermark is None or watermark < as_of:
+            return self.refresh(until=as_of)
+        if watermark == as_of:
+            return as_of
+
+        with self.engine.begin() as conn:
+            self._reset_counters(conn)
+            first_day = conn.execute(sa.select([sa.func.min(DailyAdCounters.day)])).scalar()
+            if first_day is not None:
+                self._apply(conn, first_day, as_of)
+            self._set_watermark(conn, as_of)
+
+        _logger.info('Rewound counters to %s', as_of.date())
+
+        return as_of
+
+    def _initialize(self, conn, watermark):
+        """Drop counters of unknown origin and start counting from scratch."""
+        self._reset_counters(conn)
+        conn.execute(DailyAdCounters.__table__.delete())
+        conn.execute(DailyUserCounters.__table__.delete())
+        conn.execute(CounterWatermark.__table__.insert().values(name=WATERMARK_NAME, search_date=watermark))
+
+    def _reset_counters(self, conn):
+        ads = AdInfo.__table__
+        users = UserInfo.__table__
+
+        conn.execute(ads.update()
+                     .where(sa.or_(ads.c.n_impressions.isnot(None), ads.c.n_clicks.isnot(None)))
+                     .values(n_impressions=None, n_clicks=None))
+        conn.execute(users.update()
+                     .where(sa.or_(users.c.n_context_impressions.isnot(None),
+                                   users.c.n_context_clicks.isnot(None)))
+                     .values(n_context_impressions=None, n_context_clicks=None))
+
+    def _add_day(self, conn, day):
+        """Aggregate searches of a day and add them to live counters."""
+        stream = TrainSearchStream.__table__
+        searches = SearchInfo.__table__
+        daily_ads = DailyAdCounters.__table__
+        daily_users = DailyUserCounters.__table__
+
+        source = stream.join(searches, stream.c.search_id == searches.c.search_id)
+        conditions = [
+            stream.c.object_type == 3,
+            searches.c.search_date >= day,
+            searches.c.search_date < day + _DAY,
+        ]
+        n_impressions = sa.func.count()
+        n_clicks = sa.func.sum(sa.cast(stream.c.is_click, sa.Integer))
+        day_literal = sa.literal(day, type_=sa.DateTime)
+
+        ad_totals = (sa.select([day_literal, stream.c.ad_id, n_impressions, n_clicks])
+                     .select_from(source)
+                     .where(sa.and_(*conditions))
+                     .group_by(stream.c.ad_id))
+        user_totals = (sa.select([day_literal, searches.c.user_id, n_impressions, n_clicks])
+                       .select_from(source)
+                       .where(sa.and_(searches.c.user_id.isnot(None), *conditions))
+                       .group_by(searches.c.user_id))
+
+        # A day behind a rewound watermark is aggregated again.
+        conn.execute(daily_ads.delete().where(daily_ads.c.day == day))
+        conn.execute(daily_users.delete().where(daily_users.c.day == day))
+
+        n_ads = conn.execute(daily_ads.insert().from_select(
+            ['day', 'ad_id', 'n_impressions', 'n_clicks'], ad_totals)).rowcount
+        n_users = conn.execute(daily_users.insert().from_select(
+            ['day', 'user_id', 'n_impressions', 'n_clicks'], user_totals)).rowcount
+
+        self._apply(conn, day, day + _DAY)
+        self._set_watermark(conn, day + _DAY)
+
+        return n_ads, n_users
+
+    def _apply(self, conn, start, end):
+        """Add daily counters of days in [start, end) to live counters."""
+        ads = AdInfo.__table__
+        users = UserInfo.__table__
+        daily_ads = DailyAdCounters.__table__
+        daily_users = DailyUserCounters.__table__
+
+        ad_days = daily_ads.c.day.between(start, end - _DAY)
+        user_days = daily_users.c.day.between(start, end - _DAY)
+
+        def ad_total(column):
+            return sa.select([sa.func.sum(column)]).where(sa.and_(daily_ads.c.ad_id == ads.c.ad_id, ad_days))
+
+        def user_total(column):
+            return sa.select([sa.func.sum(column)]).where(sa.and_(daily_users.c.user_id == users.c.user_id, user_days))
+
+        # Correlated subqueries instead of UPDATE ... FROM, which not every
+        # backend has. Every ad of the stream is in ads_info, users missing
+        # from user_info are left out like in extraction queries.
+        conn.execute(ads.update()
+                     .where(ads.c.ad_id.in_(sa.select([daily_ads.c.ad_id]).where(ad_days)))
+                     .values(n_impressions=(sa.func.coalesce(ads.c.n_impressions, 0) +
+                                            ad_total(daily_ads.c.n_impressions).scalar_subquery()),
+                             n_clicks=(sa.func.coalesce(ads.c.n_clicks, 0) +
+                                       ad_total(daily_ads.c.n_clicks).scalar_subquery())))
+        conn.execute(users.update()
+                     .where(users.c.user_id.in_(sa.select([daily_users.c.user_id]).where(user_days)))
+                     .values(n_context_impressions=(sa.func.coalesce(users.c.n_context_impressions, 0) +
+                                                    user_total(daily_users.c.n_impressions).scalar_subquery()),
+                             n_context_clicks=(sa.func.coalesce(users.c.n_context_clicks, 0) +
+                                               user_total(daily_users.c.n_clicks).scalar_subquery())))
+
+    def _set_watermark(self, conn, search_date):
+        watermarks = CounterWatermark.__table__
+        conn.execute(watermarks.update()
+                     .where(watermarks.c.name == WATERMARK_NAME)
+                     .values(search_date=search_date))
@@ -0,0 +1,151 @@
+import math
+
+import numpy as np
+
+
+# Predictions are clipped away from 0 and 1 so that a single confident
+# mistake costs a bounded loss.
+LOGLOSS_MARGIN = 1e-9
+
+
+def sample_logloss(y_hat, y):
+    """Clipped logloss of a single prediction."""
+    y_hat = max(min(y_hat, 1 - LOGLOSS_MARGIN), LOGLOSS_MARGIN)
+    return -(y * math.log(y_hat) + (1 - y) * math.log(1 - y_hat))
+
+
+def batch_logloss(y_hat, y):
+    """Clipped logloss of every prediction in a batch."""
+    y_hat = np.clip(y_hat, LOGLOSS_MARGIN, 1 - LOGLOSS_MARGIN)
+    return -(y * np.log(y_hat) + (1 - y) * np.log(1 - y_hat))
+
+
+def format_metric(value):
+    """Format a metric for printing, 'n/a' if it's undefined."""
+    return 'n/a' if value is None else '{:.5}'.format(value)
+
+
+class StreamingMetrics(object):
+    """
+    Constant-memory evaluation metrics over batches of predictions.
+
+    Logloss is accumulated exactly. AUC and calibration are computed
+    from a histogram of predictions binned uniformly in log-odds, which
+    resolves the small CTRs of the dataset far better than uniform bins
+    of probability. Accumulators of parallel workers can be merged.
+    """
+
+    # Log-odds range covered by the histogram, predictions outside
+    # of it go to the edge bins.
+    MAX_MARGIN = 12
+
+    def __init__(self, n_bins=10000):
+        self.n_bins = n_bins
+        self.n = 0
+        self.loss = 0.0
+        self.positives = np.zeros(n_bins, dtype=np.int64)
+        self.negatives = np.zeros(n_bins, dtype=np.int64)
+        self.prediction_sums = np.zeros(n_bins, dtype=np.float64)
+
+    def update(self, y_hat, y):
+        """Add a batch of predicted probabilities and 0/1 labels."""
+        y_hat = np.asarray(y_hat, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        self.loss += float(batch_logloss(y_hat, y).sum())
+        self.n += y.shape[0]
+
+        bins = self._bin(np.clip(y_hat, LOGLOSS_MARGIN, 1 - LOGLOSS_MARGIN))
+        self.positives += np.bincount(bins, weights=y, minlength=self.n_bins).astype(np.int64)
+        self.negatives += np.bincount(bins, weights=1 - y, minlength=self.n_bins).astype(np.int64)
+        self.prediction_sums += np.bincount(bins, weights=y_hat, minlength=self.n_bins)
+
+    def merge(self, other):
+        """Add up the state of another accumulator with the same bins."""
+        if other.n_bins != self.n_bins:
+            raise ValueError('Cannot merge metrics with {} and {} bins'.format(self.n_bins, other.n_bins))
+
+        self.n += other.n
+        self.loss += other.loss
+        self.positives += other.positives
+        self.negatives += other.negatives
+        self.prediction_sums += other.prediction_sums
+
+        return self
+
+    def _bin(self, p):
+        z = np.log(p) - np.log1p(-p)
+        bins = ((z + self.MAX_MARGIN) / (2 * self.MAX_MARGIN) * self.n_bins).astype(np.int64)
+        return np.clip(bins, 0, self.n_bins - 1)
+
+    def _bin_edges(self):
+        z = np.linspace(-self.MAX_MARGIN, self.MAX_MARGIN, self.n_bins + 1)
+        return 1 / (1 + np.exp(-z))
+
+    def logloss(self):
+        return self.loss / self.n if self.n else None
+
+    def auc(self):
+        """
+        Area under the ROC curve. Pairs within one bin count as ties,
+        so the error is bounded by the mass of single bins.
+        """
+        n_positives = self.positives.sum()
+        n_negatives = self.negatives.sum()
+
+        if n_positives == 0 or n_negatives == 0:
+            return None
+
+        negatives_below = np.cumsum(self.negatives) - self.negatives
+        correct = (self.positives * negatives_below).sum() + 0.5 * (self.positives * self.negatives).sum()
+
+        return float(correct / (n_positives * n_negatives))
+
+    def calibration(self, n_buckets=10):
+        """
+        Reliability curve over buckets of roughly equal numbers of rows
+        ordered by predicted CTR.
+
+        Returns:
+            A list of dicts with prediction range, number of rows,
+            mean prediction and observed CTR of each bucket.
+        """
+        counts = self.positives + self.negatives
+        if not self.n:
+            return []
+
+        rows_before = np.cumsum(counts) - counts
+        buckets = np.minimum(rows_before * n_buckets // self.n, n_buckets - 1)
+        edges = self._bin_edges()
+
+        curve = []
+
+        for bucket in range(n_buckets):
+            in_bucket = (buckets == bucket) & (counts > 0)
+            if not in_bucket.any():
+                continue
+
+            bins = np.flatnonzero(in_bucket)
+            n_rows = int(counts[in_bucket].sum())
+
+            curve.append({
+                'min_prediction': float(edges[bins[0]]),
+                'max_prediction': float(edges[bins[-1] + 1]),
+                'rows': n_rows,
+                'mean_prediction': float(self.prediction_sums[in_bucket].sum() / n_rows),
+                'ctr': float(self.positives[in_bucket].sum() / n_rows),
+            })
+
+        return curve
+
+    def summary(self, n_buckets=10):
+        n_positives = int(self.positives.sum())
+
+        return {
+            'rows': self.n,
+            'logloss': self.logloss(),
+            'auc': self.auc(),
+            'ctr': n_positives / self.n if self.n else None,
+            'mean_prediction': float(self.prediction_sums.sum() / self.n) if self.n else None,
+            'calibration': self.calibration(n_buckets),
+        }
@@ -29,6 +29,10 @@ class TableNames(object):
     user_info = 'user_info'
     visit = 'visits_stream'
 
+    counter_watermark = 'counter_watermark'
+    daily_ad_counters = 'daily_ad_counters'
+    daily_user_counters = 'daily_user_counters'
+
 
 Base = declarative_base()
 
@@ -59,6 +63,32 @@ class Category(Base):
     subcategory_id = Column(SmallInteger)
 
 
+class CounterWatermark(Base):
+    __tablename__ = TableNames.counter_watermark
+
+    name = Column(String(32), primary_key=True)
+    # Searches before this date are included in counters.
+    search_date = Column(DateTime, nullable=False)
+
+
+class DailyAdCounters(Base):
+    __tablename__ = TableNames.daily_ad_counters
+
+    day = Column(DateTime, primary_key=True)
+    ad_id = Column(Integer, primary_key=True)
+    n_impressions = Column(Integer)
+    n_clicks = Column(Integer)
+
+
+class DailyUserCounters(Base):
+    __tablename__ = TableNames.daily_user_counters
+
+    day = Column(DateTime, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    n_impressions = Column(Integer)
+    n_clicks = Column(Integer)
+
+
 class Location(Base):
     __tablename__ = TableNames.location
 
@@ -84,7 +114,7 @@ class SearchInfo(Base):
     __tablename__ = TableNames.search_info
 
     search_id = Column(Integer, primary_key=True)
-    search_date = Column(DateTime)
+    search_date = Column(DateTime, index=True)
     ip_id = Column(Integer)
     user_id = Column(Integer, ForeignKey('{}.user_id'.format(TableNames.user_info)))
     is_user_logged_on = Column(BIT)
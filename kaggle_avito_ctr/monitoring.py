@@ -0,0 +1,180 @@
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+
+from . import utils
+from .metrics import batch_logloss, sample_logloss
+
+
+class StageTimer(object):
+    """Lap timer accumulating wall time per training stage."""
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.n_samples = 0
+        self._last = None
+
+    def start(self, n_rows=1):
+        self.n_samples += n_rows
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.totals[stage] += now - self._last
+        self._last = now
+
+    def reset(self):
+        self.totals.clear()
+        self.n_samples = 0
+
+
+class ProgressiveValidation(object):
+    """
+    Progressive validation logloss of a fit.
+
+    Each row is scored before the model learns from it, so the mean
+    loss over a pass is an honest held-out estimate and no separate
+    evaluation pass is needed. The loss of the final `last_n` rows
+    tracks the quality of the trained model more closely.
+    """
+
+    def __init__(self, last_n=None):
+        self.last_n = last_n
+        self.loss = 0
+        self.n = 0
+        self._last_losses = np.zeros(last_n, dtype=np.float64) if last_n else None
+
+    def observe(self, y_hat, y):
+        loss = sample_logloss(y_hat, y)
+        self.loss += loss
+        if self._last_losses is not None:
+            self._last_losses[self.n % self.last_n] = loss
+        self.n += 1
+
+    def observe_batch(self, y_hat, y):
+        loss = batch_logloss(y_hat, y)
+        self.loss += float(loss.sum())
+        if self._last_losses is not None:
+            tail = loss[-self.last_n:]
+            positions = (self.n + loss.shape[0] - tail.shape[0] + np.arange(tail.shape[0])) % self.last_n
+            self._last_losses[positions] = tail
+        self.n += loss.shape[0]
+
+    def result(self):
+        """
+        Returns:
+            A dict with the number of rows, overall logloss and,
+            if last_n is set, logloss of the final last_n rows.
+        """
+        result = {
+            'rows': self.n,
+            'logloss': float(self.loss / self.n) if self.n else None,
+        }
+
+        if self._last_losses is not None:
+            n_last = min(self.n, self.last_n)
+            result['last_rows'] = n_last
+            result['last_logloss'] = float(self._last_losses[:n_last].sum() / n_last) if n_last else None
+
+        return result
+
+
+class TrainingMonitor(object):
+    """
+    Metrics hook for learners' fit loops.
+
+    Every `every_n_rows` rows writes a JSON line with throughput,
+    progressive validation logloss (each row is scored before the model
+    learns from it), the number of live weights and process RSS.
+    Stage timings are measured on a `timing_rate` fraction of rows.
+    """
+
+    def __init__(self, stream=None, every_n_rows=100000, window=10, timing_rate=0.01):
+        """
+        Args:
+            stream: A file object for JSON lines. Defaults to stdout.
+            every_n_rows: Reporting cadence.
+            window: Number of reporting intervals in the rolling logloss.
+            timing_rate: Fraction of rows to time stages on.
+        """
+        self.stream = stream if stream is not None else sys.stdout
+        self.every_n_rows = every_n_rows
+        self.timing_every = max(int(round(1 / timing_rate)), 1) if timing_rate else None
+
+        self.timer = StageTimer()
+
+        self._loss = 0
+        self._n = 0
+        self._interval_loss = 0
+        self._interval_n = 0
+        self._window = collections.deque(maxlen=window)
+
+        self._start_time = None
+        self._last_time = None
+        self._last_rows = 0
+
+    def start(self, model):
+        self._start_time = self._last_time = time.time()
+        self._last_rows = model.n_rows
+
+    def get_timer(self, n_rows):
+        """Timer for a sampled row, otherwise None."""
+        if self.timing_every is not None and n_rows % self.timing_every == 0:
+            return self.timer
+        return None
+
+    def observe(self, y_hat, y):
+        loss = sample_logloss(y_hat, y)
+        self._interval_loss += loss
+        self._interval_n += 1
+
+    def observe_batch(self, y_hat, y):
+        loss = batch_logloss(y_hat, y)
+        self._interval_loss += float(loss.sum())
+        self._interval_n += loss.shape[0]
+
+    def maybe_report(self, model):
+        if model.n_rows - self._last_rows >= self.every_n_rows:
+            self.report(model)
+
+    def report(self, model):
+        now = time.time()
+
+        self._loss += self._interval_loss
+        self._n += self._interval_n
+        self._window.append((self._interval_loss, self._interval_n))
+
+        window_loss = sum(loss for loss, _ in self._window)
+        window_n = sum(n for _, n in self._window)
+
+        record = {
+            'time': now,
+            'elapsed': now - self._start_time,
+            'rows': model.n_rows,
+            'rows_per_sec': (model.n_rows - self._last_rows) / max(now - self._last_time, 1e-9),
+            'logloss': self._loss / self._n if self._n else None,
+            'window_logloss': window_loss / window_n if window_n else None,
+            'n_weights': model.n_weights,
+            'rss_bytes': utils.current_rss(),
+        }
+
+        if self.timer.n_samples:
+            record['stage_seconds_per_row'] = {
+                stage: total / self.timer.n_samples for stage, total in self.timer.totals.items()
+            }
+            self.timer.reset()
+
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+        self._interval_loss = 0
+        self._interval_n = 0
+        self._last_time = now
+        self._last_rows = model.n_rows
+
+    def finish(self, model):
+        if model.n_rows != self._last_rows:
+            self.report(model)
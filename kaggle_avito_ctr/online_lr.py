@@ -1,9 +1,15 @@
 import collections
 import math
 
+import numpy as np
+import scipy.sparse
 from pybloom import BloomFilter
 from scipy.special import expit as sigmoid
 
+from . import utils
+from .counters import CountMinCounterStore, DictCounterStore
+from .sparse import FeatureIndex
+
 
 class OnlineLogisticRegression(object):
 
@@ -11,7 +17,41 @@ class OnlineLogisticRegression(object):
     # used with a nonzero weight.
     COUNT_THRESHOLD = -1
 
-    def __init__(self):
+    # Width of the count-min sketch of features that haven't reached
+    # COUNT_THRESHOLD yet. It takes 16 bytes per column.
+    ADMISSION_WIDTH = 2 ** 20
+
+    # Per-feature learning rate is ALPHA / (BETA + sqrt(n)),
+    # n being the number of updates of the feature's weight.
+    ALPHA = 1
+    BETA = 10
+
+    # Regularization strengths, set by fit.
+    lambda1 = 0
+    lambda2 = 0
+
+    # Fraction of negative rows the model is trained on, set by fit.
+    negative_rate = 1
+
+    # Whether the score is a sum of per-feature contributions.
+    is_linear = True
+
+    def __init__(self, counter_store=DictCounterStore, count_threshold=None, alpha=None, beta=None,
+                 admission_width=None):
+        """
+        Args:
+            counter_store: A factory of counter stores for online CTR features.
+            count_threshold: Overrides COUNT_THRESHOLD.
+            alpha: Overrides ALPHA.
+            beta: Overrides BETA.
+            admission_width: Overrides ADMISSION_WIDTH.
+        """
+        self.counter_store = counter_store
+        self.count_threshold = self.COUNT_THRESHOLD if count_threshold is None else count_threshold
+        self.admission_width = self.ADMISSION_WIDTH if admission_width is None else admission_width
+        self.alpha = self.ALPHA if alpha is None else alpha
+        self.beta = self.BETA if beta is None else beta
+        self._occurrences = None
         self.weights = None
         self._counters = None
         self._clicks = None
@@ -20,6 +60,39 @@ class OnlineLogisticRegression(object):
         self._ad_click_counts = None
         self._user_impression_counts = None
         self._user_click_counts = None
+        self._scoring_weights = None
+        self._timer = None
+        self.n_rows = 0
+
+    def __getstate__(self):
+        # The admission sketch is only needed to continue training
+        # and is much larger than the weights. Checkpoints keep it
+        # separately, see get_training_state.
+        state = self.__dict__.copy()
+        state['_occurrences'] = None
+        return state
+
+    def get_training_state(self):
+        """State that is needed to continue training but isn't pickled with the model."""
+        return {'occurrences': self._occurrences}
+
+    def set_training_state(self, state):
+        self._occurrences = state['occurrences']
+
+    @property
+    def n_weights(self):
+        return sum(len(subweights) for subweights in self.weights.values())
+
+    @property
+    def margin_offset(self):
+        """
+        Log-odds correction of negative downsampling.
+
+        A model trained on all positives and a fraction r of negatives
+        overestimates the odds of a click r times: p / (p + (1 - p) / r)
+        is sigmoid(z + log(r)). Predictions include it, training doesn't.
+        """
+        return math.log(self.negative_rate)
 
     @property
     def weights_flat(self):
@@ -34,52 +107,192 @@ class OnlineLogisticRegression(object):
         return weights
 
     def get_weight(self, field, index):
-        weight = self.weights[field][index]
+        weight = self.weights.get(field, {}).get(index, 0)
         return weight
 
-    def fit(self, data, lambda1=0, lambda2=0):
+    def fit(self, data, lambda1=0, lambda2=0, checkpointer=None, resume=False, monitor=None, validation=None,
+            negative_rate=None):
+        """
+        Train the model on a stream of (x, y) pairs.
+
+        Args:
+            data: An iterable of (x, y) pairs.
+            lambda1: L1 regularization strength.
+            lambda2: L2 regularization strength, not applied to the intercept.
+            checkpointer: An optional Checkpointer to periodically save the model.
+            resume: Continue training a checkpointed model. data must
+                start at row self.n_rows of the original stream, see
+                checkpoint.resume_iterator.
+            monitor: An optional TrainingMonitor.
+            validation: An optional ProgressiveValidation.
+            negative_rate: Fraction of negative rows kept in data, e.g. by
+                Dataset.iterator(negative_rate=...). Predictions are
+                corrected for it, see margin_offset. The monitor and
+                progressive validation see uncorrected predictions of
+                the downsampled stream. Defaults to 1, or to the rate
+                the model was trained at when resuming.
+
+        Returns:
+            validation.result() if validation is given.
+        """
+
+        if not resume:
+            self._init_weights()
+            self._init_online_features()
+            self.n_rows = 0
+
+        self.lambda1 = lambda1
+        self.lambda2 = lambda2
+        self._set_negative_rate(negative_rate, resume)
+
+        # Weights are about to change.
+        self._scoring_weights = None
+
+        if monitor is not None:
+            monitor.start(self)
+
+        for x, y in data:
+            if monitor is not None:
+                self._timer = monitor.get_timer(self.n_rows)
+                if self._timer is not None:
+                    self._timer.start()
 
-        self.weights = collections.defaultdict(self._weights_template)
-        self._counters = collections.defaultdict(self._counters_template)
+            self._process_online_features(x, y)
+            self._lap('online_features')
 
-        self._clicks = BloomFilter(capacity=5000000)
-        self._not_clicks = BloomFilter(capacity=200000000)
+            y_hat = self._update(x, y)
+            self._lap('update')
 
-        self._ad_impression_counts = collections.defaultdict(int)
-        self._ad_click_counts = collections.defaultdict(int)
-        self._user_impression_counts = collections.defaultdict(int)
-        self._user_click_counts = collections.defaultdict(int)
+            self.n_rows += 1
 
-        for i, (x, y) in enumerate(data, 1):
-            self._process_online_features(x, y)
+            if self.n_rows % 100000 == 0:
+                print('Processed {} rows'.format(self.n_rows), end='\r')
+
+            if monitor is not None:
+                monitor.observe(y_hat, y)
+                monitor.maybe_report(self)
+
+            if validation is not None:
+                validation.observe(y_hat, y)
+
+            if checkpointer is not None:
+                checkpointer.maybe_save(self)
+
+        result = self._finish_fit(checkpointer, monitor, validation)
+
+        print('Processed {} rows'.format(self.n_rows))
+
+        return result
 
-            y_hat = self.predict(x)
-            error = y_hat - y
+    def _set_negative_rate(self, negative_rate, resume):
+        if not resume:
+            self.negative_rate = 1 if negative_rate is None else negative_rate
+        elif negative_rate is not None and negative_rate != self.negative_rate:
+            raise ValueError('The model was trained at negative rate {}, it can\'t resume at {}'
+                             .format(self.negative_rate, negative_rate))
 
-            for (field, index, value) in x:
-                alpha = 1 / (10 + math.sqrt(self._counters[field][index]))
+    def _finish_fit(self, checkpointer, monitor, validation):
+        self._timer = None
 
-                # Logloss gradient.
-                grad = error * value
+        if monitor is not None:
+            monitor.finish(self)
+
+        if checkpointer is not None:
+            checkpointer.wait()
+
+        if validation is not None:
+            return validation.result()
+
+    def _lap(self, stage):
+        """Record time spent in a stage if the current row is being timed."""
+        if self._timer is not None:
+            self._timer.lap(stage)
+
+    def _update(self, x, y):
+        """Make a gradient step on a row. Returns the prediction before the step."""
+        x = self._admit(x)
+
+        y_hat = sigmoid(self._row_margin(x))
+        error = y_hat - y
+        self._lap('predict')
+
+        for (field, index, value) in x:
+            alpha = self.alpha / (self.beta + math.sqrt(self._counters[field][index]))
 
-                # w = self.get_weight(field, index)
+            # Logloss gradient.
+            grad = error * value
 
-                # # L1 regularization.
-                # if w != 0:
-                #     grad += math.copysign(lambda1, w)
+            if self.lambda1 or self.lambda2:
+                w = self.get_weight(field, index)
 
-                # # L2 regularization.
-                # if field != 'intercept':
-                #     grad += lambda2 * w
+                # L1 regularization.
+                if w != 0:
+                    grad += math.copysign(self.lambda1, w)
 
-                self.weights[field][index] -= alpha * grad
+                # L2 regularization.
+                if field != 'intercept':
+                    grad += self.lambda2 * w
 
-                self._counters[field][index] += 1
+            self.weights[field][index] -= alpha * grad
 
-            if i % 100000 == 0:
-                print('Processed {} rows'.format(i), end='\r')
+            self._counters[field][index] += 1
 
-        print('Processed {} rows'.format(i))
+        return y_hat
+
+    def _init_weights(self):
+        self.weights = collections.defaultdict(self._weights_template)
+        self._counters = collections.defaultdict(self._counters_template)
+        self._scoring_weights = None
+        self._init_admission()
+
+    def _init_admission(self):
+        if self.count_threshold > 1:
+            # Occurrences of features that don't have a weight yet.
+            self._occurrences = CountMinCounterStore(width=self.admission_width, depth=4)
+        else:
+            self._occurrences = None
+
+    def _is_allocated(self, field, index):
+        return index in self.weights.get(field, ())
+
+    def _admit(self, x):
+        """
+        Drop features seen fewer than count_threshold times.
+
+        Occurrences of not yet admitted features are counted
+        in a count-min sketch, so the long tail costs no weights.
+        """
+        if not self._start_admission():
+            return x
+
+        admitted = []
+
+        for (field, index, value) in x:
+            if not self._is_allocated(field, index):
+                key = utils.stable_hash(field, index)
+                self._occurrences.increment(key)
+                if self._occurrences.get(key) < self.count_threshold:
+                    continue
+            admitted.append((field, index, value))
+
+        return admitted
+
+    def _start_admission(self):
+        """Whether features need admission, creating the sketch if it was dropped on pickling."""
+        if self.count_threshold <= 1:
+            return False
+        if self._occurrences is None:
+            self._init_admission()
+        return True
+
+    def _init_online_features(self):
+        self._clicks = BloomFilter(capacity=5000000)
+        self._not_clicks = BloomFilter(capacity=200000000)
+
+        self._ad_impression_counts = self.counter_store()
+        self._ad_click_counts = self.counter_store()
+        self._user_impression_counts = self.counter_store()
+        self._user_click_counts = self.counter_store()
 
     def _counters_template(self):
         return collections.defaultdict(int)
@@ -118,30 +331,266 @@ class OnlineLogisticRegression(object):
         elif y == 0:
             self._not_clicks.add(combination)
 
-        n_ad_impressions = self._ad_impression_counts[ad_id]
-        n_ad_clicks = self._ad_click_counts[ad_id]
+        n_ad_impressions = self._ad_impression_counts.get(ad_id)
+        n_ad_clicks = self._ad_click_counts.get(ad_id)
         ad_online_ctr = n_ad_clicks / (10 + n_ad_impressions)
 
-        n_user_impressions = self._user_impression_counts[user_id]
-        n_user_clicks = self._user_click_counts[user_id]
+        n_user_impressions = self._user_impression_counts.get(user_id)
+        n_user_clicks = self._user_click_counts.get(user_id)
         user_online_ctr = n_user_clicks / (10 + n_user_impressions)
 
         x.append(('user_online_ctr', 0, user_online_ctr))
         x.append(('ad_online_ctr', 0, ad_online_ctr))
 
-        self._ad_impression_counts[ad_id] += 1
-        self._user_impression_counts[user_id] += 1
+        self._ad_impression_counts.increment(ad_id)
+        self._user_impression_counts.increment(user_id)
         if y == 1:
-            self._ad_click_counts[ad_id] += 1
-            self._user_click_counts[user_id] += 1
+            self._ad_click_counts.increment(ad_id)
+            self._user_click_counts.increment(user_id)
 
     def predict(self, x):
+        p = sigmoid(self._row_margin(x) + self.margin_offset)
+
+        return p
+
+    def _row_margin(self, x):
+        """Score of a row before the margin_offset correction."""
         z = 0
 
         for (field, index, value) in x:
             w = self.get_weight(field, index)
             z += w * value
 
-        p = sigmoid(z)
+        return z
 
-        return p
+    def predict_batch(self, X):
+        """
+        Predict click probabilities for many rows at once.
+
+        Args:
+            X: A list of rows or a CSR matrix with columns
+               numbered by the model's feature index.
+
+        Returns:
+            numpy.ndarray of probabilities.
+        """
+        return utils.sigmoid(self.margin_batch(X))
+
+    def margin_batch(self, X):
+        """Raw scores (log-odds) of many rows, see predict_batch."""
+        feature_index, coef = self._get_scoring_weights()
+
+        if not scipy.sparse.issparse(X):
+            X = feature_index.transform(X)
+
+        return X.dot(coef) + self.margin_offset
+
+    def _get_scoring_weights(self):
+        """Weights as a (FeatureIndex, array) pair, built once after fitting."""
+        if self._scoring_weights is None:
+            feature_index = FeatureIndex()
+            coef = []
+            for field, subweights in self.weights.items():
+                for index, value in subweights.items():
+                    feature_index.add(field, index)
+                    coef.append(value)
+            self._scoring_weights = (feature_index, np.array(coef, dtype=np.float64))
+
+        return self._scoring_weights
+
+
+class MiniBatchLogisticRegression(OnlineLogisticRegression):
+    """
+    Vectorized version of OnlineLogisticRegression.
+
+    Rows are grouped into CSR batches, the whole batch is scored
+    with a single mat-vec and updated with per-coordinate AdaGrad steps.
+    Online features are still produced row by row in time order.
+    Online features dominate the run time, so small batches train
+    about as fast as large ones and make many more updates per row.
+    """
+
+    # Keeps AdaGrad from taking full steps on features seen only a few times.
+    ADAGRAD_DAMPING = 0.003
+
+    def __init__(self, batch_size=100, learning_rate=0.1, counter_store=DictCounterStore, count_threshold=None,
+                 admission_width=None):
+        super().__init__(counter_store, count_threshold, admission_width=admission_width)
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.feature_index = None
+        self.coef = None
+        self._intercept_columns = None
+
+    @property
+    def n_weights(self):
+        return len(self.feature_index)
+
+    @property
+    def weights_flat(self):
+        weights = [(field, index, self.coef[column])
+                   for column, (field, index) in enumerate(self.feature_index.features)]
+
+        weights = sorted(weights, key=lambda x: abs(x[2]))
+
+        return weights
+
+    def get_weight(self, field, index):
+        column = self.feature_index.get(field, index)
+        if column is None:
+            return 0
+        return self.coef[column]
+
+    def fit(self, data, lambda1=0, lambda2=0, checkpointer=None, resume=False, monitor=None, validation=None,
+            negative_rate=None):
+
+        if not resume:
+            self._init_weights()
+            self._init_online_features()
+            self.n_rows = 0
+
+        self.lambda1 = lambda1
+        self.lambda2 = lambda2
+        self._set_negative_rate(negative_rate, resume)
+
+        if monitor is not None:
+            monitor.start(self)
+            self._timer = monitor.timer
+
+        for batch in utils.chunked(data, self.batch_size):
+            if self._timer is not None:
+                self._timer.start(len(batch))
+
+            xs = []
+            ys = np.empty(len(batch), dtype=np.float64)
+
+            for j, (x, y) in enumerate(batch):
+                self._process_online_features(x, y)
+                xs.append(x)
+                ys[j] = y
+
+            xs = self._admit_batch(xs)
+
+            self._lap('online_features')
+
+            y_hat = self._update_batch(xs, ys)
+            self._lap('update')
+
+            if (self.n_rows + len(batch)) // 100000 > self.n_rows // 100000:
+                print('Processed {} rows'.format(self.n_rows + len(batch)), end='\r')
+            self.n_rows += len(batch)
+
+            if monitor is not None:
+                monitor.observe_batch(y_hat, ys)
+                monitor.maybe_report(self)
+
+            if validation is not None:
+                validation.observe_batch(y_hat, ys)
+
+            if checkpointer is not None:
+                checkpointer.maybe_save(self)
+
+        result = self._finish_fit(checkpointer, monitor, validation)
+
+        print('Processed {} rows'.format(self.n_rows))
+
+        return result
+
+    def _init_weights(self):
+        self.feature_index = FeatureIndex()
+        self.coef = np.zeros(1024, dtype=np.float64)
+        self._counters = np.zeros(1024, dtype=np.float64)
+        self._intercept_columns = []
+        self._init_admission()
+
+    def _is_allocated(self, field, index):
+        return (field, index) in self.feature_index
+
+    def _admit_batch(self, xs):
+        """
+        _admit for a batch of rows, with the sketch updated once per batch.
+
+        A feature is admitted from the row where it reaches
+        count_threshold, like when rows are admitted one by one.
+        """
+        if not self._start_admission():
+            return xs
+
+        positions = []
+        keys = []
+        for i, x in enumerate(xs):
+            for j, (field, index, _) in enumerate(x):
+                if not self._is_allocated(field, index):
+                    positions.append((i, j))
+                    keys.append(utils.stable_hash(field, index))
+
+        if not keys:
+            return xs
+
+        unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        seen = self._occurrences.get_many(unique_keys)
+        self._occurrences.increment_many(unique_keys, counts)
+
+        # Number of the occurrence of every key within the batch, starting from 1.
+        order = np.argsort(inverse, kind='stable')
+        occurrence = np.empty(len(keys), dtype=np.int64)
+        occurrence[order] = np.arange(1, len(keys) + 1) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        rejected = collections.defaultdict(set)
+        for (i, j), is_admitted in zip(positions, seen[inverse] + occurrence >= self.count_threshold):
+            if not is_admitted:
+                rejected[i].add(j)
+
+        return [[feature for j, feature in enumerate(x) if j not in rejected[i]] if i in rejected else x
+                for i, x in enumerate(xs)]
+
+    def _update_batch(self, xs, ys):
+        n_known = len(self.feature_index)
+        X = self.feature_index.transform(xs, grow=True)
+
+        for column in range(n_known, len(self.feature_index)):
+            if self.feature_index.features[column][0] == 'intercept':
+                self._intercept_columns.append(column)
+
+        self.coef = utils.grow(self.coef, X.shape[1])
+        self._counters = utils.grow(self._counters, X.shape[1])
+        X.resize((X.shape[0], self.coef.shape[0]))
+
+        y_hat = utils.sigmoid(X.dot(self.coef))
+        error = y_hat - ys
+        self._lap('predict')
+
+        # Gradient averaged over the batch, so that the step size
+        # doesn't depend on batch_size.
+        grad = X.T.dot(error)
+
+        if self.lambda1 or self.lambda2:
+            grad += self._regularization_gradient(X)
+
+        grad /= X.shape[0]
+
+        # AdaGrad step: the per-row 1 / (10 + sqrt(n)) schedule overshoots
+        # when the whole batch is applied at once with stale predictions.
+        self._counters += grad ** 2
+        self.coef -= self.learning_rate * grad / (self.ADAGRAD_DAMPING + np.sqrt(self._counters))
+
+        return y_hat
+
+    def _regularization_gradient(self, X):
+        """
+        L1 and L2 gradient summed over the batch.
+
+        Like in OnlineLogisticRegression a weight is regularized
+        once per row it occurs in, so a batch adds the penalty
+        times the number of its rows with the feature.
+        """
+        l2 = self.lambda2 * self.coef
+        l2[self._intercept_columns] = 0
+
+        n_occurrences = np.bincount(X.indices, minlength=X.shape[1])
+
+        return n_occurrences * (self.lambda1 * np.sign(self.coef) + l2)
+
+    def _get_scoring_weights(self):
+        # coef is allocated ahead of the feature index.
+        return self.feature_index, self.coef[:len(self.feature_index)]
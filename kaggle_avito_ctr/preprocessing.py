@@ -1,13 +1,14 @@
+import json
 import logging
 import math
 import re
 import string
+import time
 
 import numpy as np
-import pymorphy2
 
-from .globals import DATA, session
-from .models import Category
+from . import profiling
+from .globals import DATA, get_session
 
 
 _logger = logging.getLogger(__name__)
@@ -44,10 +45,15 @@ class Preprocessor(object):
     def agents(self):
         return self.agents1 + self.agents2
 
-    def __init__(self):
+    def __init__(self, categories=None):
+        """
+        Args:
+            categories: A {category_id: parent_category_id} snapshot,
+                see CategoryFeatureExtractor.
+        """
         self.ad_ctr_preprocessor = AdCtrPreprocessor()
         self.user_ctr_preprocessor = UserCtrPreprocessor()
-        self.category_feature_extractor = CategoryFeatureExtractor()
+        self.category_feature_extractor = CategoryFeatureExtractor(categories)
         self.price_discretizer = QuantileDiscretizer('price', 20)
         self.hist_ctr_discretizer = QuantileDiscretizer('hist_ctr', 20)
         self.params_id_extractor = ParamsIdExtractor()
@@ -82,14 +88,20 @@ class Preprocessor(object):
         """
 
         fitted_agents = []
+        timer = profiling.current_timer()
 
-        for agents in (self.agents1, self.agents2):
+        for n_pass, agents in enumerate((self.agents1, self.agents2), 1):
             X = X_factory()
+            site = 'Preprocessor.fit{}'.format(n_pass)
 
             for agent in agents:
                 agent.prepare_fit()
 
             for i, row in enumerate(X):
+                if timer is not None and timer.sample(site):
+                    self._timed_fit_row(row, fitted_agents, agents, timer, site)
+                    continue
+
                 for fitted_agent in fitted_agents:
                     row = fitted_agent.transform(row)
 
@@ -97,19 +109,60 @@ class Preprocessor(object):
                     agent.fit_row(row)
 
             for agent in agents:
+                start = time.perf_counter()
                 agent.finish_fit()
+                if timer is not None:
+                    timer.record('{}.{}.finish_fit'.format(site, self._agent_name(agent)),
+                                 time.perf_counter() - start)
 
             fitted_agents.extend(agents)
 
         self.fields_to_remove = {f for agent in self.agents for f in agent.replaced_fields}
 
     def transform(self, row):
+        timer = profiling.current_timer()
+        if timer is not None and timer.sample('Preprocessor.transform'):
+            return self._timed_transform(row, timer)
+
         for agent in self.agents:
             row = agent.transform(row)
         row = [item for item in row if item[0] not in self.fields_to_remove]
         # row = self.poly2_mixer.mix(row)
         return row
 
+    def _agent_name(self, agent):
+        for name, value in vars(self).items():
+            if value is agent:
+                return name
+        return type(agent).__name__
+
+    def _timed_fit_row(self, row, fitted_agents, agents, timer, site):
+        """A step of fit timing each agent, see profiling.SampledTimer."""
+        for agent in fitted_agents:
+            start = time.perf_counter()
+            row = agent.transform(row)
+            timer.add('{}.{}.transform'.format(site, self._agent_name(agent)), time.perf_counter() - start, site)
+
+        for agent in agents:
+            start = time.perf_counter()
+            agent.fit_row(row)
+            timer.add('{}.{}.fit_row'.format(site, self._agent_name(agent)), time.perf_counter() - start, site)
+
+    def _timed_transform(self, row, timer):
+        """transform timing each agent, see profiling.SampledTimer."""
+        site = 'Preprocessor.transform'
+
+        for agent in self.agents:
+            start = time.perf_counter()
+            row = agent.transform(row)
+            timer.add('{}.{}'.format(site, self._agent_name(agent)), time.perf_counter() - start, site)
+
+        start = time.perf_counter()
+        row = [item for item in row if item[0] not in self.fields_to_remove]
+        timer.add(site + '.fields_to_remove', time.perf_counter() - start, site)
+
+        return row
+
 
 class PreprocessorAgent(object):
     """Base class for transformers compatible with Preprocessor."""
@@ -311,19 +364,32 @@ class CategoryFeatureExtractor(PreprocessorAgent):
 
     _fields = ['search_cat_id', 'ad_cat_id']
 
-    def __init__(self):
-        self.categories = {c.category_id: c for c in session.query(Category)}
+    def __init__(self, categories=None):
+        """
+        Args:
+            categories: A {category_id: parent_category_id} snapshot.
+                Loaded from the database if not specified.
+        """
+        if categories is None:
+            from .models import Category
+            categories = {c.category_id: c.parent_category_id for c in get_session().query(Category)}
+        self.categories = categories
+
+    def save_snapshot(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(sorted(self.categories.items()), f)
+
+    def load_snapshot(self, filename):
+        with open(filename) as f:
+            self.categories = dict(json.load(f))
 
     def transform(self, row):
         search_cat_id, ad_cat_id = self._get_fields(row)
 
-        search_cat = self.categories.get(search_cat_id, None)
-        ad_cat = self.categories.get(ad_cat_id, None)
-
-        if search_cat and ad_cat:
-            if search_cat.category_id == ad_cat.category_id:
+        if search_cat_id in self.categories and ad_cat_id in self.categories:
+            if search_cat_id == ad_cat_id:
                 row.append(('search_ad_same_cat', 1))
-            if search_cat.parent_category_id == ad_cat.parent_category_id:
+            if self.categories[search_cat_id] == self.categories[ad_cat_id]:
                 row.append(('search_ad_same_parent_cat', 1))
 
         return row
@@ -331,10 +397,19 @@ class CategoryFeatureExtractor(PreprocessorAgent):
 
 class TextFeatureExtractor(PreprocessorAgent):
 
-    analyzer = pymorphy2.MorphAnalyzer()
+    # Loading dictionaries takes seconds, so it's done on first use.
+    _analyzer = None
     number_pattern = re.compile('\d+')
     punctuation_pattern = re.compile(r'[{}]'.format(string.punctuation))
 
+    @property
+    def analyzer(self):
+        """pymorphy2.MorphAnalyzer shared by all instances."""
+        if TextFeatureExtractor._analyzer is None:
+            import pymorphy2
+            TextFeatureExtractor._analyzer = pymorphy2.MorphAnalyzer()
+        return TextFeatureExtractor._analyzer
+
     def transform(self, row):
         search_query_idx = ad_title_idx = None
         search_query = ad_title = None
@@ -394,6 +469,7 @@ class TextFeatureExtractor(PreprocessorAgent):
 
     def _get_lcs_len_percentage(self, s1, s2):
         """Calculate a proportion of a longest common substring length to the first string length."""
+        import pymorphy2.utils
         lcs = pymorphy2.utils.longest_common_substring([s1, s2])
         return len(lcs) / len(s1) if s1 else 0
 
@@ -0,0 +1,215 @@
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import re
+import time
+
+from . import utils
+
+
+# Timer of the stage being profiled, see current_timer.
+_active = {'timer': None}
+
+
+def current_timer():
+    """SampledTimer of the running profiled stage or None."""
+    return _active['timer']
+
+
+class SampledTimer(object):
+    """
+    Timing of hot per-row code that only times every N-th call.
+
+    Instrumented code asks sample(site) on every call and measures
+    only when it says so, so the overhead of a call that isn't timed
+    is a counter increment. Totals are extrapolated from the mean of
+    the timed calls and the number of all calls of a site.
+    """
+
+    def __init__(self, every_n=100):
+        self.every_n = every_n
+        self.calls = collections.Counter()
+        self.sampled = collections.Counter()
+        self.seconds = collections.Counter()
+        self._sites = {}
+
+    def sample(self, site):
+        """Count a call of site. True if the call is to be timed."""
+        n = self.calls[site] = self.calls[site] + 1
+        return n % self.every_n == 0
+
+    def add(self, name, seconds, site=None):
+        """
+        Add a timed call.
+
+        Args:
+            name: What was timed.
+            seconds: Duration of the call.
+            site: Site whose sample() decided to time the call, name by default.
+                Several names may be timed on one decision.
+        """
+        self.sampled[name] += 1
+        self.seconds[name] += seconds
+        self._sites[name] = site or name
+
+    def record(self, name, seconds):
+        """Add a call that is timed every time, e.g. a once per stage one."""
+        self.calls[name] += 1
+        self.add(name, seconds)
+
+    def result(self):
+        """{name: {calls, sampled_calls, mean_seconds, estimated_seconds}}."""
+        result = {}
+
+        for name, n_sampled in self.sampled.items():
+            n_calls = self.calls[self._sites[name]]
+            mean = self.seconds[name] / n_sampled
+            result[name] = {
+                'calls': n_calls,
+                'sampled_calls': n_sampled,
+                'mean_seconds': mean,
+                'estimated_seconds': mean * n_calls,
+            }
+
+        return result
+
+
+class Stage(object):
+    """Measurements of a running stage. Rows are set directly or counted with count."""
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def count(self, iterable):
+        """Yield items of iterable adding them to rows."""
+        self.rows = self.rows or 0
+        for item in iterable:
+            self.rows += 1
+            yield item
+
+
+class StageProfiler(object):
+    """
+    Wall time, CPU time, throughput and peak memory of named stages.
+
+    Per-row code instrumented with current_timer, such as Preprocessor
+    agents and dataset decoding and encoding, is timed with sampling
+    inside of a stage. Optionally, every stage is also run under
+    cProfile and its stats are dumped to cprofile_dir.
+
+    Peak RSS is reset before a stage where the OS allows, otherwise it
+    is the process peak so far. CPU time includes finished child
+    processes, e.g. preprocessing workers of a streaming run.
+    """
+
+    def __init__(self, sample_every=100, cprofile_dir=None):
+        self.sample_every = sample_every
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        stage = Stage(name, rows)
+        timer = SampledTimer(self.sample_every)
+        previous_timer = _active['timer']
+
+        profile = cProfile.Profile() if self.cprofile_dir else None
+
+        peak_is_reset = utils.reset_peak_rss()
+        rss_before = utils.current_rss()
+        cpu_start = _cpu_time()
+        wall_start = time.perf_counter()
+
+        _active['timer'] = timer
+        if profile is not None:
+            profile.enable()
+
+        try:
+            yield stage
+        finally:
+            if profile is not None:
+                profile.disable()
+            _active['timer'] = previous_timer
+
+            wall = time.perf_counter() - wall_start
+            cpu = _cpu_time() - cpu_start
+
+            record = {
+                'name': name,
+                'rows': stage.rows,
+                'seconds': wall,
+                'cpu_seconds': cpu,
+                'rows_per_sec': stage.rows / wall if stage.rows and wall > 0 else None,
+                'peak_rss_bytes': utils.peak_rss(),
+                'peak_rss_is_stage_peak': peak_is_reset,
+                'rss_growth_bytes': utils.current_rss() - rss_before,
+                'breakdown': timer.result(),
+            }
+
+            if profile is not None:
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                record['cprofile'] = os.path.join(self.cprofile_dir, _safe_filename(name) + '.prof')
+                profile.dump_stats(record['cprofile'])
+
+            self.stages.append(record)
+
+    def report(self):
+        return {
+            'sample_every': self.sample_every,
+            'stages': self.stages,
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def format_table(self):
+        """Stages, each followed by its sampled breakdown, as a text table."""
+        row_format = '{:48} | {:>9} | {:>9} | {:>10} | {:>11} | {:>9}'
+        lines = [
+            row_format.format('stage', 'wall, s', 'cpu, s', 'rows', 'rows/s', 'peak MB'),
+            row_format.format('  timed code', 'est. s', 'of wall', 'calls', 'us/call', ''),
+            '-' * 110,
+        ]
+
+        for record in self.stages:
+            lines.append(row_format.format(
+                record['name'][:48],
+                '{:.2f}'.format(record['seconds']),
+                '{:.2f}'.format(record['cpu_seconds']),
+                record['rows'] if record['rows'] is not None else '-',
+                '{:.0f}'.format(record['rows_per_sec']) if record['rows_per_sec'] else '-',
+                '{:.1f}'.format(record['peak_rss_bytes'] / 2 ** 20)))
+
+            breakdown = sorted(record['breakdown'].items(), key=lambda item: -item[1]['estimated_seconds'])
+            for name, timing in breakdown:
+                share = timing['estimated_seconds'] / record['seconds'] if record['seconds'] else 0
+                lines.append(row_format.format(
+                    '  ' + name[:46],
+                    '{:.2f}'.format(timing['estimated_seconds']),
+                    '{:.1%}'.format(share),
+                    timing['calls'],
+                    '{:.2f}'.format(timing['mean_seconds'] * 1e6),
+                    ''))
+
+        return '\n'.join(lines)
+
+
+def profiled_stage(profiler, name, rows=None):
+    """profiler.stage(name) or a no-op stage if profiler is None."""
+    if profiler is None:
+        return contextlib.nullcontext(Stage(name, rows))
+    return profiler.stage(name, rows)
+
+
+def _cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _safe_filename(name):
+    return re.sub(r'[^\w.-]+', '_', name)
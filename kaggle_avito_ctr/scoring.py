@@ -0,0 +1,465 @@
+import collections
+import json
+import os
+import pickle
+import shutil
+import threading
+
+import numpy as np
+import scipy.sparse
+
+from . import streaming, utils
+from .fast_solution import raw_to_sparse
+from .globals import DATA
+
+
+FORMAT_VERSION = 3
+# Version 1 artifacts are float64 only and are read as such,
+# versions before 3 have no margin offset.
+_SUPPORTED_VERSIONS = (1, 2, 3)
+
+WEIGHT_DTYPES = ('float64', 'float16', 'int8')
+
+_META_FILENAME = 'meta.json'
+_INDICES_FILENAME = 'indices.npy'
+_WEIGHTS_FILENAME = 'weights.npy'
+_SCALES_FILENAME = 'scales.npy'
+
+
+def export_model(model, dst, dtype='float64'):
+    """
+    Write a scoring-only artifact of a fitted linear model.
+
+    The artifact is a directory with a JSON header and two .npy arrays:
+    feature indexes sorted within each field and the matching weights.
+    It is written to a temporary directory first and renamed in place.
+    Indexes are stored as int32 when they fit.
+
+    Weights can be stored as float16 or as int8 with a float64 scale
+    per field (see quantize_weights), dequantized on the fly at scoring.
+    The model's margin_offset, if any, is kept in the header.
+    """
+
+    if not model.is_linear:
+        raise ValueError('Only linear models can be exported, {} is not one'.format(model.__class__.__name__))
+
+    feature_index, coef = model._get_scoring_weights()
+
+    by_field = collections.defaultdict(list)
+    for column, (field, index) in enumerate(feature_index.features):
+        by_field[field].append((index, column))
+
+    fields = sorted(by_field)
+    field_offsets = [0]
+    indices = []
+    columns = []
+
+    for field in fields:
+        for index, column in sorted(by_field[field]):
+            indices.append(index)
+            columns.append(column)
+        field_offsets.append(len(indices))
+
+    weights = np.asarray(coef)[columns].astype(np.float64)
+
+    _write_artifact(dst, model.__class__.__name__, fields, field_offsets,
+                    np.array(indices, dtype=np.int64), weights, dtype, getattr(model, 'margin_offset', 0))
+
+
+def quantize_artifact(src, dst, dtype):
+    """Rewrite an exported artifact with weights stored as dtype."""
+    model = ScoringModel.load(src)
+    _write_artifact(dst, model.model_name, model.fields, model.field_offsets,
+                    np.asarray(model.indices), model.dequantized_weights(), dtype, model.margin_offset)
+
+
+def quantize_weights(weights, field_offsets, dtype):
+    """
+    Quantize float64 weights.
+
+    int8 weights are scaled per field so that the largest absolute
+    weight of the field maps to 127: fields differ in weight magnitude
+    by orders of magnitude and a global scale would zero out small ones.
+
+    Returns:
+        (quantized weights, per-field scales or None)
+    """
+
+    if dtype not in WEIGHT_DTYPES:
+        raise ValueError('Unsupported weight dtype {}'.format(dtype))
+
+    if dtype != 'int8':
+        return weights.astype(dtype), None
+
+    n_fields = len(field_offsets) - 1
+    quantized = np.empty(weights.shape[0], dtype=np.int8)
+    scales = np.ones(n_fields, dtype=np.float64)
+
+    for i in range(n_fields):
+        start, stop = field_offsets[i], field_offsets[i + 1]
+        segment = weights[start:stop]
+        max_abs = np.abs(segment).max() if stop > start else 0
+        if max_abs > 0:
+            scales[i] = max_abs / 127
+        quantized[start:stop] = np.round(segment / scales[i])
+
+    return quantized, scales
+
+
+def _write_artifact(dst, model_name, fields, field_offsets, indices, weights, dtype, margin_offset=0):
+    weights, scales = quantize_weights(weights, field_offsets, dtype)
+
+    int32 = np.iinfo(np.int32)
+    if indices.shape[0] == 0 or (int32.min <= indices.min() and indices.max() <= int32.max):
+        indices = indices.astype(np.int32)
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'model': model_name,
+        'fields': fields,
+        'field_offsets': field_offsets,
+        'weights_dtype': dtype,
+        'margin_offset': margin_offset,
+    }
+
+    tmp_dst = dst + '.tmp'
+    if os.path.exists(tmp_dst):
+        shutil.rmtree(tmp_dst)
+    os.makedirs(tmp_dst)
+
+    np.save(os.path.join(tmp_dst, _INDICES_FILENAME), indices)
+    np.save(os.path.join(tmp_dst, _WEIGHTS_FILENAME), weights)
+    if scales is not None:
+        np.save(os.path.join(tmp_dst, _SCALES_FILENAME), scales)
+    with open(os.path.join(tmp_dst, _META_FILENAME), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.rename(tmp_dst, dst)
+
+
+def is_artifact(path):
+    return os.path.isfile(os.path.join(path, _META_FILENAME))
+
+
+def load_model(filename):
+    """Load an exported artifact or a pickled model."""
+    if is_artifact(filename):
+        return ScoringModel.load(filename)
+
+    with open(filename, 'rb') as f:
+        model = pickle.load(f)
+
+    return model
+
+
+class ScoringModel(object):
+    """
+    Read-only linear model loaded from an exported artifact.
+
+    Arrays are memory-mapped, so loading is cheap and scoring processes
+    share the same pages. Quantized weights are dequantized on the fly.
+    """
+
+    is_linear = True
+
+    def __init__(self, fields, field_offsets, indices, weights, scales=None, model_name=None, margin_offset=0):
+        self.fields = fields
+        self.field_offsets = field_offsets
+        self.indices = indices
+        self.weights = weights
+        self.scales = scales
+        self.model_name = model_name
+        self.margin_offset = margin_offset
+
+        self._field_ranges = {
+            field: (field_offsets[i], field_offsets[i + 1])
+            for i, field in enumerate(fields)
+        }
+        self._field_scales = {
+            field: (1.0 if scales is None else float(scales[i]))
+            for i, field in enumerate(fields)
+        }
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, _META_FILENAME)) as f:
+            meta = json.load(f)
+
+        if meta['format_version'] not in _SUPPORTED_VERSIONS:
+            raise ValueError('Unsupported model artifact version {}'.format(meta['format_version']))
+
+        indices = np.load(os.path.join(path, _INDICES_FILENAME), mmap_mode=mmap_mode)
+        weights = np.load(os.path.join(path, _WEIGHTS_FILENAME), mmap_mode=mmap_mode)
+
+        scales = None
+        if meta.get('weights_dtype', 'float64') == 'int8':
+            scales = np.load(os.path.join(path, _SCALES_FILENAME))
+
+        return cls(meta['fields'], meta['field_offsets'], indices, weights,
+                   scales=scales, model_name=meta.get('model', None), margin_offset=meta.get('margin_offset', 0))
+
+    @property
+    def nbytes(self):
+        """Size of the weight table in bytes."""
+        return self.indices.nbytes + self.weights.nbytes
+
+    def get_weight(self, field, index):
+        column = self._lookup(field, np.array([index], dtype=np.int64))[0]
+        if column < 0:
+            return 0
+        return float(self.weights[column]) * self._field_scales.get(field, 1.0)
+
+    def dequantized_weights(self):
+        """All weights as a float64 array in artifact column order."""
+        weights = np.asarray(self.weights, dtype=np.float64)
+        if self.scales is not None:
+            weights = weights * np.repeat(self.scales, np.diff(self.field_offsets))
+        return weights
+
+    def _lookup(self, field, indices):
+        """Columns of field's indexes, -1 for unknown features."""
+        start, stop = self._field_ranges.get(field, (0, 0))
+        columns = np.full(indices.shape[0], -1, dtype=np.int64)
+
+        if start == stop:
+            return columns
+
+        segment = self.indices[start:stop]
+        positions = np.searchsorted(segment, indices)
+        positions = np.minimum(positions, stop - start - 1)
+        found = segment[positions] == indices
+        columns[found] = start + positions[found]
+
+        return columns
+
+    def predict(self, x):
+        return self.predict_batch([x])[0]
+
+    def predict_batch(self, X):
+        """
+        Predict click probabilities for many rows at once.
+
+        Args:
+            X: A list of rows or a CSR matrix with artifact column numbers.
+
+        Returns:
+            numpy.ndarray of probabilities.
+        """
+
+        return utils.sigmoid(self.margin_batch(X))
+
+    def margin_batch(self, X):
+        """Raw scores (log-odds) of many rows, see predict_batch."""
+        if scipy.sparse.issparse(X):
+            return X.dot(self.dequantized_weights()) + self.margin_offset
+
+        z = np.full(len(X), self.margin_offset, dtype=np.float64)
+
+        for field, (row_ids, indices, values) in self._group_by_field(X).items():
+            columns = self._lookup(field, np.array(indices, dtype=np.int64))
+            known = columns >= 0
+            weights = self.weights[columns[known]].astype(np.float64) * self._field_scales.get(field, 1.0)
+            contributions = weights * np.array(values, dtype=np.float64)[known]
+            np.add.at(z, np.array(row_ids, dtype=np.int64)[known], contributions)
+
+        return z
+
+    def _group_by_field(self, X):
+        groups = collections.defaultdict(lambda: ([], [], []))
+
+        for i, x in enumerate(X):
+            for (field, index, value) in x:
+                row_ids, indices, values = groups[field]
+                row_ids.append(i)
+                indices.append(index)
+                values.append(value)
+
+        return groups
+
+
+class SearchScorer(object):
+    """
+    Scores the candidate ads of a search reusing search-level features.
+
+    All ads of a search share the search context, so with a linear model
+    a row's score is the search-level partial sum plus the ad-level one.
+    The search-level part is computed once per search and optionally
+    kept in a small LRU cache keyed by search id and the search-level
+    features, so a reused id with another context isn't served a stale
+    score. The model's margin_offset goes to the search-level part only.
+    """
+
+    def __init__(self, model, search_fields=None, cache_size=0):
+        if not model.is_linear:
+            raise ValueError('Search-level scoring requires a linear model')
+
+        self.model = model
+        self.margin_offset = getattr(model, 'margin_offset', 0)
+        self.search_fields = set(DATA['SEARCH_FIELDS'] if search_fields is None else search_fields)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def split(self, x):
+        """Split a row into (search-level, ad-level) features."""
+        search_part = []
+        ad_part = []
+
+        for item in x:
+            if item[0] in self.search_fields:
+                search_part.append(item)
+            else:
+                ad_part.append(item)
+
+        return search_part, ad_part
+
+    def score(self, search_id, xs):
+        return self.score_many([(search_id, xs)])[0]
+
+    def score_many(self, searches):
+        """
+        Score candidates of several searches in one batch.
+
+        Args:
+            searches: A list of (search_id, rows) pairs. search_id may be
+                None to disable caching for the search.
+
+        Returns:
+            A list of probability arrays, one per search.
+        """
+
+        search_margins = []
+        missing = []
+        ad_parts = []
+
+        for i, (search_id, xs) in enumerate(searches):
+            search_part = None
+
+            for j, x in enumerate(xs):
+                row_search_part, ad_part = self.split(x)
+                if j == 0:
+                    search_part = row_search_part
+                ad_parts.append(ad_part)
+
+            key = self._cache_key(search_id, search_part)
+            margin = self._cache_get(key)
+            search_margins.append(margin)
+
+            if margin is None and xs:
+                missing.append((i, key, search_part))
+
+        if missing:
+            margins = self.model.margin_batch([search_part for _, _, search_part in missing])
+            for (i, key, _), margin in zip(missing, margins):
+                search_margins[i] = margin
+                self._cache_put(key, margin)
+
+        return self._combine(search_margins, ad_parts, [len(xs) for _, xs in searches])
+
+    def score_split(self, searches):
+        """
+        Score searches that are already split, e.g. by SparseDataset.search_iterator.
+
+        Args:
+            searches: A list of (search-level features, list of
+                ad-level features of every candidate) pairs.
+
+        Returns:
+            A list of probability arrays, one per search.
+        """
+
+        search_margins = self.model.margin_batch([search_part for search_part, _ in searches]) if searches else []
+        ad_parts = [ad_part for _, search_ad_parts in searches for ad_part in search_ad_parts]
+
+        return self._combine(search_margins, ad_parts, [len(search_ad_parts) for _, search_ad_parts in searches])
+
+    def _combine(self, search_margins, ad_parts, n_candidates):
+        """Probabilities of candidates from search margins and ad-level features."""
+        ad_margins = self.model.margin_batch(ad_parts) - self.margin_offset if ad_parts else np.empty(0)
+
+        predictions = []
+        offset = 0
+
+        for search_margin, n in zip(search_margins, n_candidates):
+            z = ad_margins[offset:offset + n] + (search_margin or 0)
+            predictions.append(utils.sigmoid(z))
+            offset += n
+
+        return predictions
+
+    def _cache_key(self, search_id, search_part):
+        if search_id is None or search_part is None:
+            return None
+        return search_id, tuple(search_part)
+
+    def _cache_get(self, key):
+        if key is None:
+            return None
+        with self._cache_lock:
+            margin = self._cache.get(key, None)
+            if margin is not None:
+                self._cache.move_to_end(key)
+        return margin
+
+    def _cache_put(self, key, margin):
+        if key is None or self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = margin
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+# Model and dataset of the current scoring worker.
+_worker = {}
+
+
+def _init_scoring_worker(model, dataset_class, dataset_filename, field_names):
+    _worker['model'] = model
+    _worker['dataset'] = dataset_class(dataset_filename)
+    _worker['field_names'] = field_names
+
+
+def _score_lines(lines):
+    dataset = _worker['dataset']
+    field_names = _worker['field_names']
+
+    if field_names is None:
+        rows, sample_ids = zip(*(dataset.decode_line(line) for line in lines))
+    else:
+        # Raw rows of a model trained by fit_hashed.py --raw.
+        raw_rows = [list(zip(field_names, dataset.decode_line(line))) for line in lines]
+        rows = [raw_to_sparse(row) for row in raw_rows]
+        sample_ids = [row[0][1] for row in raw_rows]
+
+    predictions = _worker['model'].predict_batch(list(rows))
+
+    return list(zip(sample_ids, predictions.tolist()))
+
+
+def parallel_predictions(model, dataset, n_workers, block_size=10000, field_names=None):
+    """
+    Score a test dataset in a process pool.
+
+    Only reading of lines is left to the calling process. Blocks of
+    lines are decoded and scored by workers, which get the model once
+    at start: with the fork start method the pages of a loaded model
+    are shared rather than copied, and an artifact stays memory-mapped.
+
+    Args:
+        model: A model with predict_batch, e.g. from load_model.
+        dataset: A SparseDataset, or a RawDataset with field_names
+            to be scored through fast_solution.raw_to_sparse.
+        n_workers: Number of scoring processes.
+        block_size: Number of rows scored by a worker at once.
+
+    Yields:
+        (sample id, prediction) pairs in the order of the dataset.
+    """
+
+    initargs = (model, dataset.__class__, dataset.file.name, field_names)
+
+    return streaming.parallel_map(_score_lines, dataset.lines(), n_workers, block_size,
+                                  initializer=_init_scoring_worker, initargs=initargs)
@@ -0,0 +1,283 @@
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import time
+
+import numpy as np
+
+from .monitoring import ProgressiveValidation
+
+
+_logger = logging.getLogger(__name__)
+
+_META_FILENAME = 'meta.json'
+_ARRAYS = ('offsets', 'labels', 'fields', 'indices', 'values')
+
+# Hyperparameters passed to fit rather than to the model constructor.
+FIT_PARAMS = ('lambda1', 'lambda2')
+
+
+class DecodedDataset(object):
+    """
+    A sparse dataset decoded once into flat NumPy arrays.
+
+    Saved as a directory of .npy files and memory-mapped on load,
+    so any number of processes iterate over the same pages without
+    paying for gzip and JSON decoding again. An optional source dict,
+    e.g. the decoded file and row limit, is saved along to tell when
+    the decoded copy is stale.
+    """
+
+    def __init__(self, field_names, offsets, labels, fields, indices, values, source=None):
+        self.field_names = field_names
+        self.source = source
+        self.offsets = offsets
+        self.labels = labels
+        self.fields = fields
+        self.indices = indices
+        self.values = values
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    @classmethod
+    def from_iterator(cls, data, source=None):
+        """Decode an iterable of (x, label) pairs, e.g. SparseDataset.iterator()."""
+        field_ids = {}
+        offsets = [0]
+        labels = []
+        fields = []
+        indices = []
+        values = []
+
+        for x, label in data:
+            for (field, index, value) in x:
+                fields.append(field_ids.setdefault(field, len(field_ids)))
+                indices.append(index)
+                values.append(value)
+            offsets.append(len(fields))
+            labels.append(label)
+
+        field_names = sorted(field_ids, key=field_ids.get)
+
+        return cls(field_names,
+                   np.array(offsets, dtype=np.int64),
+                   np.array(labels, dtype=np.int64),
+                   np.array(fields, dtype=np.int32),
+                   np.array(indices, dtype=np.int64),
+                   np.array(values, dtype=np.float64),
+                   source)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, _META_FILENAME), 'w') as f:
+            json.dump({'field_names': self.field_names, 'source': self.source}, f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, _META_FILENAME)) as f:
+            meta = json.load(f)
+
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _ARRAYS}
+
+        return cls(meta['field_names'], source=meta.get('source', None), **arrays)
+
+    @staticmethod
+    def load_source(path):
+        """Source of a saved dataset, None if there's none or no dataset."""
+        try:
+            with open(os.path.join(path, _META_FILENAME)) as f:
+                return json.load(f).get('source', None)
+        except FileNotFoundError:
+            return None
+
+    def iterator(self, offset=0, limit=None, block_size=10000):
+        """Iterate over (x, label) pairs like SparseDataset.iterator."""
+        stop = len(self) if limit is None else min(len(self), offset + limit)
+
+        for block_start in range(offset, stop, block_size):
+            block_stop = min(block_start + block_size, stop)
+            start, end = self.offsets[block_start], self.offsets[block_stop]
+
+            # Converting a block at a time keeps per-row NumPy overhead out of the loop.
+            fields = [self.field_names[i] for i in self.fields[start:end].tolist()]
+            indices = self.indices[start:end].tolist()
+            values = self.values[start:end].tolist()
+            offsets = (self.offsets[block_start:block_stop + 1] - start).tolist()
+            labels = self.labels[block_start:block_stop].tolist()
+
+            for i, label in enumerate(labels):
+                a, b = offsets[i], offsets[i + 1]
+                yield list(zip(fields[a:b], indices[a:b], values[a:b])), label
+
+
+def grid_configs(space):
+    """All combinations of a {name: [values]} space."""
+    names = sorted(space)
+    for values in itertools.product(*(space[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def random_configs(space, n, seed=0):
+    """
+    n random configurations of a space.
+
+    Values of the space are either lists to choose from or
+    ('uniform' | 'loguniform', low, high) tuples.
+    """
+    rng = random.Random(seed)
+
+    for _ in range(n):
+        config = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, tuple):
+                distribution, low, high = values
+                if distribution == 'loguniform':
+                    config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+                elif distribution == 'uniform':
+                    config[name] = rng.uniform(low, high)
+                else:
+                    raise ValueError('Unknown distribution {}'.format(distribution))
+            else:
+                config[name] = rng.choice(values)
+        yield config
+
+
+class _EarlyStopping(object):
+    """
+    Stops a configuration whose progressive logloss at a milestone is
+    worse than the best seen at that milestone by more than tolerance.
+
+    Best losses are kept in a shared array, so configurations running
+    in other processes are compared against each other.
+    """
+
+    def __init__(self, best_losses, every_n_rows, tolerance):
+        self.best_losses = best_losses
+        self.every_n_rows = every_n_rows
+        self.tolerance = tolerance
+
+    def should_stop(self, milestone, loss):
+        if milestone >= len(self.best_losses):
+            return False
+
+        with self.best_losses.get_lock():
+            best = self.best_losses[milestone]
+            if loss < best:
+                self.best_losses[milestone] = loss
+                return False
+
+        return loss > best * (1 + self.tolerance)
+
+    def wrap(self, data, validation, state):
+        """Yield data until validation loss makes the configuration a clear loser."""
+        for i, row in enumerate(data):
+            # Mini-batch learners observe rows a batch after they are read.
+            if i and i % self.every_n_rows == 0 and validation.n:
+                milestone = i // self.every_n_rows - 1
+                if self.should_stop(milestone, validation.loss / validation.n):
+                    state['stopped_at'] = i
+                    return
+            yield row
+
+
+# Per-process state of search workers.
+_worker = {}
+
+
+def _init_worker(dataset_path, model_class, limit, last_n, early_stopping):
+    _worker['dataset'] = DecodedDataset.load(dataset_path)
+    _worker['model_class'] = model_class
+    _worker['limit'] = limit
+    _worker['last_n'] = last_n
+    _worker['early_stopping'] = early_stopping
+
+
+def _run_config(config):
+    fit_kwargs = {name: value for name, value in config.items() if name in FIT_PARAMS}
+    model_kwargs = {name: value for name, value in config.items() if name not in FIT_PARAMS}
+
+    model = _worker['model_class'](**model_kwargs)
+    validation = ProgressiveValidation(_worker['last_n'])
+    data = _worker['dataset'].iterator(limit=_worker['limit'])
+    state = {'stopped_at': None}
+
+    early_stopping = _worker['early_stopping']
+    if early_stopping is not None:
+        data = early_stopping.wrap(data, validation, state)
+
+    start_time = time.time()
+    score = model.fit(data, validation=validation, **fit_kwargs)
+
+    result = {
+        'config': config,
+        'rows': score['rows'],
+        'logloss': score['logloss'],
+        'last_logloss': score.get('last_logloss', None),
+        'stopped_at': state['stopped_at'],
+        'seconds': time.time() - start_time,
+    }
+    result['score'] = result['last_logloss'] if result['last_logloss'] is not None else result['logloss']
+
+    return result
+
+
+def run_search(dataset_path, model_class, configs, n_workers=None, limit=None, last_n=None,
+               early_stop_rows=None, early_stop_tolerance=0.01):
+    """
+    Fit a model for every configuration in a process pool.
+
+    Every configuration is scored by progressive validation logloss
+    on the decoded dataset, of the final last_n rows if given.
+
+    Args:
+        dataset_path: A DecodedDataset directory.
+        model_class: Model constructor, called with each configuration
+            except for FIT_PARAMS, which go to fit.
+        configs: An iterable of {name: value} dicts.
+        n_workers: Number of concurrent fits. Defaults to the CPU count.
+        limit: Train on the first N rows only.
+        last_n: Rank on the logloss of the final N rows.
+        early_stop_rows: Compare configurations every N rows and stop
+            those that lose by more than early_stop_tolerance.
+
+    Returns:
+        A list of result dicts sorted by score.
+    """
+
+    # Workers inherit the shared array of best losses, which needs fork.
+    context = multiprocessing.get_context('fork')
+
+    early_stopping = None
+    if early_stop_rows:
+        n_rows = limit if limit is not None else len(DecodedDataset.load(dataset_path))
+        best_losses = context.Array('d', [float('inf')] * max(n_rows // early_stop_rows, 1))
+        early_stopping = _EarlyStopping(best_losses, early_stop_rows, early_stop_tolerance)
+
+    results = []
+    initargs = (dataset_path, model_class, limit, last_n, early_stopping)
+
+    with context.Pool(n_workers, initializer=_init_worker, initargs=initargs) as pool:
+        for result in pool.imap_unordered(_run_config, configs):
+            _logger.info('%s: %s', result['config'], result['score'])
+            results.append(result)
+
+    results.sort(key=lambda result: (result['stopped_at'] is not None, result['score']))
+
+    return results
@@ -0,0 +1,237 @@
+import http.server
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+
+_logger = logging.getLogger(__name__)
+
+
+class _PendingRequest(object):
+
+    def __init__(self, search_id, rows):
+        self.search_id = search_id
+        self.rows = rows
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ScoringService(object):
+    """
+    In-process scorer for the candidate ads of a search.
+
+    A request is a search context and a list of candidate ads, both
+    dicts keyed by raw dataset field names (see extraction._make_query).
+    Every candidate is merged with the search context, transformed
+    by the preprocessor and the whole list is scored in one batch.
+
+    With max_batch_rows > 0 concurrent requests are coalesced by a
+    background thread into batches of up to max_batch_rows rows,
+    waiting at most max_wait_ms for more requests to arrive.
+
+    With a SearchScorer the search-level part of the score is computed
+    once per search, cached by an optional 'search_id' of the context
+    together with the context's features.
+    """
+
+    def __init__(self, preprocessor, model, field_names, max_batch_rows=0, max_wait_ms=2, search_scorer=None):
+        self.preprocessor = preprocessor
+        self.model = model
+        self.field_names = field_names
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.search_scorer = search_scorer
+
+        self._queue = None
+        self._thread = None
+
+        if self.max_batch_rows > 0:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._batch_loop, daemon=True)
+            self._thread.start()
+
+    def score(self, search, ads):
+        """
+        Predict click probabilities of candidate ads.
+
+        Returns:
+            A list of probabilities in the order of ads.
+        """
+        request = _PendingRequest(search.get('search_id', None), self._make_rows(search, ads))
+
+        if self._queue is None:
+            return self._predict([request])[0].tolist()
+
+        self._queue.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.predictions.tolist()
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _make_rows(self, search, ads):
+        rows = []
+
+        for i, ad in enumerate(ads):
+            values = {'id': i, 'intercept': 1}
+            values.update(search)
+            values.update(ad)
+            rows.append([(name, values.get(name, None)) for name in self.field_names])
+
+        return rows
+
+    def _transform(self, rows):
+        xs = []
+
+        for row in rows:
+            x = self.preprocessor.transform(row)
+            # Drop the sample id just like SparseDataset.iterator does.
+            x.pop(0)
+            xs.append(x)
+
+        return xs
+
+    def _predict(self, requests):
+        """Score requests in one batch. Returns a list of prediction arrays."""
+        xs = [self._transform(request.rows) for request in requests]
+
+        if self.search_scorer is not None:
+            return self.search_scorer.score_many([(request.search_id, x) for request, x in zip(requests, xs)])
+
+        predictions = np.asarray(self.model.predict_batch([x for request_xs in xs for x in request_xs]))
+
+        result = []
+        offset = 0
+        for request in requests:
+            result.append(predictions[offset:offset + len(request.rows)])
+            offset += len(request.rows)
+
+        return result
+
+    def _batch_loop(self):
+        stopping = False
+
+        while not stopping:
+            request = self._queue.get()
+            if request is None:
+                break
+
+            requests = [request]
+            n_rows = len(request.rows)
+            deadline = time.time() + self.max_wait
+
+            while n_rows < self.max_batch_rows:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                requests.append(request)
+                n_rows += len(request.rows)
+
+            self._process(requests)
+
+    def _process(self, requests):
+        try:
+            predictions = self._predict(requests)
+        except Exception as e:
+            _logger.exception('Failed to score a batch')
+            for request in requests:
+                request.error = e
+                request.done.set()
+            return
+
+        for request, request_predictions in zip(requests, predictions):
+            request.predictions = request_predictions
+            request.done.set()
+
+
+class ScoringRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /score {"search": {...}, "ads": [{...}, ...]} -> {"predictions": [...]}
+    GET /health -> {"status": "ok"}
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send(404, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            search = request['search']
+            ads = request['ads']
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': 'bad request: {}'.format(e)})
+            return
+
+        try:
+            predictions = self.server.service.score(search, ads)
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+
+        self._send(200, {'predictions': predictions})
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        return request, ('unix', 0)
+
+
+def make_server(service, host='127.0.0.1', port=8000, unix_socket=None):
+    """Create an HTTP server over TCP or a Unix socket."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, ScoringRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+
+    server.service = service
+
+    return server
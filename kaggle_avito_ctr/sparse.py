@@ -0,0 +1,68 @@
+import numpy as np
+import scipy.sparse
+
+
+class FeatureIndex(object):
+    """Mapping of (field, index) pairs to contiguous column numbers."""
+
+    def __init__(self):
+        self._columns = {}
+        self.features = []
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, feature):
+        return feature in self._columns
+
+    def get(self, field, index):
+        """Column of a feature or None if it's unknown."""
+        return self._columns.get((field, index), None)
+
+    def add(self, field, index):
+        """Column of a feature, allocating a new one for unknown features."""
+        key = (field, index)
+        column = self._columns.get(key, None)
+        if column is None:
+            column = len(self.features)
+            self._columns[key] = column
+            self.features.append(key)
+        return column
+
+    def transform(self, rows, grow=False, n_columns=None):
+        """
+        Convert rows of (field, index, value) triplets to a CSR matrix.
+
+        Args:
+            rows: A list of rows.
+            grow: Allocate columns for unknown features instead of skipping them.
+            n_columns: Width of the matrix. Defaults to the number of known features.
+
+        Returns:
+            scipy.sparse.csr_matrix with one row per input row.
+        """
+
+        get_column = self.add if grow else self.get
+
+        indptr = [0]
+        indices = []
+        data = []
+
+        for row in rows:
+            for (field, index, value) in row:
+                column = get_column(field, index)
+                if column is None:
+                    continue
+                indices.append(column)
+                data.append(value)
+            indptr.append(len(indices))
+
+        if n_columns is None:
+            n_columns = len(self)
+
+        X = scipy.sparse.csr_matrix(
+            (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(rows), n_columns),
+        )
+
+        return X
@@ -0,0 +1,149 @@
+import collections
+import multiprocessing
+import queue
+import threading
+
+from . import utils
+
+
+def tee(rows, dataset):
+    """Yield rows while appending them to a dataset opened for writing."""
+    for row in rows:
+        dataset.append(row)
+        yield row
+
+
+def parallel_map(func, iterable, n_workers=1, block_size=1000, max_pending=None,
+                 initializer=None, initargs=()):
+    """
+    Ordered map of func over blocks of items in a process pool.
+
+    Unlike Pool.imap, at most max_pending blocks (2 * n_workers by
+    default) are in flight, so a slow consumer stalls reading of the
+    input instead of piling results up in memory.
+
+    Args:
+        func: A picklable function of a list of items returning a list of results.
+        iterable: Input items.
+        n_workers: Number of worker processes. With 1 func runs in the calling process.
+        block_size: Number of items sent to a worker at once.
+
+    Yields:
+        Results in the order of input items.
+    """
+
+    blocks = utils.chunked(iterable, block_size)
+
+    if n_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for block in blocks:
+            yield from func(block)
+        return
+
+    max_pending = max_pending or 2 * n_workers
+    pending = collections.deque()
+
+    with multiprocessing.Pool(n_workers, initializer=initializer, initargs=initargs) as pool:
+        for block in blocks:
+            if len(pending) >= max_pending:
+                yield from pending.popleft().get()
+            pending.append(pool.apply_async(func, (block,)))
+
+        while pending:
+            yield from pending.popleft().get()
+
+
+def prefetch(iterable, depth=16, block_size=100):
+    """
+    Iterate over iterable in a background thread.
+
+    Blocks of block_size items are produced up to depth blocks ahead
+    of the consumer, so reading and decoding overlaps with whatever
+    the consumer does as far as the GIL allows: zlib releases it
+    while inflating, JSON decoding doesn't. It only pays off with a
+    spare core. Small blocks keep fewer decoded rows alive, which
+    the garbage collector would otherwise traverse over and over.
+
+    Exceptions of the producer are raised in the consumer. Closing
+    the iterator early stops the thread.
+    """
+
+    blocks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in utils.chunked(iterable, block_size):
+                if not put(block):
+                    return
+        except BaseException as e:
+            put(e)
+        else:
+            put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            block = blocks.get()
+            if block is end:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield from block
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Preprocessor of the current transform worker.
+_worker = {}
+
+
+def _init_transform_worker(preprocessor, field_names):
+    _worker['preprocessor'] = preprocessor
+    _worker['field_names'] = field_names
+
+
+def _transform_block(rows):
+    preprocessor = _worker['preprocessor']
+    field_names = _worker['field_names']
+    return [preprocessor.transform(list(zip(field_names, row))) for row in rows]
+
+
+def transform_stream(rows, preprocessor, field_names, n_workers=1, block_size=1000, sparse_dataset=None):
+    """
+    Preprocess raw rows on the fly.
+
+    Args:
+        rows: Raw rows, e.g. from RawDataset.iterator() or a DB query.
+        preprocessor: A fitted Preprocessor.
+        field_names: Names of raw row columns.
+        n_workers: Number of preprocessing processes.
+        sparse_dataset: An optional SparseDataset to also write transformed rows to.
+
+    Yields:
+        (x, label) pairs like SparseDataset.iterator.
+    """
+
+    transformed = parallel_map(_transform_block, rows, n_workers, block_size,
+                               initializer=_init_transform_worker, initargs=(preprocessor, field_names))
+
+    if sparse_dataset is not None:
+        transformed = tee(transformed, sparse_dataset)
+
+    for row in transformed:
+        label = row.pop(0)[2]
+        yield row, label
@@ -0,0 +1,165 @@
+import math
+
+import numpy as np
+
+from .extraction import get_field_names
+from .globals import DATA
+
+
+def _zipf_sampler(rng, n, exponent):
+    """Sampler of ids 0..n-1 with Zipf-like popularity."""
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    # Popular ids shouldn't all be small numbers.
+    ids = rng.permutation(n)
+
+    def sample(size):
+        return ids[np.minimum(np.searchsorted(cdf, rng.random_sample(size)), n - 1)]
+
+    return sample
+
+
+class SyntheticAvito(object):
+    """
+    Generator of raw rows shaped like extraction._make_query output.
+
+    Users, ads and locations are drawn with Zipf-like skew and fixed
+    per-entity attributes, contextual ads are shown 1-3 per search
+    at positions 1 and 7 and clicks follow a latent per-ad CTR, so
+    cardinalities, sparsity and the click rate resemble the real data
+    well enough to benchmark every stage without the database.
+    """
+
+    def __init__(self, n_users=100000, n_ads=200000, n_categories=60, n_params=2000,
+                 n_regions=80, n_cities=3000, seed=0):
+        self.rng = np.random.RandomState(seed)
+        rng = self.rng
+
+        self.n_categories = n_categories
+        # Searches of the first hour predate counters.
+        self.start_date = DATA['COUNTER_START_DATE'] - 3600
+        self.n_searches = 0
+
+        # Categories form a three-level tree.
+        self.category_ids = np.arange(1, n_categories + 1)
+        self.category_levels = rng.randint(1, 4, n_categories)
+        self.category_parents = 1000 + (self.category_ids - 1) // 10
+
+        self._sample_user = _zipf_sampler(rng, n_users, 1.1)
+        self._sample_ad = _zipf_sampler(rng, n_ads, 1.05)
+        self._sample_category = _zipf_sampler(rng, n_categories, 1.2)
+        self._sample_city = _zipf_sampler(rng, n_cities, 1.3)
+        self._sample_param = _zipf_sampler(rng, n_params, 1.2)
+
+        self.users = {
+            'agent_id': _zipf_sampler(rng, 3000, 1.3)(n_users),
+            'agent_family_id': _zipf_sampler(rng, 50, 1.5)(n_users),
+            'agent_osid': _zipf_sampler(rng, 30, 1.5)(n_users),
+            'device_id': _zipf_sampler(rng, 2000, 1.3)(n_users),
+            'n_visits': rng.geometric(0.02, n_users),
+            'n_phone_requests': rng.geometric(0.3, n_users) - 1,
+            'ctr_bias': rng.normal(0, 0.5, n_users),
+            'n_impressions': rng.poisson(20, n_users),
+            'known': rng.random_sample(n_users) > 0.05,
+        }
+        self.users['n_clicks'] = rng.binomial(self.users['n_impressions'], 0.01)
+
+        latent_ctr = 1 / (1 + np.exp(-rng.normal(-5, 0.8, n_ads)))
+        n_impressions = rng.poisson(200, n_ads)
+        self.ads = {
+            'category': self.category_ids[self._sample_category(n_ads)],
+            'price': np.exp(rng.normal(8, 1.5, n_ads)).round(),
+            'has_price': rng.random_sample(n_ads) > 0.03,
+            'n_params': rng.randint(0, 5, n_ads),
+            'ctr': latent_ctr,
+            'n_impressions': n_impressions,
+            'n_clicks': rng.binomial(n_impressions, latent_ctr),
+            'hist_ctr': np.clip(latent_ctr * rng.lognormal(0, 0.3, n_ads), 0, 1),
+        }
+
+        self.cities = {
+            'region': rng.randint(1, n_regions + 1, n_cities),
+            'level': rng.randint(1, 4, n_cities),
+        }
+
+    def categories(self):
+        """{category_id: parent_category_id} snapshot for CategoryFeatureExtractor."""
+        return dict(zip(self.category_ids.tolist(), self.category_parents.tolist()))
+
+    def rows(self, n, part='train'):
+        """Yield n raw rows in the column order of get_field_names(part)."""
+        field_names = get_field_names(part)
+        n_yielded = 0
+
+        while n_yielded < n:
+            for values in self._search_block(1000):
+                if n_yielded >= n:
+                    break
+                if part == 'train':
+                    values['is_click'] = int(self.rng.random_sample() < values.pop('p_click'))
+                else:
+                    values.pop('p_click')
+                    values['id'] = n_yielded
+                yield [values[name] for name in field_names]
+                n_yielded += 1
+
+    def _search_block(self, n_searches):
+        rng = self.rng
+
+        users = self._sample_user(n_searches)
+        cities = self._sample_city(n_searches)
+        search_categories = self.category_ids[self._sample_category(n_searches)]
+        # About 2 searches per second.
+        dates = self.start_date + (self.n_searches + np.arange(n_searches)) * 0.5 + rng.random_sample(n_searches)
+        n_ads = rng.randint(1, 4, n_searches)
+
+        self.n_searches += n_searches
+
+        for i in range(n_searches):
+            user = users[i]
+            city = cities[i]
+            search_date = float(dates[i])
+            search_category = int(search_categories[i])
+            known_user = self.users['known'][user]
+
+            search = {
+                'intercept': 1,
+                'hour': int(search_date // 3600 % 24),
+                'search_date': search_date,
+                'search_cat_id': search_category,
+                'search_cat_level': int(self.category_levels[search_category - 1]),
+                'user_id': int(user) if known_user else -1,
+                'user_agent_id': int(self.users['agent_id'][user]) if known_user else -1,
+                'user_agent_family_id': int(self.users['agent_family_id'][user]) if known_user else -1,
+                'user_agent_osid': int(self.users['agent_osid'][user]) if known_user else -1,
+                'user_device_id': int(self.users['device_id'][user]) if known_user else -1,
+                'user_n_impressions': int(self.users['n_impressions'][user]) if known_user else 0,
+                'user_n_clicks': int(self.users['n_clicks'][user]) if known_user else 0,
+                'user_n_visits': int(self.users['n_visits'][user]) if known_user else 0,
+                'user_n_phone_requests': int(self.users['n_phone_requests'][user]) if known_user else 0,
+                'loc_level': int(self.cities['level'][city]),
+                'region_id': int(self.cities['region'][city]),
+                'city_id': int(city),
+            }
+
+            for ad, position in zip(self._sample_ad(n_ads[i]), (1, 7, 7)):
+                values = dict(search)
+                n_params = self.ads['n_params'][ad]
+                params = {str(param): 'v{}'.format(param % 7) for param in self._sample_param(n_params)}
+                margin = (math.log(self.ads['ctr'][ad] / (1 - self.ads['ctr'][ad])) +
+                          self.users['ctr_bias'][user] + (0.3 if position == 1 else -0.3))
+
+                values.update({
+                    'ad_position': position,
+                    'hist_ctr': float(self.ads['hist_ctr'][ad]),
+                    'ad_id': int(ad),
+                    'price': float(self.ads['price'][ad]) if self.ads['has_price'][ad] else None,
+                    'ad_params': params or None,
+                    'ad_cat_id': int(self.ads['category'][ad]),
+                    'ad_n_impressions': int(self.ads['n_impressions'][ad]),
+                    'ad_n_clicks': int(self.ads['n_clicks'][ad]),
+                    'p_click': 1 / (1 + math.exp(-margin)),
+                })
+
+                yield values
@@ -0,0 +1,83 @@
+import itertools
+import os
+import resource
+import sys
+import zlib
+
+import numpy as np
+from scipy.special import expit
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def sigmoid(z):
+    """Vectorized sigmoid clipped to avoid overflow on extreme margins."""
+    return expit(np.clip(z, -35, 35))
+
+
+def grow(array, size):
+    """
+    Return an array with at least `size` elements.
+
+    Capacity is doubled to amortize reallocations, new elements are zeros.
+    """
+    if array.shape[0] >= size:
+        return array
+
+    new_shape = (max(size, 2 * array.shape[0]),) + array.shape[1:]
+    new_array = np.zeros(new_shape, dtype=array.dtype)
+    new_array[:array.shape[0]] = array
+
+    return new_array
+
+
+def stable_hash(field, value):
+    """32-bit hash of a (field, value) pair that is the same in every process."""
+    return zlib.crc32('{}\x00{}'.format(field, value).encode('utf-8'))
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes."""
+    try:
+        # Unlike ru_maxrss, it follows reset_peak_rss.
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset peak_rss to the current RSS, so that it measures a part of a run.
+
+    Returns:
+        False where not supported, Linux only.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    """Current resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
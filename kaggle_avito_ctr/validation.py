@@ -1,19 +1,26 @@
+import itertools
 import logging
-import math
 
+import numpy as np
+
+from . import utils
 from .extraction import SparseDataset
+from .metrics import StreamingMetrics, format_metric
 
 
 _logger = logging.getLogger(__name__)
 
 
 def evaluate(model, data):
-    score = logloss(model, data)
-    return score
+    """Returns StreamingMetrics of the model on data."""
+    metrics = compute_metrics(model, data)
+    return metrics
 
 
 def cv(clf, filename, n_folds=5, num_samples=None):
+    """Returns logloss of every fold. AUC is logged per fold and overall."""
     scores = []
+    total = StreamingMetrics()
 
     if num_samples is not None:
         test_limit = num_samples / n_folds
@@ -28,16 +35,35 @@ def cv(clf, filename, n_folds=5, num_samples=None):
                 test_iterator = test_ds.iterator(offset=part, limit=test_limit, every_nth=n_folds)
 
                 clf.fit(train_iterator)
-                score = logloss(clf, test_iterator)
+                metrics = compute_metrics(clf, test_iterator)
+                score = metrics.logloss()
 
                 scores.append(score)
+                total.merge(metrics)
+
+                _logger.info('CV {}/{} score: {}, AUC: {}'.format(part, n_folds, score, metrics.auc()))
 
-                _logger.info('CV {}/{} score: {}'.format(part, n_folds, score))
+    _logger.info('CV overall score: {}, AUC: {}'.format(total.logloss(), total.auc()))
 
     return scores
 
 
-def validation_curve(clf, filename, train_sizes, test_proporion=0.2):
+def validation_curve(clf, filename, train_sizes, test_proporion=0.2, incremental=False):
+    """
+    Train and test scores for increasing training set sizes.
+
+    With incremental=True the model is trained once, continuing from
+    one size to the next, instead of from scratch for every size. Every
+    chunk of the training data between two sizes is scored right after
+    the model is trained on it and the train score accumulates these,
+    so each row is read twice in total. It's close to, but not exactly,
+    the score of the final model on the training prefix.
+    Needs a model that supports fit(..., resume=True).
+    """
+
+    if incremental:
+        return _incremental_validation_curve(clf, filename, train_sizes, test_proporion)
+
     scores = []
     nth = int(1 / test_proporion)
 
@@ -50,31 +76,59 @@ def validation_curve(clf, filename, train_sizes, test_proporion=0.2):
                 train_iterator = train_ds.iterator(limit=limit, skip_nth=nth)
                 test_iterator = test_ds.iterator(every_nth=nth)
                 train_score = logloss(clf, train_iterator)
-                test_score = logloss(clf, test_iterator)
+                test_metrics = compute_metrics(clf, test_iterator)
+                test_score = test_metrics.logloss()
 
                 scores.append((train_score, test_score))
 
-                _logger.info('{} samples train/test scores: {:.5}/{:.5}'
-                             .format(limit, train_score, test_score))
+                _logger.info('{} samples train/test scores: {}/{}, test AUC: {}'.format(
+                    limit, format_metric(train_score), format_metric(test_score), format_metric(test_metrics.auc())))
 
     return scores
 
 
-def sample_logloss(y_hat, y):
-    margin = 1e-9
-    y_hat = max(min(y_hat, 1 - margin), margin)
-    return -(y * math.log(y_hat) + (1 - y) * math.log(1 - y_hat))
+def _incremental_validation_curve(clf, filename, train_sizes, test_proporion):
+    scores = {}
+    nth = int(1 / test_proporion)
+
+    train_metrics = StreamingMetrics()
+
+    # A second reader of the training data follows the first one a chunk behind to score it.
+    with SparseDataset(filename) as train_ds, SparseDataset(filename) as score_ds:
+        with SparseDataset(filename) as test_ds:
+            train_iterator = train_ds.iterator(limit=max(train_sizes), skip_nth=nth)
+            score_iterator = score_ds.iterator(limit=max(train_sizes), skip_nth=nth)
+            n_trained = 0
+
+            for limit in sorted(set(train_sizes)):
+                chunk = itertools.islice(train_iterator, limit - n_trained)
+                clf.fit(chunk, resume=n_trained > 0)
+                train_metrics.merge(compute_metrics(clf, itertools.islice(score_iterator, limit - n_trained)))
+                n_trained = limit
+
+                test_iterator = test_ds.iterator(every_nth=nth)
+                train_score = train_metrics.logloss()
+                test_metrics = compute_metrics(clf, test_iterator)
+                test_score = test_metrics.logloss()
+
+                scores[limit] = (train_score, test_score)
+
+                _logger.info('{} samples train/test scores: {}/{}, test AUC: {}'.format(
+                    limit, format_metric(train_score), format_metric(test_score), format_metric(test_metrics.auc())))
+
+    return [scores[limit] for limit in train_sizes]
+
 
+def compute_metrics(clf, data, batch_size=10000):
+    """Score (x, y) pairs in batches into a StreamingMetrics accumulator."""
+    metrics = StreamingMetrics()
 
-def logloss(clf, data):
-    n = 0
-    loss = 0
+    for batch in utils.chunked(data, batch_size):
+        xs, ys = zip(*batch)
+        metrics.update(clf.predict_batch(xs), np.array(ys, dtype=np.float64))
 
-    for x, y in data:
-        y_hat = clf.predict(x)
-        loss += sample_logloss(y_hat, y)
-        n += 1
+    return metrics
 
-    loss /= n
 
-    return loss
+def logloss(clf, data, batch_size=10000):
+    return compute_metrics(clf, data, batch_size).logloss()
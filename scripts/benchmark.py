@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import RawDataset, SparseDataset
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.preprocessing import Preprocessor
+from kaggle_avito_ctr.profiling import StageProfiler
+from kaggle_avito_ctr.synthetic import SyntheticAvito
+from kaggle_avito_ctr.utils import chunked
+from kaggle_avito_ctr.validation import logloss
+from make_submission import make_submission
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_rows', type=int, default=100000, help='Number of synthetic train rows')
+    parser.add_argument('--test_rows', type=int, default=20000, help='Number of synthetic test rows')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the data generator')
+    parser.add_argument('--workdir', help='Directory for generated files, a temporary one by default')
+    parser.add_argument('--output', help='Name of a JSON file to write results to, stdout by default')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        results = run(workdir, args.train_rows, args.test_rows, args.seed)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+class Benchmark(object):
+    """Times stages of a run, see StageProfiler for the measurements."""
+
+    def __init__(self):
+        self.profiler = StageProfiler()
+        self.stages = {}
+
+    def measure(self, name, func, n_rows):
+        print('Running {}'.format(name), file=sys.stderr)
+
+        with self.profiler.stage(name, n_rows):
+            result = func()
+
+        self.stages[name] = self.profiler.stages[-1]
+
+        return result
+
+
+def run(workdir, train_rows, test_rows, seed):
+    raw_train = os.path.join(workdir, 'train_raw.gz')
+    raw_test = os.path.join(workdir, 'test_raw.gz')
+    sparse_train = os.path.join(workdir, 'train.gz')
+    sparse_test = os.path.join(workdir, 'test.gz')
+    submission = os.path.join(workdir, 'submission.csv')
+
+    benchmark = Benchmark()
+    generator = SyntheticAvito(seed=seed)
+
+    benchmark.measure('generate', lambda: (write_raw(generator.rows(train_rows, 'train'), raw_train),
+                                           write_raw(generator.rows(test_rows, 'test'), raw_test)),
+                      train_rows + test_rows)
+
+    benchmark.measure('raw_iterator', lambda: consume(RawDataset(raw_train).iterator()), train_rows)
+
+    preprocessor = Preprocessor(generator.categories())
+    benchmark.measure('preprocessor_fit',
+                      lambda: preprocessor.fit(lambda: RawDataset(raw_train).sparse_iterator('train')),
+                      train_rows)
+
+    benchmark.measure('preprocessor_transform', lambda: (transform(preprocessor, raw_train, sparse_train, 'train'),
+                                                         transform(preprocessor, raw_test, sparse_test, 'test')),
+                      train_rows + test_rows)
+
+    benchmark.measure('sparse_iterator', lambda: consume(SparseDataset(sparse_train).iterator()), train_rows)
+
+    model = OnlineLogisticRegression()
+    benchmark.measure('fit', lambda: model.fit(SparseDataset(sparse_train).iterator()), train_rows)
+
+    benchmark.measure('predict', lambda: consume(model.predict(x) for x, _ in SparseDataset(sparse_test).iterator()),
+                      test_rows)
+    benchmark.measure('predict_batch',
+                      lambda: consume(model.predict_batch([x for x, _ in batch])
+                                      for batch in chunked(SparseDataset(sparse_test).iterator(), 10000)),
+                      test_rows)
+
+    benchmark.measure('logloss', lambda: logloss(model, SparseDataset(sparse_train).iterator()), train_rows)
+
+    benchmark.measure('submission', lambda: make_submission(model, sparse_test, submission), test_rows)
+
+    preprocessor_filename = os.path.join(workdir, 'preprocessor.pkl')
+    model_filename = os.path.join(workdir, 'model.pkl')
+    for obj, filename in ((preprocessor, preprocessor_filename), (model, model_filename)):
+        with open(filename, 'wb') as f:
+            pickle.dump(obj, f)
+
+    return {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'train_rows': train_rows,
+        'test_rows': test_rows,
+        'seed': seed,
+        'stages': benchmark.stages,
+        'startup': measure_startup(preprocessor_filename, model_filename),
+    }
+
+
+# Imports make_submission and unpickles a preprocessor and a model
+# the way a scoring process starts.
+_STARTUP_CODE = """
+import pickle, sys, time
+start = time.perf_counter()
+import make_submission
+for filename in sys.argv[1:]:
+    with open(filename, 'rb') as f:
+        pickle.load(f)
+print(time.perf_counter() - start)
+print(' '.join(sorted(name for name in ('pymorphy2', 'sqlalchemy') if name in sys.modules)))
+"""
+
+
+def measure_startup(preprocessor_filename, model_filename, n_runs=5):
+    """
+    Best of n_runs times of a fresh interpreter loading scoring code.
+
+    Heavy modules such as SQLAlchemy and pymorphy2 should stay unloaded.
+    """
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    import_seconds = []
+
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, '-c', _STARTUP_CODE, preprocessor_filename, model_filename],
+            cwd=scripts_dir, universal_newlines=True)
+        seconds.append(time.perf_counter() - start)
+        lines = output.splitlines()
+        import_seconds.append(float(lines[0]))
+        heavy_modules = lines[1].split() if len(lines) > 1 else []
+
+    return {
+        'seconds': min(seconds),
+        'import_seconds': min(import_seconds),
+        'heavy_modules': heavy_modules,
+    }
+
+
+def write_raw(rows, dst):
+    with RawDataset(dst, 'w') as ds:
+        for row in rows:
+            ds.append(row)
+
+
+def transform(preprocessor, src, dst, part):
+    with SparseDataset(dst, 'w') as ds:
+        for row in RawDataset(src).sparse_iterator(part):
+            ds.append(preprocessor.transform(row))
+
+
+def consume(iterator):
+    for _ in iterator:
+        pass
+
+
+if __name__ == '__main__':
+    main()
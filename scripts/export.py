@@ -5,23 +5,42 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from kaggle_avito_ctr.extraction import RawDataset, make_test_query, make_train_query
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
 
 
 def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('dst', help='Name of a file to write')
     parser.add_argument('--type', choices=['train', 'test'], default='train')
     parser.add_argument('--offset', help='Skip fist N samples')
     parser.add_argument('--limit', help='Max number of entries to fetch')
+    parser.add_argument('--grouped', action='store_true',
+                        help='Write rows grouped by search, with search-level columns stored once per search')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
 
     args = parser.parse_args()
 
-    export(args.dst, args.type, args.offset, args.limit)
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    with profiled_stage(profiler, 'export') as stage:
+        stage.rows = export(args.dst, args.type, args.offset, args.limit, args.grouped)
 
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
 
-def export(dst, part, offset, limit):
 
-    with RawDataset(dst, 'w') as ds:
+def export(dst, part, offset, limit, grouped=False):
+    """Returns the number of exported rows."""
+    n_rows = 0
+
+    with RawDataset(dst, 'w', grouped=grouped) as ds:
         if part == 'train':
             q = make_train_query()
         elif part == 'test':
@@ -29,6 +48,9 @@ def export(dst, part, offset, limit):
 
         for row in q:
             ds.append(row)
+            n_rows += 1
+
+    return n_rows
 
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import pickle
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.scoring import WEIGHT_DTYPES, ScoringModel, export_model, is_artifact, quantize_artifact
+from kaggle_avito_ctr.validation import logloss
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='Name of a file containing a pickled model or an exported model directory')
+    parser.add_argument('dst', help='Name of a directory to write the scoring artifact to')
+    parser.add_argument('--dtype', choices=WEIGHT_DTYPES, default='float64', help='Weight storage type')
+    parser.add_argument('--validation', help='Sparse dataset to measure the logloss delta of quantization on')
+    parser.add_argument('--validation_rows', type=int, help='Use only first N validation rows')
+
+    args = parser.parse_args()
+
+    if is_artifact(args.model):
+        quantize_artifact(args.model, args.dst, args.dtype)
+        reference = ScoringModel.load(args.model)
+    else:
+        with open(args.model, 'rb') as f:
+            model = pickle.load(f)
+        export_model(model, args.dst, args.dtype)
+        reference = model
+
+    print('Model exported to {}'.format(args.dst))
+
+    exported = ScoringModel.load(args.dst)
+    print('Weight table size: {:.1f} MB'.format(exported.nbytes / 2 ** 20))
+
+    if args.validation is not None:
+        print_logloss_delta(reference, exported, args.validation, args.validation_rows)
+
+
+def print_logloss_delta(reference, exported, dataset_filename, limit=None):
+    with SparseDataset(dataset_filename) as dataset:
+        reference_score = logloss(reference, dataset.iterator(limit=limit))
+        exported_score = logloss(exported, dataset.iterator(limit=limit))
+
+    print('Reference logloss: {:.6f}'.format(reference_score))
+    print('Exported logloss: {:.6f}'.format(exported_score))
+    print('Delta: {:+.6f}'.format(exported_score - reference_score))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,21 +5,77 @@ import pickle
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.checkpoint import Checkpointer, load_checkpoint, resume_iterator
+from kaggle_avito_ctr.counters import COUNTER_STORES
 from kaggle_avito_ctr.extraction import SparseDataset
-from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.fm import FactorizationMachine, FieldAwareFactorizationMachine
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.monitoring import TrainingMonitor
+from kaggle_avito_ctr.online_lr import MiniBatchLogisticRegression, OnlineLogisticRegression
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
+from kaggle_avito_ctr.scoring import export_model
 
 
 def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('dataset', help='Name of a file containing the dataset')
     parser.add_argument('dst', help='Name of a file to save fitted model')
+    parser.add_argument('--model_type', choices=['lr', 'fm', 'ffm'], default='lr',
+                        help='Logistic regression or (field-aware) factorization machine')
+    parser.add_argument('--batch_size', type=int, help='Train a vectorized model on mini-batches of N rows')
+    parser.add_argument('--counter_store', choices=sorted(COUNTER_STORES), default='dict',
+                        help='Storage of ad and user counters for online CTR features')
+    parser.add_argument('--count_threshold', type=int,
+                        help='Allocate a weight only after a feature has been seen N times')
+    parser.add_argument('--admission_width', type=int,
+                        help='Width of the sketch counting features below --count_threshold')
+    parser.add_argument('--negative_rate', type=float,
+                        help='Train on all clicks and a deterministic fraction R of non-clicks, '
+                             'predictions are corrected for the sampling')
+    parser.add_argument('--artifact', help='Also write a scoring-only model artifact to this directory')
+    parser.add_argument('--checkpoint', help='Name of a file to periodically save training state to')
+    parser.add_argument('--checkpoint_rows', type=int, help='Save a checkpoint every N rows')
+    parser.add_argument('--checkpoint_minutes', type=float, help='Save a checkpoint every T minutes')
+    parser.add_argument('--metrics', help='Name of a file to write JSON lines of training metrics to')
+    parser.add_argument('--metrics_rows', type=int, default=100000, help='Report training metrics every N rows')
+    parser.add_argument('--resume', action='store_true', help='Continue training from the checkpoint')
+    parser.add_argument('--prefetch', type=int,
+                        help='Read and decode up to N blocks of rows ahead in a background thread')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
 
     args = parser.parse_args()
 
+    if args.artifact and args.model_type != 'lr':
+        parser.error('--artifact requires a linear model, --model_type lr')
+
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume requires --checkpoint')
+
+    if args.resume and args.negative_rate is not None:
+        parser.error('--resume continues at the negative rate of the checkpoint, --negative_rate can\'t be given')
+
     print('Begin training')
 
-    with SparseDataset(args.dataset) as X:
-        model = fit(X.iterator())
+    checkpointer = make_checkpointer(args.checkpoint, args.checkpoint_rows, args.checkpoint_minutes)
+    monitor = make_monitor(args.metrics, args.metrics_rows)
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    with profiled_stage(profiler, 'fit') as stage, SparseDataset(args.dataset) as X:
+        if args.resume:
+            model = load_checkpoint(args.checkpoint)
+            print('Resuming from row {}'.format(model.n_rows))
+            data = resume_iterator(X, model, prefetch=args.prefetch)
+            model.fit(stage.count(data), checkpointer=checkpointer, resume=True, monitor=monitor)
+        else:
+            model = make_model(args.model_type, args.batch_size, args.counter_store, args.count_threshold,
+                               args.admission_width)
+            data = X.iterator(prefetch=args.prefetch, negative_rate=args.negative_rate)
+            fit(stage.count(data), model, checkpointer, monitor, args.negative_rate)
 
     print('Training succeded')
 
@@ -28,12 +84,49 @@ def main():
 
     print('Model saved to {}'.format(args.dst))
 
+    if args.artifact:
+        export_model(model, args.artifact)
+        print('Scoring artifact saved to {}'.format(args.artifact))
+
     print_summary(model)
 
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
+
+
+def fit(X, model, checkpointer=None, monitor=None, negative_rate=None):
+    model.fit(X, checkpointer=checkpointer, monitor=monitor, negative_rate=negative_rate)
+    return model
+
 
-def fit(X):
-    model = OnlineLogisticRegression()
-    model.fit(X)
+def make_checkpointer(filename, every_n_rows=None, every_minutes=None):
+    if filename is None:
+        return None
+    every_seconds = every_minutes * 60 if every_minutes is not None else None
+    return Checkpointer(filename, every_n_rows=every_n_rows, every_seconds=every_seconds)
+
+
+def make_monitor(filename, every_n_rows):
+    if filename is None:
+        return None
+    return TrainingMonitor(open(filename, 'a'), every_n_rows=every_n_rows)
+
+
+def make_model(model_type='lr', batch_size=None, counter_store='dict', count_threshold=None, admission_width=None):
+    kwargs = {
+        'counter_store': COUNTER_STORES[counter_store],
+        'count_threshold': count_threshold,
+        'admission_width': admission_width,
+    }
+    if model_type == 'fm':
+        model = FactorizationMachine(**kwargs)
+    elif model_type == 'ffm':
+        model = FieldAwareFactorizationMachine(**kwargs)
+    elif batch_size:
+        model = MiniBatchLogisticRegression(batch_size, **kwargs)
+    else:
+        model = OnlineLogisticRegression(**kwargs)
     return model
 
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import pickle
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import RawDataset, SparseDataset
+from kaggle_avito_ctr.fast_solution import HashingLogisticRegression, raw_iterator
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.monitoring import TrainingMonitor
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', help='Name of a file containing the dataset')
+    parser.add_argument('dst', help='Name of a file to save fitted model')
+    parser.add_argument('--raw', action='store_true', help='Train on a raw dataset instead of a sparse one')
+    parser.add_argument('--n_bits', type=int, default=20, help='Use 2 ** N hashed weights')
+    parser.add_argument('--alpha', type=float, default=0.1, help='Learning rate')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Hash rows in batches of N')
+    parser.add_argument('--metrics', help='Name of a file to write JSON lines of training metrics to')
+    parser.add_argument('--metrics_rows', type=int, default=100000, help='Report training metrics every N rows')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
+
+    args = parser.parse_args()
+
+    model = HashingLogisticRegression(args.n_bits, args.alpha, args.batch_size)
+    monitor = TrainingMonitor(open(args.metrics, 'a'), every_n_rows=args.metrics_rows) if args.metrics else None
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    print('Begin training')
+
+    with profiled_stage(profiler, 'fit') as stage:
+        if args.raw:
+            with RawDataset(args.dataset) as dataset:
+                model.fit(raw_iterator(dataset, 'train'), monitor=monitor)
+        else:
+            with SparseDataset(args.dataset) as dataset:
+                model.fit(dataset.iterator(), monitor=monitor)
+        stage.rows = model.n_rows
+
+    print('Training succeded')
+
+    with open(args.dst, 'wb') as f:
+        pickle.dump(model, f)
+
+    print('Model saved to {}'.format(args.dst))
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
+
+
+if __name__ == '__main__':
+    main()
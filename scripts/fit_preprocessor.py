@@ -1,28 +1,60 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import os
 import pickle
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from kaggle_avito_ctr.extraction import RawDataset
+from kaggle_avito_ctr.globals import configure_logging
 from kaggle_avito_ctr.preprocessing import Preprocessor
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
 
 
 def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('source_file', help='Name of a file containing the dataset')
     parser.add_argument('target_file', help='Name of a file to store pickled preprocessor')
+    parser.add_argument('--categories', help='JSON snapshot of categories to use instead of the DB')
+    parser.add_argument('--save_categories',
+                        help='Name of a JSON file to write the category snapshot to, e.g. for serve.py')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
 
     args = parser.parse_args()
 
-    preprocessor = fit_preprocessor(args.source_file)
+    categories = load_categories(args.categories) if args.categories else None
+
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    with profiled_stage(profiler, 'fit_preprocessor') as stage:
+        preprocessor = fit_preprocessor(args.source_file, categories, stage)
     save_preprocessor(preprocessor, args.target_file)
+    if args.save_categories:
+        preprocessor.category_feature_extractor.save_snapshot(args.save_categories)
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
+
+
+def load_categories(filename):
+    with open(filename) as f:
+        return dict(json.load(f))
 
 
-def fit_preprocessor(source):
-    X_factory = lambda: RawDataset(source).sparse_iterator('train')
-    preprocessor = Preprocessor()
+def fit_preprocessor(source, categories=None, stage=None):
+    """stage, if given, counts rows read by both passes of fitting."""
+    if stage is not None:
+        X_factory = lambda: stage.count(RawDataset(source).sparse_iterator('train'))
+    else:
+        X_factory = lambda: RawDataset(source).sparse_iterator('train')
+    preprocessor = Preprocessor(categories)
     preprocessor.fit(X_factory)
     return preprocessor
 
@@ -6,26 +6,45 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from kaggle_avito_ctr.extraction import RawDataset, SparseDataset
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
 
 
 def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('source_file', help='Name of a file containing the dataset')
     parser.add_argument('target_file', help='Gzipped text file containing the result')
     parser.add_argument('preprocessor', help='Pickled preprocessor')
     parser.add_argument('--type', choices=['train', 'test'], default='train')
+    parser.add_argument('--grouped', action='store_true',
+                        help='Write rows grouped by search, with search-level features stored once per search')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
 
     args = parser.parse_args()
 
     with open(args.preprocessor, 'rb') as f:
         preprocessor = pickle.load(f)
 
-    transform(args.source_file, args.target_file, preprocessor, args.type)
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    with profiled_stage(profiler, 'transform') as stage:
+        stage.rows = transform(args.source_file, args.target_file, preprocessor, args.type, args.grouped)
 
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
 
-def transform(src, dst, preprocessor, part):
+
+def transform(src, dst, preprocessor, part, grouped=False):
+    """Returns the number of transformed rows."""
+    i = -1
     with RawDataset(src) as src_ds:
-        with SparseDataset(dst, 'w') as dst_ds:
+        with SparseDataset(dst, 'w', grouped=grouped) as dst_ds:
             for (i, row) in enumerate(src_ds.sparse_iterator(part)):
                 transformed_row = preprocessor.transform(row)
                 dst_ds.append(transformed_row)
@@ -35,6 +54,8 @@ def transform(src, dst, preprocessor, part):
 
     print()
 
+    return i + 1
+
 
 if __name__ == '__main__':
     main()
@@ -2,44 +2,111 @@
 import argparse
 import csv
 import os
-import pickle
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.extraction import RawDataset, SparseDataset
+from kaggle_avito_ctr.fast_solution import raw_iterator
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
+from kaggle_avito_ctr.scoring import SearchScorer, load_model, parallel_predictions
+from kaggle_avito_ctr.utils import chunked
+
+
+_WRITE_BUFFER_SIZE = 2 ** 20
 
 
 def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('model', help='Name of a file containing a model')
+    parser.add_argument('model', help='Name of a pickled model or an exported model directory')
     parser.add_argument('dataset', help='Name of a file containing test dataset')
     parser.add_argument('dst', help='Name of a submission CSV file')
+    parser.add_argument('--raw', action='store_true',
+                        help='Score a raw test dataset with a model trained by fit_hashed.py --raw')
+    parser.add_argument('--prefetch', type=int,
+                        help='Read and decode up to N blocks of rows ahead in a background thread')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Decode and score blocks of rows in N processes')
+    parser.add_argument('--by_search', action='store_true',
+                        help='Score search-level features once per search, linear models only')
+    parser.add_argument('--profile', help='Name of a JSON file to write a profile of the run to')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats to this directory')
 
     args = parser.parse_args()
 
-    with open(args.model, 'rb') as f:
-        model = pickle.load(f)
+    if args.by_search and (args.raw or args.workers > 1):
+        parser.error('--by_search works with neither --raw nor --workers')
+
+    profiler = StageProfiler(args.profile_sample, args.profile_dir) if args.profile else None
+
+    with profiled_stage(profiler, 'load_model'):
+        model = load_model(args.model)
+
+    with profiled_stage(profiler, 'make_submission') as stage:
+        stage.rows = make_submission(model, args.dataset, args.dst, raw=args.raw, prefetch=args.prefetch,
+                                     n_workers=args.workers, by_search=args.by_search)
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
 
-    make_submission(model, args.dataset, args.dst)
 
+def make_submission(model, dataset_filename, dst, raw=False, prefetch=None, n_workers=1, by_search=False):
+    """
+    Write predictions for a test dataset in its order.
 
-def make_submission(model, dataset_filename, dst):
+    With n_workers > 1 rows are decoded and scored by a pool
+    of processes, see scoring.parallel_predictions. With by_search
+    the search-level part of a linear model's score is computed
+    once per search, see scoring.SearchScorer.
+
+    Returns:
+        The number of scored rows.
+    """
+
+    n_rows = 0
     header = ['ID', 'IsClick']
 
-    with open(dst, 'w') as f:
+    with open(dst, 'w', buffering=_WRITE_BUFFER_SIZE) as f:
         writer = csv.writer(f)
         writer.writerow(header)
 
-        with SparseDataset(dataset_filename) as dataset:
-            for sample_id, prediction in _stream_predictions(model, dataset):
-                row = (sample_id, prediction)
-                writer.writerow(row)
+        dataset_class = RawDataset if raw else SparseDataset
+
+        with dataset_class(dataset_filename) as dataset:
+            if n_workers > 1:
+                field_names = dataset.get_field_names('test') if raw else None
+                predictions = parallel_predictions(model, dataset, n_workers, field_names=field_names)
+            elif by_search:
+                predictions = _search_predictions(model, dataset.search_iterator(prefetch=prefetch))
+            else:
+                data = raw_iterator(dataset, 'test', prefetch=prefetch) if raw else dataset.iterator(prefetch=prefetch)
+                predictions = _stream_predictions(model, data)
+
+            for block in chunked(predictions, 10000):
+                writer.writerows(block)
+                n_rows += len(block)
+
+    return n_rows
+
+
+def _stream_predictions(model, data, batch_size=10000):
+    for batch in chunked(data, batch_size):
+        rows, sample_ids = zip(*batch)
+        predictions = model.predict_batch(rows)
+        yield from zip(sample_ids, predictions)
 
 
-def _stream_predictions(model, dataset):
-    for row, sample_id in dataset.iterator():
-        prediction = model.predict(row)
-        yield sample_id, prediction
+def _search_predictions(model, searches, batch_size=5000):
+    scorer = SearchScorer(model)
+    for batch in chunked(searches, batch_size):
+        split = [(search_part, [ad_part for ad_part, _ in ads]) for search_part, ads in batch]
+        for (_, ads), predictions in zip(batch, scorer.score_split(split)):
+            yield from zip((sample_id for _, sample_id in ads), predictions)
 
 
 if __name__ == '__main__':
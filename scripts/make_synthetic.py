@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import RawDataset
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.synthetic import SyntheticAvito
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('train', help='Name of a raw train dataset file to write')
+    parser.add_argument('test', help='Name of a raw test dataset file to write')
+    parser.add_argument('categories', help='Name of a JSON file to write the category snapshot to')
+    parser.add_argument('--train_rows', type=int, default=1000000, help='Number of train rows')
+    parser.add_argument('--test_rows', type=int, default=100000, help='Number of test rows')
+    parser.add_argument('--n_users', type=int, default=100000, help='Number of distinct users')
+    parser.add_argument('--n_ads', type=int, default=200000, help='Number of distinct ads')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--grouped', action='store_true',
+                        help='Write rows grouped by search, with search-level columns stored once per search')
+
+    args = parser.parse_args()
+
+    generator = SyntheticAvito(n_users=args.n_users, n_ads=args.n_ads, seed=args.seed)
+
+    write_dataset(generator.rows(args.train_rows, 'train'), args.train, args.grouped)
+    # Test searches follow train ones like in the competition data.
+    write_dataset(generator.rows(args.test_rows, 'test'), args.test, args.grouped)
+
+    with open(args.categories, 'w') as f:
+        json.dump(sorted(generator.categories().items()), f)
+
+    print('Generated {} train and {} test rows'.format(args.train_rows, args.test_rows))
+
+
+def write_dataset(rows, dst, grouped=False):
+    with RawDataset(dst, 'w', grouped=grouped) as ds:
+        for row in rows:
+            ds.append(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,51 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import csv
 import os
 import pickle
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from kaggle_avito_ctr.extraction import RawDataset, SparseDataset, make_test_query, make_train_query, make_val_query
-from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.checkpoint import Checkpointer, load_checkpoint, resume_iterator
+from kaggle_avito_ctr.counters import COUNTER_STORES
+from kaggle_avito_ctr.extraction import (RawDataset, SparseDataset, downsample_negatives, get_field_names,
+                                         make_test_query, make_train_query, make_val_query)
+from kaggle_avito_ctr.fm import FactorizationMachine, FieldAwareFactorizationMachine
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.metrics import format_metric
+from kaggle_avito_ctr.monitoring import ProgressiveValidation, TrainingMonitor
+from kaggle_avito_ctr.online_lr import MiniBatchLogisticRegression, OnlineLogisticRegression
 from kaggle_avito_ctr.preprocessing import Preprocessor
+from kaggle_avito_ctr.profiling import StageProfiler, profiled_stage
+from kaggle_avito_ctr.streaming import tee, transform_stream
+from kaggle_avito_ctr.utils import chunked
 from kaggle_avito_ctr.validation import evaluate
 
 
 def main():
+    configure_logging()
+
     parser = init_parser()
     args = parser.parse_args()
 
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume requires --checkpoint')
+
+    if args.resume and args.negative_rate is not None:
+        parser.error('--resume continues at the negative rate of the checkpoint, --negative_rate can\'t be given')
+
+    profiler = make_profiler(args.profile, args.profile_sample, args.profile_dir)
+
+    run(args, profiler)
+
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.format_table())
+        print('Profile saved to {}'.format(args.profile))
+
+
+def run(args, profiler=None):
     do_export = do_fitpp = do_process = do_fit = do_eval = False
 
     if args.export:
@@ -45,38 +76,63 @@ def main():
         if args.noeval:
             do_eval = False
 
-    if do_export:
+    # The preprocessor is fitted on a raw dataset file, otherwise
+    # rows can be streamed right from the DB.
+    stream_export = args.stream and do_export and not (args.format == 'train' and do_fitpp)
+
+    if do_export and not stream_export:
         print('Exporting dataset to {}'.format(args.raw_dataset))
-        export(args.raw_dataset, args.format, args.p_sample)
+        with profiled_stage(profiler, 'export') as stage:
+            stage.rows = export(args.raw_dataset, args.format, args.p_sample, args.grouped)
     else:
         print('Skipping dataset export')
 
     if args.format == 'train' and do_fitpp:
         print('Fitting preprocessor to {}'.format(args.preprocessor))
-        preprocessor = fit_preprocessor(args.raw_dataset)
+        with profiled_stage(profiler, 'fit_preprocessor') as stage:
+            preprocessor = fit_preprocessor(args.raw_dataset, stage)
         serialize(preprocessor, args.preprocessor)
     else:
         print('Skipping preprocessor fitting')
         preprocessor = deserialize(args.preprocessor)
 
+    if args.stream:
+        with profiled_stage(profiler, 'stream') as stage:
+            stream(args, preprocessor, stream_export, do_fit, do_eval, stage)
+        return
+
     if do_process:
         print('Preprocessing raw dataset {} to {}'.format(args.raw_dataset, args.dataset))
-        transform(args.raw_dataset, args.dataset, preprocessor, args.format)
+        with profiled_stage(profiler, 'transform') as stage:
+            stage.rows = transform(args.raw_dataset, args.dataset, preprocessor, args.format, args.grouped)
     else:
         print('Skipping raw dataset preprocessing')
 
     if args.format == 'train' and do_fit:
         print('Fitting model {} to dataset {}'.format(args.model, args.dataset))
-        model = fit(args.dataset)
+        checkpointer = make_checkpointer(args.checkpoint, args.checkpoint_rows, args.checkpoint_minutes)
+        model = make_model(args.model_type, args.batch_size, args.counter_store, args.count_threshold,
+                           args.admission_width)
+        monitor = make_monitor(args.metrics, args.metrics_rows)
+        validation = ProgressiveValidation(args.progressive_last_n) if args.progressive else None
+        with profiled_stage(profiler, 'fit') as stage:
+            model, progressive_score = fit(args.dataset, model, checkpointer, args.resume, monitor, validation,
+                                           args.prefetch, args.negative_rate)
+            stage.rows = model.n_rows
         serialize(model, args.model)
     else:
         print('Skipping model fitting')
         model = deserialize(args.model)
+        progressive_score = None
     print_model_summary(model)
 
-    if args.format != 'test' and do_eval:
+    if progressive_score is not None:
+        print_progressive_score(progressive_score)
+
+    if args.format != 'test' and do_eval and progressive_score is None:
         print('Evaluating model {}'.format(args.model))
-        evaluate_model(model, args.dataset)
+        with profiled_stage(profiler, 'evaluate') as stage:
+            stage.rows = evaluate_model(model, args.dataset, args.prefetch)
     else:
         print('Skipping model evaluation')
 
@@ -105,6 +161,49 @@ def init_parser():
 
     parser.add_argument('--p_sample', type=float, default=1.0,
                         help='Probability to include each row from the original dataset.')
+    parser.add_argument('--model_type', choices=['lr', 'fm', 'ffm'], default='lr',
+                        help='Logistic regression or (field-aware) factorization machine.')
+    parser.add_argument('--batch_size', type=int,
+                        help='Train a vectorized model on mini-batches of N rows.')
+    parser.add_argument('--counter_store', choices=sorted(COUNTER_STORES), default='dict',
+                        help='Storage of ad and user counters for online CTR features.')
+    parser.add_argument('--count_threshold', type=int,
+                        help='Allocate a weight only after a feature has been seen N times.')
+    parser.add_argument('--admission_width', type=int,
+                        help='Width of the sketch counting features below --count_threshold.')
+    parser.add_argument('--negative_rate', type=float,
+                        help='Train on all clicks and a deterministic fraction R of non-clicks. '
+                             'Predictions are corrected for the sampling.')
+
+    parser.add_argument('--checkpoint', help='Name of a file to periodically save training state to')
+    parser.add_argument('--checkpoint_rows', type=int, help='Save a checkpoint every N rows')
+    parser.add_argument('--checkpoint_minutes', type=float, help='Save a checkpoint every T minutes')
+    parser.add_argument('--metrics', help='Name of a file to write JSON lines of training metrics to')
+    parser.add_argument('--metrics_rows', type=int, default=100000, help='Report training metrics every N rows')
+    parser.add_argument('--resume', action='store_true', help='Continue model training from the checkpoint')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream rows from export through preprocessing to training or scoring '
+                             'without intermediate files.')
+    parser.add_argument('--stream_workers', type=int, default=1,
+                        help='Number of preprocessing processes in streaming mode.')
+    parser.add_argument('--tee', action='store_true',
+                        help='Still write raw and preprocessed datasets in streaming mode.')
+    parser.add_argument('--grouped', action='store_true',
+                        help='Write raw and preprocessed datasets grouped by search, with search-level '
+                             'columns and features stored once per search. Either layout is read.')
+    parser.add_argument('--submission', help='Name of a submission CSV file to write in test streaming mode.')
+    parser.add_argument('--progressive', action='store_true',
+                        help='Evaluate with progressive validation while training instead of a separate pass.')
+    parser.add_argument('--progressive_last_n', type=int,
+                        help='Also report progressive validation logloss of the final N training rows.')
+    parser.add_argument('--prefetch', type=int,
+                        help='Read and decode up to N blocks of dataset rows ahead in a background thread.')
+    parser.add_argument('--profile',
+                        help='Name of a JSON file to write wall and CPU time, rows/sec, peak RSS '
+                             'and a sampled per-agent breakdown of every stage to.')
+    parser.add_argument('--profile_sample', type=int, default=100,
+                        help='Time every N-th call of per-row code when profiling.')
+    parser.add_argument('--profile_dir', help='Also dump cProfile stats of every stage to this directory.')
 
     return parser
 
@@ -120,34 +219,113 @@ def deserialize(filename):
     return obj
 
 
-def export(dst, part, p_sample):
+def export(dst, part, p_sample, grouped=False):
+    """Returns the number of exported rows."""
+    n_rows = 0
+    with RawDataset(dst, 'w', grouped=grouped) as ds:
+        for row in make_query(part, p_sample):
+            ds.append(row)
+            n_rows += 1
+    return n_rows
+
+
+def make_query(part, p_sample):
 
     kwargs = {
         'p_sample': p_sample,
     }
 
-    with RawDataset(dst, 'w') as ds:
-        if part == 'train':
-            q = make_train_query(**kwargs)
-        elif part == 'test':
-            q = make_test_query(**kwargs)
-        elif part == 'eval':
-            q = make_val_query(**kwargs)
-
-        for row in q:
-            ds.append(row)
-
-
-def fit_preprocessor(dataset):
-    X_factory = lambda: RawDataset(dataset).sparse_iterator('train')
+    if part == 'train':
+        q = make_train_query(**kwargs)
+    elif part == 'test':
+        q = make_test_query(**kwargs)
+    elif part == 'eval':
+        q = make_val_query(**kwargs)
+
+    return q
+
+
+def stream(args, preprocessor, from_db, do_fit, do_eval, stage=None):
+    """
+    Run the stages after preprocessor fitting as one pass over the data.
+
+    Raw rows come from the DB or the raw dataset file and are
+    preprocessed by a pool of workers with bounded queues, so memory
+    stays flat when the consumer is slower than the producers.
+    Training data is evaluated with progressive validation.
+    """
+
+    # Negatives are only dropped from a stream to train on.
+    negative_rate = args.negative_rate if args.format == 'train' and do_fit else None
+
+    with contextlib.ExitStack() as stack:
+        if from_db:
+            print('Streaming rows from the DB')
+            rows = (list(row) for row in make_query(args.format, args.p_sample))
+            if args.tee:
+                rows = tee(rows, stack.enter_context(RawDataset(args.raw_dataset, 'w', grouped=args.grouped)))
+            if negative_rate is not None:
+                rows = downsample_negatives(rows, negative_rate)
+        else:
+            print('Streaming rows from {}'.format(args.raw_dataset))
+            rows = stack.enter_context(RawDataset(args.raw_dataset)).iterator(prefetch=args.prefetch,
+                                                                               negative_rate=negative_rate)
+
+        sparse_dataset = None
+        if args.tee:
+            sparse_dataset = stack.enter_context(SparseDataset(args.dataset, 'w', grouped=args.grouped))
+        data = transform_stream(rows, preprocessor, get_field_names(args.format), args.stream_workers,
+                                sparse_dataset=sparse_dataset)
+        if stage is not None:
+            data = stage.count(data)
+
+        if args.format == 'train' and do_fit:
+            print('Fitting model {}'.format(args.model))
+            checkpointer = make_checkpointer(args.checkpoint, args.checkpoint_rows, args.checkpoint_minutes)
+            model = make_model(args.model_type, args.batch_size, args.counter_store, args.count_threshold,
+                               args.admission_width)
+            monitor = make_monitor(args.metrics, args.metrics_rows)
+            validation = ProgressiveValidation(args.progressive_last_n)
+            score = model.fit(data, checkpointer=checkpointer, monitor=monitor, validation=validation,
+                              negative_rate=negative_rate)
+            serialize(model, args.model)
+            print_model_summary(model)
+            print_progressive_score(score)
+        elif args.format == 'test':
+            if args.submission is None:
+                raise ValueError('--submission is required to score a test stream')
+            print('Writing submission {}'.format(args.submission))
+            write_submission(deserialize(args.model), data, args.submission)
+        elif do_eval:
+            print('Evaluating model {}'.format(args.model))
+            print_metrics(evaluate(deserialize(args.model), data))
+
+
+def write_submission(model, data, dst, batch_size=10000):
+    with open(dst, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'IsClick'])
+        for batch in chunked(data, batch_size):
+            rows, sample_ids = zip(*batch)
+            writer.writerows(zip(sample_ids, model.predict_batch(rows)))
+
+
+def fit_preprocessor(dataset, stage=None):
+    """stage, if given, counts rows read by both passes of fitting."""
+    if stage is not None:
+        X_factory = lambda: stage.count(RawDataset(dataset).sparse_iterator('train'))
+    else:
+        X_factory = lambda: RawDataset(dataset).sparse_iterator('train')
     preprocessor = Preprocessor()
     preprocessor.fit(X_factory)
     return preprocessor
 
 
-def transform(src, dst, preprocessor, part):
+def transform(src, dst, preprocessor, part, grouped=False):
+    """Returns the number of transformed rows."""
+    i = -1
     with RawDataset(src) as src_ds:
-        with SparseDataset(dst, 'w') as dst_ds:
+        with SparseDataset(dst, 'w', grouped=grouped) as dst_ds:
             for (i, row) in enumerate(src_ds.sparse_iterator(part)):
                 transformed_row = preprocessor.transform(row)
                 dst_ds.append(transformed_row)
@@ -157,11 +335,58 @@ def transform(src, dst, preprocessor, part):
 
     print()
 
+    return i + 1
 
-def fit(dataset):
-    model = OnlineLogisticRegression()
+
+def fit(dataset, model, checkpointer=None, resume=False, monitor=None, validation=None, prefetch=None,
+        negative_rate=None):
+    """Returns the fitted model and progressive validation results if requested."""
     with SparseDataset(dataset) as X:
-        model.fit(X.iterator())
+        if resume:
+            model = load_checkpoint(checkpointer.filename)
+            print('Resuming from row {}'.format(model.n_rows))
+            data = resume_iterator(X, model, prefetch=prefetch)
+            score = model.fit(data, checkpointer=checkpointer, resume=True, monitor=monitor, validation=validation)
+        else:
+            data = X.iterator(prefetch=prefetch, negative_rate=negative_rate)
+            score = model.fit(data, checkpointer=checkpointer, monitor=monitor, validation=validation,
+                              negative_rate=negative_rate)
+    return model, score
+
+
+def make_checkpointer(filename, every_n_rows=None, every_minutes=None):
+    if filename is None:
+        return None
+    every_seconds = every_minutes * 60 if every_minutes is not None else None
+    return Checkpointer(filename, every_n_rows=every_n_rows, every_seconds=every_seconds)
+
+
+def make_monitor(filename, every_n_rows):
+    if filename is None:
+        return None
+    return TrainingMonitor(open(filename, 'a'), every_n_rows=every_n_rows)
+
+
+def make_profiler(filename, sample_every=100, cprofile_dir=None):
+    if filename is None:
+        return None
+    return StageProfiler(sample_every=sample_every, cprofile_dir=cprofile_dir)
+
+
+def make_model(model_type='lr', batch_size=None, counter_store='dict', count_threshold=None, admission_width=None):
+    kwargs = {
+        'counter_store': COUNTER_STORES[counter_store],
+        'count_threshold': count_threshold,
+        'admission_width': admission_width,
+    }
+    if model_type == 'fm':
+        model = FactorizationMachine(**kwargs)
+    elif model_type == 'ffm':
+        model = FieldAwareFactorizationMachine(**kwargs)
+    elif batch_size:
+        model = MiniBatchLogisticRegression(batch_size, **kwargs)
+    else:
+        model = OnlineLogisticRegression(**kwargs)
     return model
 
 
@@ -173,10 +398,35 @@ def print_model_summary(model):
         print('{:25} | {:5} | {:10.5}'.format(f, i, w))
 
 
-def evaluate_model(model, dataset_filename):
+def print_progressive_score(score):
+    print('Progressive validation score is {} on {} rows'.format(format_metric(score['logloss']), score['rows']))
+    if 'last_logloss' in score:
+        print('Progressive validation score of the last {} rows is {}'
+              .format(score['last_rows'], format_metric(score['last_logloss'])))
+
+
+def evaluate_model(model, dataset_filename, prefetch=None):
+    """Returns the number of evaluated rows."""
     with SparseDataset(dataset_filename) as dataset:
-        score = evaluate(model, dataset.iterator())
-    print('Evaluation score is {:.5}'.format(score))
+        metrics = evaluate(model, dataset.iterator(prefetch=prefetch))
+    print_metrics(metrics)
+    return metrics.n
+
+
+def print_metrics(metrics):
+    print('Evaluation score is {}'.format(format_metric(metrics.logloss())))
+    print('AUC is {}'.format(format_metric(metrics.auc())))
+    print_calibration(metrics.calibration())
+
+
+def print_calibration(curve):
+    print('Calibration:')
+    print('{:>21} | {:>9} | {:>10} | {:>10}'.format('predicted range', 'rows', 'mean pred', 'ctr'))
+    print('-' * 60)
+    for bucket in curve:
+        print('{:>10.5f}-{:<10.5f} | {:9} | {:10.5f} | {:10.5f}'.format(
+            bucket['min_prediction'], bucket['max_prediction'], bucket['rows'],
+            bucket['mean_prediction'], bucket['ctr']))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.fm import FactorizationMachine, FieldAwareFactorizationMachine
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.metrics import format_metric
+from kaggle_avito_ctr.online_lr import MiniBatchLogisticRegression, OnlineLogisticRegression
+from kaggle_avito_ctr.search import DecodedDataset, grid_configs, random_configs, run_search
+
+
+MODEL_CLASSES = {
+    'lr': OnlineLogisticRegression,
+    'minibatch': MiniBatchLogisticRegression,
+    'fm': FactorizationMachine,
+    'ffm': FieldAwareFactorizationMachine,
+}
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', help='Name of a file containing the training dataset')
+    parser.add_argument('dst', help='Name of a CSV file to write ranked results to')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=SPEC',
+                        help='Search space of a model or fit parameter: comma separated values, '
+                             'or uniform:LOW:HIGH / loguniform:LOW:HIGH with --n_random')
+    parser.add_argument('--model_type', choices=sorted(MODEL_CLASSES), default='lr', help='Model to tune')
+    parser.add_argument('--n_random', type=int, help='Sample N random configurations instead of the full grid')
+    parser.add_argument('--seed', type=int, default=0, help='Random search seed')
+    parser.add_argument('--workers', type=int, help='Number of concurrent fits, defaults to the CPU count')
+    parser.add_argument('--limit', type=int, help='Train on first N rows only')
+    parser.add_argument('--last_n', type=int, help='Rank on progressive logloss of the final N rows')
+    parser.add_argument('--early_stop_rows', type=int,
+                        help='Compare configurations every N rows and stop clear losers')
+    parser.add_argument('--early_stop_tolerance', type=float, default=0.01,
+                        help='Relative logloss margin over the best configuration to stop at')
+    parser.add_argument('--decoded', help='Directory of the decoded dataset, reused if it exists')
+
+    args = parser.parse_args()
+
+    space = dict(parse_param(param) for param in args.param)
+    if args.n_random:
+        configs = list(random_configs(space, args.n_random, args.seed))
+    else:
+        configs = list(grid_configs(space))
+
+    decoded = args.decoded or args.dataset + '.decoded'
+    source = {'dataset': os.path.abspath(args.dataset), 'limit': args.limit}
+    if DecodedDataset.load_source(decoded) != source:
+        print('Decoding {} to {}'.format(args.dataset, decoded))
+        with SparseDataset(args.dataset) as dataset:
+            DecodedDataset.from_iterator(dataset.iterator(limit=args.limit), source).save(decoded)
+
+    print('Running {} configurations'.format(len(configs)))
+
+    results = run_search(decoded, MODEL_CLASSES[args.model_type], configs, n_workers=args.workers,
+                         limit=args.limit, last_n=args.last_n, early_stop_rows=args.early_stop_rows,
+                         early_stop_tolerance=args.early_stop_tolerance)
+
+    write_results(results, sorted(space), args.dst)
+
+    print('Best configuration: {} with score {}'.format(results[0]['config'], format_metric(results[0]['score'])))
+
+
+def parse_param(param):
+    name, spec = param.split('=', 1)
+    parts = spec.split(':')
+    if parts[0] in ('uniform', 'loguniform'):
+        return name, (parts[0], float(parts[1]), float(parts[2]))
+    return name, [parse_value(value) for value in spec.split(',')]
+
+
+def parse_value(value):
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    return value
+
+
+def write_results(results, param_names, dst):
+    header = ['rank', 'score', 'logloss', 'last_logloss', 'rows', 'stopped_at', 'seconds'] + param_names
+
+    with open(dst, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for rank, result in enumerate(results, 1):
+            row = [rank] + [result[name] for name in header[1:7]]
+            row += [result['config'].get(name, None) for name in param_names]
+            writer.writerow(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import pickle
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.extraction import get_field_names
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.scoring import SearchScorer, load_model
+from kaggle_avito_ctr.service import ScoringService, make_server
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('preprocessor', help='Pickled preprocessor')
+    parser.add_argument('model', help='Name of a pickled model or an exported model directory')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--unix_socket', help='Listen on a Unix socket instead of TCP')
+    parser.add_argument('--categories', help='JSON category snapshot to use instead of the pickled one')
+    parser.add_argument('--max_batch_rows', type=int, default=0,
+                        help='Coalesce concurrent requests into batches of up to N rows (0 disables)')
+    parser.add_argument('--max_wait_ms', type=float, default=2,
+                        help='Max time to wait for more requests to fill a batch')
+    parser.add_argument('--search_level_scoring', action='store_true',
+                        help='Compute the search-level part of the score once per search (linear models only)')
+    parser.add_argument('--search_cache_size', type=int, default=1024,
+                        help='Number of recent search contexts to keep partial scores for')
+
+    args = parser.parse_args()
+
+    with open(args.preprocessor, 'rb') as f:
+        preprocessor = pickle.load(f)
+
+    if args.categories:
+        preprocessor.category_feature_extractor.load_snapshot(args.categories)
+
+    model = load_model(args.model)
+
+    search_scorer = None
+    if args.search_level_scoring:
+        search_scorer = SearchScorer(model, cache_size=args.search_cache_size)
+
+    service = ScoringService(preprocessor, model, get_field_names('test'),
+                             max_batch_rows=args.max_batch_rows, max_wait_ms=args.max_wait_ms,
+                             search_scorer=search_scorer)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+
+    print('Serving on {}'.format(args.unix_socket or '{}:{}'.format(args.host, args.port)))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from kaggle_avito_ctr.globals import configure_logging
+from kaggle_avito_ctr.materialization import CounterMaterializer
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d')
+
+
+def main():
+    configure_logging()
+
+    parser = argparse.ArgumentParser(description='Maintain ad and user history counters')
+    parser.add_argument('action', choices=['refresh', 'snapshot'],
+                        help='Count new days of searches or set counters as of a date')
+    parser.add_argument('--date', type=parse_date,
+                        help='YYYY-MM-DD. Refresh: stop before this day (by default the last day with searches, '
+                             'which may still be loading). '
+                             'Snapshot: count searches before this day (COUNTER_START_DATE by default)')
+
+    args = parser.parse_args()
+
+    materializer = CounterMaterializer()
+
+    if args.action == 'refresh':
+        watermark = materializer.refresh(until=args.date)
+    else:
+        watermark = materializer.snapshot(as_of=args.date)
+
+    if watermark is None:
+        print('No searches to count')
+    else:
+        print('Counters include searches before {}'.format(watermark.date()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kaggle_avito_ctr.extraction import RawDataset, SparseDataset
+from kaggle_avito_ctr.preprocessing import Preprocessor
+from kaggle_avito_ctr.synthetic import SyntheticAvito
+
+
+@pytest.fixture(scope='session')
+def sparse_train(tmp_path_factory):
+    """Name of a preprocessed synthetic train dataset of 30000 rows."""
+    workdir = tmp_path_factory.mktemp('synthetic')
+    raw_filename = str(workdir / 'train_raw.gz')
+    sparse_filename = str(workdir / 'train.gz')
+
+    generator = SyntheticAvito(seed=0)
+    _write(generator.rows(30000, 'train'), RawDataset(raw_filename, 'w'))
+
+    preprocessor = Preprocessor(generator.categories())
+    preprocessor.fit(lambda: RawDataset(raw_filename).sparse_iterator('train'))
+
+    rows = (preprocessor.transform(row) for row in RawDataset(raw_filename).sparse_iterator('train'))
+    _write(rows, SparseDataset(sparse_filename, 'w'))
+
+    return sparse_filename
+
+
+def _write(rows, dataset):
+    with dataset:
+        for row in rows:
+            dataset.append(row)
+    # Leaving the context only flushes, the gzip trailer is written on close.
+    dataset.file.close()
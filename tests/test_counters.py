@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from kaggle_avito_ctr.counters import ArrayCounterStore, CountMinCounterStore, DictCounterStore
+
+
+def _impressions(n, n_keys, seed=0):
+    """(key, is_click) pairs with Zipf-like key popularity and a per-key click rate."""
+    rng = np.random.RandomState(seed)
+    keys = np.minimum(rng.zipf(1.2, n), n_keys) - 1
+    ctrs = rng.uniform(0, 0.1, n_keys)
+    clicks = rng.random_sample(n) < ctrs[keys]
+    return list(zip(keys.tolist(), clicks.tolist()))
+
+
+def _count(store_factory, impressions):
+    impression_counts = store_factory()
+    click_counts = store_factory()
+    for key, is_click in impressions:
+        impression_counts.increment(key)
+        if is_click:
+            click_counts.increment(key)
+    return impression_counts, click_counts
+
+
+def _ctr(impression_counts, click_counts, key):
+    # Like the online CTR features of OnlineLogisticRegression.
+    return click_counts.get(key) / (10 + impression_counts.get(key))
+
+
+def test_array_store_matches_dict_store():
+    impressions = _impressions(50000, 5000)
+    exact = _count(DictCounterStore, impressions)
+    dense = _count(ArrayCounterStore, impressions)
+
+    for key in range(5000):
+        assert dense[0].get(key) == exact[0].get(key)
+        assert dense[1].get(key) == exact[1].get(key)
+
+
+def test_array_store_rejects_negative_ids():
+    counts = ArrayCounterStore()
+    counts.increment(3)
+
+    with pytest.raises(ValueError):
+        counts.increment(-1)
+    with pytest.raises(ValueError):
+        counts.get(-1)
+
+
+def test_sketch_ctr_error_within_bound():
+    epsilon, delta = 1e-3, 0.01
+    n_keys = 20000
+    impressions = _impressions(200000, n_keys)
+
+    exact_impressions, exact_clicks = _count(DictCounterStore, impressions)
+    sketch_impressions, sketch_clicks = _count(
+        lambda: CountMinCounterStore.from_error_bound(epsilon, delta), impressions)
+
+    impression_bound = sketch_impressions.error_bound()
+    click_bound = sketch_clicks.error_bound()
+
+    n_exceeded = 0
+
+    for key in range(n_keys):
+        impression_error = sketch_impressions.get(key) - exact_impressions.get(key)
+        click_error = sketch_clicks.get(key) - exact_clicks.get(key)
+
+        # A sketch never underestimates.
+        assert impression_error >= 0 and click_error >= 0
+
+        if impression_error > impression_bound or click_error > click_bound:
+            n_exceeded += 1
+            continue
+
+        # Overestimates of at most the bounds move clicks / (10 + impressions) by at most this much.
+        ctr_bound = max(impression_bound, click_bound) / (10 + exact_impressions.get(key))
+        ctr_error = abs(_ctr(sketch_impressions, sketch_clicks, key) - _ctr(exact_impressions, exact_clicks, key))
+        assert ctr_error <= ctr_bound
+
+    # Each count exceeds its bound with probability at most delta.
+    assert n_exceeded <= 2 * delta * n_keys
+
+
+def test_sketch_batch_updates_match_single_updates():
+    keys = np.array([key for key, _ in _impressions(20000, 5000)] + [2 ** 32 - 1, 2 ** 31 - 1], dtype=np.int64)
+    single = CountMinCounterStore(width=1000)
+    for key in keys:
+        single.increment(int(key))
+
+    batch = CountMinCounterStore(width=1000)
+    unique_keys, counts = np.unique(keys, return_counts=True)
+    batch.increment_many(unique_keys, counts)
+
+    assert batch.total == single.total
+    assert list(batch.get_many(unique_keys)) == [single.get(int(key)) for key in unique_keys]
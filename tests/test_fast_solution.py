@@ -0,0 +1,32 @@
+import numpy as np
+
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.fast_solution import HashingLogisticRegression, hash_features, raw_to_sparse
+from kaggle_avito_ctr.metrics import StreamingMetrics
+from kaggle_avito_ctr.validation import evaluate
+
+
+def test_ids_are_hashed_as_categories():
+    sparse_row = [('ad_id', 0, 164412), ('user_id', 0, 92654)]
+    raw_row = raw_to_sparse([('ad_id', 164412), ('user_id', 92654)])
+
+    sparse_buckets, sparse_values, _ = hash_features([sparse_row], 20)
+    raw_buckets, raw_values, _ = hash_features([raw_row], 20)
+
+    assert list(sparse_buckets) == list(raw_buckets)
+    assert list(sparse_values) == list(raw_values) == [1, 1]
+
+
+def test_fit_on_sparse_dataset(sparse_train):
+    model = HashingLogisticRegression()
+    model.fit(SparseDataset(sparse_train).iterator(skip_nth=5))
+
+    train_ctr = np.mean([y for _, y in SparseDataset(sparse_train).iterator(skip_nth=5)])
+    ys = np.array([y for _, y in SparseDataset(sparse_train).iterator(every_nth=5)], dtype=np.float64)
+    base_rate = StreamingMetrics()
+    base_rate.update(np.full(len(ys), train_ctr), ys)
+
+    metrics = evaluate(model, SparseDataset(sparse_train).iterator(every_nth=5))
+
+    # Ids multiplied into the score as values push predictions to 0 and the loss several times up.
+    assert metrics.logloss() < 1.1 * base_rate.logloss()
@@ -0,0 +1,81 @@
+import numpy as np
+
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.fm import FactorizationMachine, FieldAwareFactorizationMachine
+from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.utils import sigmoid
+
+
+class ChunkedLogloss(object):
+    """Progressive validation logloss of every chunk_size rows."""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.losses = []
+
+    def observe(self, y_hat, y):
+        y_hat = min(max(y_hat, 1e-9), 1 - 1e-9)
+        self.losses.append(-(y * np.log(y_hat) + (1 - y) * np.log(1 - y_hat)))
+
+    def result(self):
+        losses = np.array(self.losses)
+        return [losses[i:i + self.chunk_size].mean() for i in range(0, len(losses), self.chunk_size)]
+
+
+def progressive_logloss(model, filename, n_rows):
+    validation = ChunkedLogloss(5000)
+    model.fit(SparseDataset(filename).iterator(limit=n_rows), validation=validation)
+    return validation.result()
+
+
+def test_fm_progressive_loss_stays_close_to_lr(sparse_train):
+    lr_losses = progressive_logloss(OnlineLogisticRegression(), sparse_train, 30000)
+    fm = FactorizationMachine()
+    fm_losses = progressive_logloss(fm, sparse_train, 30000)
+
+    # Past the first chunks a diverging model loses several times more than LR.
+    for lr_loss, fm_loss in zip(lr_losses[1:], fm_losses[1:]):
+        assert fm_loss < 1.5 * lr_loss
+    assert np.abs(fm.factors).max() < 1
+
+
+def test_ffm_progressive_loss_stays_close_to_lr(sparse_train):
+    lr_losses = progressive_logloss(OnlineLogisticRegression(), sparse_train, 10000)
+    ffm_losses = progressive_logloss(FieldAwareFactorizationMachine(), sparse_train, 10000)
+
+    for lr_loss, ffm_loss in zip(lr_losses[1:], ffm_losses[1:]):
+        assert ffm_loss < 1.5 * lr_loss
+
+
+def test_ffm_update_accumulates_features_of_one_field():
+    model = FieldAwareFactorizationMachine(k=2, lambda_v=0, init_std=0.5)
+    model._init_weights()
+    x = [('intercept', 0, 1), ('ad_parameter', 1, 1), ('ad_parameter', 2, 1), ('ad_parameter', 3, 2),
+         ('hour', 5, 1)]
+    y = 1
+
+    columns, values = model._allocate(x)
+    fields = model._get_fields(x)
+    before = model.factors.copy()
+
+    z = np.dot(model.coef[columns], values)
+    for i in range(len(x)):
+        for j in range(i + 1, len(x)):
+            z += np.dot(before[columns[i], fields[j]], before[columns[j], fields[i]]) * values[i] * values[j]
+    error = sigmoid(z) - y
+
+    expected = {}
+    for i in range(len(x)):
+        for j in range(len(x)):
+            if i != j:
+                cell = (columns[i], fields[j])
+                expected[cell] = expected.get(cell, 0) + error * values[i] * values[j] * before[columns[j], fields[i]]
+
+    model._update(x, y)
+
+    for (column, field), grad in expected.items():
+        step = model.alpha_v * grad / (1 + np.abs(grad))
+        assert np.allclose(model.factors[column, field], before[column, field] - step)
+
+    # A factor towards the feature's own field, the only one of it, stays.
+    assert np.array_equal(model.factors[columns[0], fields[0]], before[columns[0], fields[0]])
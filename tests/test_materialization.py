@@ -0,0 +1,68 @@
+import datetime
+
+import sqlalchemy as sa
+
+from kaggle_avito_ctr.materialization import CounterMaterializer
+
+
+DAY = datetime.timedelta(days=1)
+FIRST_DAY = datetime.datetime(2015, 5, 1)
+
+# (search_id, search_date, user_id)
+SEARCHES = [
+    (1, FIRST_DAY + datetime.timedelta(hours=10), 1),
+    (2, FIRST_DAY + datetime.timedelta(hours=12), 2),
+    (3, FIRST_DAY + DAY + datetime.timedelta(hours=9), 1),
+    (4, FIRST_DAY + 2 * DAY + datetime.timedelta(hours=8), 1),
+]
+# (search_id, ad_id, object_type, is_click)
+STREAM = [
+    (1, 10, 3, 1), (1, 11, 3, 0), (1, 20, 1, 0),
+    (2, 10, 3, 0),
+    (3, 11, 3, 1),
+    (4, 10, 3, 1),
+]
+
+
+def _make_engine(path):
+    engine = sa.create_engine('sqlite:///{}'.format(path))
+    with engine.begin() as conn:
+        # Only the columns counted, the models use postgresql types.
+        conn.execute('CREATE TABLE ads_info (ad_id INTEGER PRIMARY KEY, n_impressions INTEGER, n_clicks INTEGER)')
+        conn.execute('CREATE TABLE user_info '
+                     '(user_id INTEGER PRIMARY KEY, n_context_impressions INTEGER, n_context_clicks INTEGER)')
+        conn.execute('CREATE TABLE search_info (search_id INTEGER PRIMARY KEY, search_date DATETIME, user_id INTEGER)')
+        conn.execute('CREATE TABLE train_search_stream '
+                     '(search_id INTEGER, ad_id INTEGER, object_type INTEGER, is_click INTEGER)')
+        conn.execute('INSERT INTO ads_info (ad_id) VALUES (10), (11), (20)')
+        conn.execute('INSERT INTO user_info (user_id) VALUES (1), (2)')
+        for search_id, search_date, user_id in SEARCHES:
+            conn.execute(sa.text('INSERT INTO search_info VALUES (:search_id, :search_date, :user_id)'),
+                         search_id=search_id, search_date=str(search_date), user_id=user_id)
+        for row in STREAM:
+            conn.execute('INSERT INTO train_search_stream VALUES (?, ?, ?, ?)', row)
+    return engine
+
+
+def _counters(engine):
+    with engine.connect() as conn:
+        ads = {ad_id: (n_impressions, n_clicks) for ad_id, n_impressions, n_clicks
+               in conn.execute('SELECT ad_id, n_impressions, n_clicks FROM ads_info')}
+        users = {user_id: (n_impressions, n_clicks) for user_id, n_impressions, n_clicks
+                 in conn.execute('SELECT user_id, n_context_impressions, n_context_clicks FROM user_info')}
+    return ads, users
+
+
+def test_refresh_and_snapshot_on_sqlite(tmp_path):
+    engine = _make_engine(tmp_path / 'avito.sqlite')
+    materializer = CounterMaterializer(engine)
+
+    # The day of the last search may still be loading and is left out.
+    assert materializer.refresh() == FIRST_DAY + 2 * DAY
+    assert _counters(engine) == ({10: (2, 1), 11: (2, 1), 20: (None, None)}, {1: (3, 2), 2: (1, 0)})
+
+    assert materializer.snapshot(as_of=FIRST_DAY + DAY) == FIRST_DAY + DAY
+    assert _counters(engine) == ({10: (2, 1), 11: (1, 0), 20: (None, None)}, {1: (2, 1), 2: (1, 0)})
+
+    assert materializer.refresh(until=FIRST_DAY + 3 * DAY) == FIRST_DAY + 3 * DAY
+    assert _counters(engine) == ({10: (3, 2), 11: (2, 1), 20: (None, None)}, {1: (4, 3), 2: (1, 0)})
@@ -0,0 +1,41 @@
+import copy
+import pickle
+
+import numpy as np
+
+from kaggle_avito_ctr.checkpoint import Checkpointer, load_checkpoint
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.metrics import StreamingMetrics
+from kaggle_avito_ctr.online_lr import MiniBatchLogisticRegression
+from kaggle_avito_ctr.validation import evaluate
+
+
+def test_minibatch_beats_base_rate(sparse_train):
+    model = MiniBatchLogisticRegression()
+    model.fit(SparseDataset(sparse_train).iterator(skip_nth=5))
+
+    train_ctr = np.mean([y for _, y in SparseDataset(sparse_train).iterator(skip_nth=5)])
+    ys = np.array([y for _, y in SparseDataset(sparse_train).iterator(every_nth=5)], dtype=np.float64)
+    base_rate = StreamingMetrics()
+    base_rate.update(np.full(len(ys), train_ctr), ys)
+
+    metrics = evaluate(model, SparseDataset(sparse_train).iterator(every_nth=5))
+
+    assert metrics.logloss() < base_rate.logloss()
+
+
+def test_admission_sketch_is_kept_in_checkpoints_only(sparse_train, tmp_path):
+    rows = list(SparseDataset(sparse_train).iterator(limit=10000))
+    filename = str(tmp_path / 'checkpoint.pkl')
+
+    full = MiniBatchLogisticRegression(count_threshold=5, admission_width=2 ** 16)
+    full.fit(copy.deepcopy(rows))
+
+    partial = MiniBatchLogisticRegression(count_threshold=5, admission_width=2 ** 16)
+    partial.fit(copy.deepcopy(rows[:5000]), checkpointer=Checkpointer(filename, every_n_rows=5000, fork=False))
+    assert pickle.loads(pickle.dumps(partial))._occurrences is None
+
+    resumed = load_checkpoint(filename)
+    resumed.fit(copy.deepcopy(rows[5000:]), resume=True)
+
+    assert np.array_equal(resumed.coef, full.coef)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.fm import FactorizationMachine, FieldAwareFactorizationMachine
+from kaggle_avito_ctr.online_lr import MiniBatchLogisticRegression, OnlineLogisticRegression
+
+
+@pytest.mark.parametrize('model_class', [
+    OnlineLogisticRegression, MiniBatchLogisticRegression, FactorizationMachine, FieldAwareFactorizationMachine,
+])
+def test_csr_batch_matches_rows(sparse_train, model_class):
+    model = model_class()
+    model.fit(SparseDataset(sparse_train).iterator(limit=2000))
+
+    rows = [x for x, _ in SparseDataset(sparse_train).iterator(offset=2000, limit=100)]
+    X = _feature_index(model).transform(rows)
+
+    assert np.allclose(model.predict_batch(X), model.predict_batch(rows))
+    assert np.allclose(model.predict_batch(X), [model.predict(x) for x in rows])
+
+
+def _feature_index(model):
+    """Column numbering of CSR batches the model takes."""
+    if not hasattr(model, 'feature_index'):
+        feature_index, _ = model._get_scoring_weights()
+        return feature_index
+    return model.feature_index
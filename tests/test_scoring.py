@@ -0,0 +1,23 @@
+import numpy as np
+
+from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.scoring import SearchScorer
+
+
+def _linear_model():
+    model = OnlineLogisticRegression()
+    model._init_weights()
+    model.weights['intercept'][0] = -3
+    model.weights['hour'][1] = 0.5
+    model.weights['hour'][2] = -0.5
+    model.weights['ad_position'][1] = 1
+    return model
+
+
+def test_search_cache_is_keyed_by_context():
+    model = _linear_model()
+    scorer = SearchScorer(model, cache_size=16)
+
+    for hour in [1, 2, 1]:
+        xs = [[('intercept', 0, 1), ('hour', hour, 1), ('ad_position', position, 1)] for position in [1, 7]]
+        assert np.allclose(scorer.score('search', xs), model.predict_batch(xs))
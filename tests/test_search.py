@@ -0,0 +1,16 @@
+from kaggle_avito_ctr.extraction import SparseDataset
+from kaggle_avito_ctr.search import DecodedDataset
+
+
+def test_decoded_dataset_keeps_its_source(sparse_train, tmp_path):
+    path = str(tmp_path / 'decoded')
+    source = {'dataset': sparse_train, 'limit': 100}
+    assert DecodedDataset.load_source(path) is None
+
+    DecodedDataset.from_iterator(SparseDataset(sparse_train).iterator(limit=100), source).save(path)
+
+    assert DecodedDataset.load_source(path) == source
+    decoded = DecodedDataset.load(path)
+    assert len(decoded) == 100
+    for (x, y), (expected_x, expected_y) in zip(decoded.iterator(), SparseDataset(sparse_train).iterator(limit=100)):
+        assert x == [tuple(feature) for feature in expected_x] and y == expected_y
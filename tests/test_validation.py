@@ -0,0 +1,18 @@
+from kaggle_avito_ctr.online_lr import OnlineLogisticRegression
+from kaggle_avito_ctr.validation import validation_curve
+
+
+def test_incremental_validation_curve_tracks_from_scratch_scores(sparse_train):
+    train_sizes = [2000, 8000, 16000]
+
+    incremental = validation_curve(OnlineLogisticRegression(), sparse_train, train_sizes, incremental=True)
+    from_scratch = validation_curve(OnlineLogisticRegression(), sparse_train, train_sizes)
+
+    # An online model resumed on the next chunk ends up where one pass over the prefix does.
+    for (_, test_score), (_, expected_test_score) in zip(incremental, from_scratch):
+        assert abs(test_score - expected_test_score) < 1e-9
+
+    # The first chunk is the whole prefix, later ones are scored by earlier versions of the model.
+    assert abs(incremental[0][0] - from_scratch[0][0]) < 1e-9
+    for (train_score, _), (expected_train_score, _) in zip(incremental[1:], from_scratch[1:]):
+        assert abs(train_score - expected_train_score) < 0.1 * expected_train_score